@@ -7,9 +7,11 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.init as init
+from torch.autograd import Variable
 
 import qelos as q
 from qelos.rnn import PositionwiseForward
+from qelos.seq import chunked_attention
 
 MASKID = 0
 
@@ -48,6 +50,14 @@ def get_attn_subsequent_mask(seq):
     return subsequent_mask
 
 
+def get_position_input(position_enc, batsize, seqlen, start=0):
+    ''' Position encodings of positions start..start+seqlen-1 for every example,
+        (batsize, seqlen, d_pos_vec), broadcast from a slice of the encoding table
+        instead of looking up a (batsize, seqlen) tensor of position indices '''
+    pos_input = position_enc.weight[start:start+seqlen].unsqueeze(0)
+    return pos_input.expand(batsize, seqlen, pos_input.size(2))
+
+
 #### BASIC ##########################
 class ScaledDotProductAttention(nn.Module):
     ''' Scaled Dot-Product Attention. Old, don't use '''
@@ -125,7 +135,8 @@ class OldOriginalMultiHeadAttention(nn.Module):
         k_s = torch.bmm(k_s, self.w_ks).view(-1, len_k, d_k)   # (n_head*mb_size) x len_k x d_k
         v_s = torch.bmm(v_s, self.w_vs).view(-1, len_v, d_v)   # (n_head*mb_size) x len_v x d_v
 
-        q.emit("mymha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
+        if q.emitting("mymha"):
+            q.emit("mymha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
 
         # perform attention, result size = (n_head * mb_size) x len_q x d_v
         if attn_mask.dim() == 2:
@@ -170,37 +181,84 @@ class MultiHeadAttention(nn.Module):
         init.xavier_normal(self.w_ks)
         init.xavier_normal(self.w_vs)
 
-    def forward(self, x, k, v, attn_mask=None):
+    def _project(self, x, *ws):
+        """ projects x with all given weights in one matmul, all weights must have the same size """
+        mb_size, seqlen, dim = x.size()
+        d = ws[0].size(1) // self.n_head
+        w = torch.cat(ws, 1) if len(ws) > 1 else ws[0]
+        y = torch.mm(x.contiguous().view(-1, dim), w).view(mb_size, seqlen, len(ws), self.n_head, d) \
+            .permute(2, 3, 0, 1, 4).contiguous().view(len(ws), -1, seqlen, d)    # len(ws) x (n_head*mb_size) x seqlen x d
+        return tuple([y[i] for i in range(len(ws))])
+
+    def chunked(self, query_chunk=64, key_chunk=256):
+        """ Attend over blocks of queries and keys with an online softmax (see qelos.seq.chunked_attention()).
+            Full attention weights are not materialized, and .forward() returns None instead of them. """
+        self.attention.chunked(query_chunk=query_chunk, key_chunk=key_chunk)
+        return self
+
+    def project_kv(self, k, v):
+        """ computes the (n_head*mb_size) x len_k x d_k key and (n_head*mb_size) x len_v x d_v value projections.
+            Pass them to .forward() as kv to reuse them (e.g. for incremental decoding). """
+        if k is v and self.d_k == self.d_v:
+            return self._project(k, self.w_ks, self.w_vs)
+        return self._project(k, self.w_ks) + self._project(v, self.w_vs)
+
+    def project_qkv(self, x):
+        """ fused query, key and value projections of x for self-attention """
+        if self.d_k == self.d_v:
+            return self._project(x, self.w_qs, self.w_ks, self.w_vs)
+        return self._project(x, self.w_qs) + self.project_kv(x, x)
+
+    def forward(self, x, k, v, attn_mask=None, kv=None):
+        """ if kv is given, k and v are ignored and the given (k_s, v_s) projections are used instead """
         d_k, d_v = self.d_k, self.d_v
         n_head = self.n_head
 
         residual = x
 
         mb_size, len_q, dim_q = x.size()
-        mb_size, len_k, dim_k = k.size()
-        mb_size, len_v, dim_v = v.size()
 
         # treat the result as a (n_head * mb_size) size batch
-        q_s = torch.mm(x.view(-1, dim_q), self.w_qs).view(mb_size, len_q, n_head, d_k) \
-            .permute(2, 0, 1, 3).contiguous().view(-1, len_q, d_k)   # (n_head*mb_size) x len_q x d_k
-        k_s = torch.mm(k.view(-1, dim_k), self.w_ks).view(mb_size, len_k, n_head, d_k) \
-            .permute(2, 0, 1, 3).contiguous().view(-1, len_k, d_k)   # (n_head*mb_size) x len_k x d_k
-        v_s = torch.mm(v.view(-1, dim_v), self.w_vs).view(mb_size, len_v, n_head, d_v) \
-            .permute(2, 0, 1, 3).contiguous().view(-1, len_v, d_v)   # (n_head*mb_size) x len_v x d_v
-
+        if kv is None and k is x and v is x:
+            q_s, k_s, v_s = self.project_qkv(x)
+        else:
+            q_s, = self._project(x, self.w_qs)      # (n_head*mb_size) x len_q x d_k
+            k_s, v_s = kv if kv is not None else self.project_kv(k, v)
+        # k_s: (n_head*mb_size) x len_k x d_k, v_s: (n_head*mb_size) x len_k x d_v
 
-        q.emit("mymha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
+        if q.emitting("mymha"):
+            q.emit("mymha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
 
         # perform attention, result size = (n_head * mb_size) x len_q x d_v
-        if attn_mask.dim() == 2:
-            attn_mask = attn_mask.repeat(n_head, 1)
+        attgen = self.attention.attgen
+        if attn_mask is not None:       # mask is broadcast over heads
+            attn_mask = attn_mask if isinstance(attn_mask, Variable) else Variable(attn_mask)
+            if attn_mask.dim() == 2:
+                attn_mask = attn_mask.unsqueeze(1)          # mb_size x 1 x len_k
+
+        def scores_fn(qs, qe, ks, ke):      # (n_head*mb_size) x (qe-qs) x (ke-ks) scores
+            scores = torch.bmm(q_s[:, qs:qe], k_s[:, ks:ke].transpose(1, 2))
+            if attn_mask is not None:
+                blockmask = attn_mask[:, :, ks:ke] if attn_mask.size(1) == 1 else attn_mask[:, qs:qe, ks:ke]
+                scores = scores.view(n_head, mb_size, qe - qs, ke - ks)
+                scores = scores.masked_fill((blockmask == 0).unsqueeze(0).expand_as(scores), -float("inf"))\
+                    .view(n_head * mb_size, qe - qs, ke - ks)
+            return scores / attgen.scale
+
+        if self.attention._chunks is not None:      # attention weights are never materialized
+            query_chunk, key_chunk = self.attention._chunks
+            outputs = chunked_attention(scores_fn, v_s, len_q, query_chunk=query_chunk,
+                                        key_chunk=key_chunk, dropout=attgen.dropout)
+            attns = None
         else:
-            attn_mask = attn_mask.repeat(n_head, 1, 1)
-        attns = self.attention.attgen(k_s, q_s, mask=attn_mask)
-        outputs = self.attention.attcon(v_s, attns)
+            attns = attgen.normalizer(scores_fn(0, len_q, 0, k_s.size(1)))
+            if attgen.dropout is not None:
+                attns = attgen.dropout(attns)
+            outputs = torch.bmm(attns, v_s)
 
         # back to original mb_size batch, result size = mb_size x len_q x (n_head*d_v)
-        outputs = torch.cat(torch.split(outputs, mb_size, dim=0), dim=-1)
+        outputs = outputs.view(n_head, mb_size, len_q, d_v).permute(1, 2, 0, 3).contiguous()\
+            .view(mb_size, len_q, n_head * d_v)
 
         # project back to residual size
         outputs = self.proj(outputs)
@@ -258,7 +316,8 @@ class OriginalMultiHeadAttention(nn.Module):
         k_s = torch.bmm(k_s, self.w_ks).view(-1, len_k, d_k)   # (n_head*mb_size) x len_k x d_k
         v_s = torch.bmm(v_s, self.w_vs).view(-1, len_v, d_v)   # (n_head*mb_size) x len_v x d_v
 
-        q.emit("mha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
+        if q.emitting("mha"):
+            q.emit("mha", {"q_s": q_s, "k_s": k_s, "v_s": v_s})
 
         # perform attention, result size = (n_head * mb_size) x len_q x d_v
         outputs, attns = self.attention(q_s, k_s, v_s, attn_mask=attn_mask.repeat(n_head, 1, 1))
@@ -322,13 +381,11 @@ class Encoder(nn.Module):
         if isinstance(enc_input, tuple) and len(enc_input) == 2:
             enc_input, enc_slf_attn_mask = enc_input
 
-        if src_pos is None:
-            src_pos = torch.arange(0, src_seq.size(1))\
-                .unsqueeze(0).repeat(src_seq.size(0), 1).long()
-            src_pos = q.var(src_pos).v
-
         # Position Encoding addition
-        pos_input = self.position_enc(src_pos)
+        if src_pos is None:
+            pos_input = get_position_input(self.position_enc, src_seq.size(0), src_seq.size(1))
+        else:
+            pos_input = self.position_enc(src_pos)
         if not self.cat_pos_enc:
             enc_input = enc_input + pos_input           # does the paper add position encodings? --> yes
         else:
@@ -366,9 +423,29 @@ class DecoderLayer(nn.Module):
 
         return dec_output, dec_slf_attn, dec_enc_attn
 
+    def step(self, dec_input, enc_output, cache, slf_attn_mask=None, dec_enc_attn_mask=None):
+        """ computes only the new position(s) in dec_input (batsize, 1, d_model),
+            attending over the self-attention keys/values of previous positions in cache (dict).
+            Encoder keys/values are projected only once and also kept in cache. """
+        slf_kv = self.slf_attn.project_kv(dec_input, dec_input)
+        if "slf_kv" in cache:
+            slf_kv = tuple([torch.cat([prev, new], 1) for prev, new in zip(cache["slf_kv"], slf_kv)])
+        cache["slf_kv"] = slf_kv
+        if "enc_kv" not in cache:
+            cache["enc_kv"] = self.enc_attn.project_kv(enc_output, enc_output)
+
+        dec_output, dec_slf_attn = self.slf_attn(
+            dec_input, None, None, attn_mask=slf_attn_mask, kv=slf_kv)
+        dec_output, dec_enc_attn = self.enc_attn(
+            dec_output, None, None, attn_mask=dec_enc_attn_mask, kv=cache["enc_kv"])
+        dec_output = self.pos_ffn(dec_output)
+
+        return dec_output, dec_slf_attn, dec_enc_attn
+
 
-class Decoder(nn.Module):       # This decoder is teacher forced, non-reccable TODO: make proper decoder
-    ''' A decoder model with self attention mechanism. '''
+class Decoder(nn.Module):
+    ''' A decoder model with self attention mechanism.
+        .forward() is teacher forced, use .step() for incremental decoding. '''
     def __init__(
             self, tgt_emb, n_max_seq, n_layers=6, n_head=8, d_k=64, d_v=64,
             d_pos_vec=212, d_model=512, d_inner_hid=1024, dropout=0.1, cat_pos_enc=True):
@@ -391,21 +468,39 @@ class Decoder(nn.Module):       # This decoder is teacher forced, non-reccable T
             DecoderLayer(d_model, d_inner_hid, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
 
+        self._subsequent_masks = {}     # per device
+
+        # incremental decoding state, see .step()
+        self._cache = None
+        self._t = 0
+        self._slf_attn_mask = None
+
+    def reset_state(self):
+        self._cache = None
+        self._t = 0
+        self._slf_attn_mask = None
+
+    def get_subsequent_mask(self, seqlen, x):
+        ''' (1, seqlen, seqlen) mask allowing every position to attend to itself and previous positions.
+            Built once per device (on the device of x) and sliced for every length. '''
+        device = x.get_device() if x.is_cuda else None
+        mask = self._subsequent_masks.get(device)
+        if mask is None or mask.size(1) < seqlen:
+            maxlen = max(seqlen, self.n_max_seq + 1)
+            mask = torch.ones(maxlen, maxlen).tril().byte().unsqueeze(0)
+            mask = mask.cuda(device) if device is not None else mask
+            self._subsequent_masks[device] = mask
+        return mask[:, :seqlen, :seqlen]
+
     def forward(self, tgt_seq, src_enc, src_mask=None, tgt_pos=None):
         # Word embedding look up
         dec_input, dec_mask = self.tgt_word_emb(tgt_seq)
-        if dec_mask is not None:
-            dec_mask = dec_mask.unsqueeze(1).repeat(1, dec_input.size(1), 1)
-        else:
-            dec_mask = q.var(np.ones((tgt_seq.size(0), tgt_seq.size(1), tgt_seq.size(1)))).v
-
-        if tgt_pos is None:
-            tgt_pos = torch.arange(0, tgt_seq.size(1)) \
-                .unsqueeze(0).repeat(tgt_seq.size(0), 1).long()
-            tgt_pos = q.var(tgt_pos).v
 
         # Position Encoding addition
-        pos_input = self.position_enc(tgt_pos)
+        if tgt_pos is None:
+            pos_input = get_position_input(self.position_enc, tgt_seq.size(0), tgt_seq.size(1))
+        else:
+            pos_input = self.position_enc(tgt_pos)
         if not self.cat_pos_enc:
             dec_input = dec_input + pos_input
         else:
@@ -414,9 +509,10 @@ class Decoder(nn.Module):       # This decoder is teacher forced, non-reccable T
         dec_outputs, dec_slf_attns, dec_enc_attns = [], [], []
 
         # Decode
-        # dec_slf_attn_pad_mask = get_attn_padding_mask(tgt_seq, tgt_seq)
-        dec_slf_attn_sub_mask = -1*get_attn_subsequent_mask(tgt_seq)+1
-        dec_slf_attn_mask = q.var(dec_mask.data.byte() * dec_slf_attn_sub_mask).v
+        # (1, len, len) subsequent mask, only combined with padding mask into (batsize, len, len) if there is one
+        dec_slf_attn_mask = self.get_subsequent_mask(tgt_seq.size(1), dec_input)
+        if dec_mask is not None:
+            dec_slf_attn_mask = dec_mask.data.byte().unsqueeze(1) * dec_slf_attn_mask
 
         dec_output = dec_input
         for dec_layer in self.layer_stack:
@@ -430,6 +526,38 @@ class Decoder(nn.Module):       # This decoder is teacher forced, non-reccable T
 
         return dec_output       #dec_outputs, dec_slf_attns, dec_enc_attns
 
+    def step(self, tgt_t, src_enc, src_mask=None):
+        """ Incremental decoding: computes the decoder output for the next position only.
+            Every layer's self-attention keys/values of previous positions
+            and the encoder-side keys/values are cached until .reset_state() is called.
+            Outputs of consecutive steps equal the outputs of .forward() on the whole sequence.
+            :param tgt_t:   (batsize,) target symbols for current position
+            :param src_enc: (batsize, srclen, d_model) encoder output, only projected on the first step
+            :param src_mask: (batsize, srclen) encoder output mask
+            :return: (batsize, d_model) decoder output for current position """
+        if self._cache is None:
+            self._cache = [{} for _ in self.layer_stack]
+        dec_input, dec_mask = self.tgt_word_emb(tgt_t.unsqueeze(1))
+        if dec_mask is None:
+            dec_mask = q.var(torch.ones(tgt_t.size(0), 1)).cuda(dec_input).v
+        dec_mask = dec_mask.byte()
+        self._slf_attn_mask = dec_mask if self._slf_attn_mask is None \
+            else torch.cat([self._slf_attn_mask, dec_mask], 1)
+
+        pos_input = get_position_input(self.position_enc, tgt_t.size(0), 1, start=self._t)
+        if not self.cat_pos_enc:
+            dec_input = dec_input + pos_input
+        else:
+            dec_input = torch.cat([dec_input, pos_input], 2)
+
+        dec_output = dec_input
+        for dec_layer, cache in zip(self.layer_stack, self._cache):
+            dec_output, _, _ = dec_layer.step(
+                dec_output, src_enc, cache, slf_attn_mask=self._slf_attn_mask,
+                dec_enc_attn_mask=src_mask)
+        self._t += 1
+        return dec_output.squeeze(1)
+
 
 class Transformer(nn.Module):
     ''' A sequence to sequence model with attention mechanism. '''
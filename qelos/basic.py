@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -32,6 +33,8 @@ class Lambda(nn.Module):
 
 class StackSpecFunction(Lambda):
     """ Only used inside stacks."""
+    _spec = None        # compiled spec if made by .spec(), used by Stack's execution plan
+
     @staticmethod
     def get_(spece, a, k, g):
         if isinstance(spece, set):
@@ -43,6 +46,19 @@ class StackSpecFunction(Lambda):
         else:
             return a[spece]
 
+    @staticmethod
+    def compile_(spece):
+        """ resolves spec element once into (source, key),
+            source 0 for previous layer outputs (args), 1 for kwargs and 2 for saved slots """
+        if isinstance(spece, set):
+            assert (len(spece) == 1)
+            return 1, list(spece)[0]
+        elif isinstance(spece, list):
+            assert (len(spece) == 1)
+            return 2, spece[0]
+        else:
+            return 0, spece
+
 
 class argmap(StackSpecFunction):
     """
@@ -92,7 +108,10 @@ class argmap(StackSpecFunction):
             for kwargspec_k, kwargspec_v in kwargspec.items():
                 outkwargs[kwargspec_k] = this.get_(kwargspec_v, args, kwargs, saved_slots)
             return outargs, outkwargs
-        return cls(dict_arg_map)
+        ret = cls(dict_arg_map)
+        ret._spec = ([this.compile_(argspec_e) for argspec_e in argspec],
+                     [(k,) + this.compile_(v) for k, v in kwargspec.items()])
+        return ret
 
 
 class argsave(StackSpecFunction):
@@ -145,13 +164,30 @@ class argsave(StackSpecFunction):
             for spec_key, spec_val in savespec.items():
                 update[spec_key] = this.get_(spec_val, args, kwargs, saved_slots)
             return update
-        return cls(dict_save_map)
+        ret = cls(dict_save_map)
+        ret._spec = [(k,) + this.compile_(v) for k, v in savespec.items()]
+        return ret
+
+
+class _FixedKwargs(nn.Module):
+    """ calls given module with given keyword arguments, for tracing """
+    def __init__(self, module, kw):
+        super(_FixedKwargs, self).__init__()
+        self.module = module
+        self._kw = kw
+
+    def forward(self, *x):
+        return self.module(*x, **self._kw)
 
 
 class Stack(nn.Module):
+    # execution plan ops
+    _LAYER, _MAP, _MAPFN, _SAVE, _SAVEFN = range(5)
+
     def __init__(self, *layers):
         super(Stack, self).__init__()
         self.layers = q.ModuleList()
+        self._plan = None
         self.add(*layers)
         self._saved_slots = {}      # not for params
 
@@ -160,31 +196,69 @@ class Stack(nn.Module):
 
     def _add(self, *layers):
         self.layers.extend(list(layers))
+        self._plan = None
+
+    def compile_plan(self):
+        """
+        Compiles layers into a flat execution plan, run by .forward().
+        Whether layer inputs come from an argmap is known per step in advance
+        and argmap/argsave specs are resolved once into (source, key) lookups.
+        Done automatically on first call after adding layers.
+        """
+        plan = []
+        argmapped = False
+        for layer in self.layers:
+            if isinstance(layer, argmap):
+                if layer._spec is not None:
+                    plan.append((self._MAP, layer._spec, argmapped))
+                else:
+                    plan.append((self._MAPFN, layer, argmapped))
+                argmapped = True
+            elif isinstance(layer, argsave):
+                if layer._spec is not None:
+                    plan.append((self._SAVE, layer._spec, argmapped))
+                else:
+                    plan.append((self._SAVEFN, layer, argmapped))
+            else:
+                plan.append((self._LAYER, layer, argmapped))
+                argmapped = False
+        self._plan = (plan, argmapped)
+        return self
 
     def forward(self, *x, **kw):
+        if self._plan is None:
+            self.compile_plan()
+        plan, argmapped_out = self._plan
+        slots = self._saved_slots
         y_l = x
         args, kwargs = None, None
-        argmapped = False
-        for layer in self.layers:
+        for op, payload, argmapped in plan:
             if argmapped:
                 rargs = args
-                rkw = {}
-                rkw.update(kw)
-                rkw.update(kwargs)
+                rkw = kw
+                if len(kwargs) > 0:
+                    rkw = dict(kw)
+                    rkw.update(kwargs)
             else:
                 rargs = y_l
                 rkw = kw
-            if isinstance(layer, q.argmap):
-                args, kwargs = layer(rargs, rkw, self._saved_slots)
-                argmapped = True
-            elif isinstance(layer, argsave):
-                globols = layer(rargs, rkw, self._saved_slots)
+            if op == self._LAYER:
+                y_l = payload(*rargs, **rkw)
+                if not q.issequence(y_l):
+                    y_l = tuple([y_l])
+            elif op == self._MAP:
+                sources = (rargs, rkw, slots)
+                argspec, kwargspec = payload
+                args = [sources[src][key] for src, key in argspec]
+                kwargs = dict([(name, sources[src][key]) for name, src, key in kwargspec])
+            elif op == self._SAVE:
+                sources = (rargs, rkw, slots)
+                slots.update(dict([(name, sources[src][key]) for name, src, key in payload]))
+            elif op == self._MAPFN:
+                args, kwargs = payload(rargs, rkw, slots)
             else:
-                y_l = layer(*rargs, **rkw)
-                argmapped = False
-            if not q.issequence(y_l) and not argmapped:
-                y_l = tuple([y_l])
-        if argmapped:
+                payload(rargs, rkw, slots)
+        if argmapped_out:
             ret = args
         else:
             ret = y_l
@@ -192,9 +266,111 @@ class Stack(nn.Module):
             ret = ret[0]
         return ret
 
+    def trace(self, *x, **kw):
+        """
+        Traces this stack with example inputs x and fixed keyword arguments kw
+        into a TorchScript module (requires torch.jit) that runs without the python execution plan.
+        Only valid as long as the control flow of the layers does not depend on the inputs.
+        """
+        if not hasattr(torch, "jit") or not hasattr(torch.jit, "trace"):
+            raise q.SumTingWongException("tracing requires torch.jit")
+        return torch.jit.trace(_FixedKwargs(self, kw), x)
+
     # TODO: stack generator
 
 
+class IndexMask(object):
+    """
+    Sparse (batsize, outdim) 0/1 mask, given by the allowed ids of every row.
+    When given as mask= to WordLinout/ComputedWordLinout, only the scores for the allowed ids are computed
+    and compact (batsize, numids) scores (aligned with .ids) are returned.
+    Softmax/LogSoftmax accept compact or full scores with this mask and return full (batsize, outdim) outputs.
+    """
+    def __init__(self, ids, mask, outdim):
+        """
+        :param ids:     (batsize, numids) LongTensor variable of allowed ids, padding positions must contain a valid id (e.g. 0)
+        :param mask:    (batsize, numids) float variable, 0 for padding positions
+        :param outdim:  number of possible ids
+        """
+        assert(ids.size(1) != outdim)       # to tell compact and full scores apart
+        self.ids, self.mask, self.outdim = ids, mask, outdim
+
+    @classmethod
+    def from_lists(cls, lists, outdim, cuda=None):
+        """ :param lists: list of lists of allowed ids, one per row """
+        numids = max([1] + [len(l) for l in lists])
+        numids += 1 if numids == outdim else 0
+        ids = np.zeros((len(lists), numids), dtype="int64")
+        mask = np.zeros((len(lists), numids), dtype="float32")
+        for i, l in enumerate(lists):
+            ids[i, :len(l)] = l
+            mask[i, :len(l)] = 1
+        return cls(q.var(ids).cuda(cuda).v, q.var(mask).cuda(cuda).v, outdim)
+
+    def gather(self, x):
+        """ (batsize, outdim) --> (batsize, numids) """
+        return torch.gather(x, 1, self.ids)
+
+    def scatter(self, x, fill=0.):
+        """ (batsize, numids) --> (batsize, outdim), not allowed ids get value fill """
+        pad = (self.mask == 0).long()
+        scatter_ids = self.ids * (1 - pad) + pad * self.outdim         # padding goes to extra column
+        ret = q.var(x.data.new(x.size(0), self.outdim + 1).fill_(fill)).v
+        ret = ret.scatter(1, scatter_ids, x)
+        return ret[:, :self.outdim]
+
+    def to_dense(self):
+        return self.scatter(self.mask)
+
+    def index_select(self, dim, idx):
+        assert(dim == 0)
+        return IndexMask(self.ids.index_select(0, idx), self.mask.index_select(0, idx), self.outdim)
+
+
+class SparseVNT(object):
+    """
+    Sparse valid next tokens (allowed output ids for every timestep) for a batch of sequences.
+    Can be given as outmask= to decoders of AttentionDecoderCell instead of a dense (batsize, seqlen, outdim) mask,
+    .step() makes the IndexMask for one timestep.
+    """
+    def __init__(self, vnt, outdim, seqlen=None, rows=None):
+        """
+        :param vnt:     one of:
+                        * list (examples) of lists (timesteps) of lists of allowed ids
+                        * scipy sparse matrix (numexamples * seqlen, outdim), row i * seqlen + t for timestep t of example i
+                        * callable f(t, x_t, rows) that returns a list of allowed id lists for examples rows (numpy array)
+                          given (batsize,) inputs x_t (e.g. previous tokens) at timestep t
+        :param outdim:  number of possible ids
+        :param seqlen:  number of timesteps per example (required for sparse matrix)
+        :param rows:    (optional) numpy array of examples in batch, all examples by default
+        """
+        self.vnt, self.outdim, self.seqlen = vnt, outdim, seqlen
+        if rows is None and not callable(vnt):
+            numex = len(vnt) if isinstance(vnt, list) else vnt.shape[0] // seqlen
+            rows = np.arange(numex)
+        self.rows = rows
+
+    def step(self, t, x_t=None):
+        """ IndexMask of allowed ids at timestep t for every example """
+        if callable(self.vnt):
+            rows = self.rows if self.rows is not None else np.arange(x_t.size(0))
+            lists = self.vnt(t, x_t, rows)
+        elif isinstance(self.vnt, list):
+            lists = [self.vnt[i][t] if t < len(self.vnt[i]) else [] for i in self.rows]
+        else:       # sparse matrix
+            m = self.vnt[self.rows * self.seqlen + t].tocsr()
+            lists = [m.indices[m.indptr[i]:m.indptr[i+1]] for i in range(len(self.rows))]
+        return IndexMask.from_lists(lists, self.outdim, cuda=x_t)
+
+    def index_select(self, dim, idx):
+        """ keeps only examples idx (LongTensor) """
+        assert(dim == 0)
+        idx = idx.data if hasattr(idx, "data") else idx
+        idx = idx.cpu().numpy()
+        rows = idx if self.rows is None else self.rows[idx]
+        return SparseVNT(self.vnt, self.outdim, seqlen=self.seqlen, rows=rows)
+
+
 class Softmax(nn.Module):
     def __init__(self, temperature=1., _log_in_train=False):
         super(Softmax, self).__init__()
@@ -202,6 +378,14 @@ class Softmax(nn.Module):
         self._log = False
         self._logafter = False
         self._log_in_train = _log_in_train
+        self._inplace = False
+
+    def inplace(self, truth=True):
+        """ Compute masked (log-)softmax in-place on the given scores if they don't require gradients (inference).
+            The scores passed to .forward() are overwritten. Softmax needs no buffers beyond the row reductions,
+            log-softmax needs one temporary of the size of the scores (for the exponentials). """
+        self._inplace = truth
+        return self
 
     def logsumexp(self, x, mask=None):
         #x = torch.add(x, torch.log(mask))
@@ -219,6 +403,8 @@ class Softmax(nn.Module):
     def forward(self, x, mask=None, temperature=None):
         temperature = temperature if temperature is not None else self.temperature
         mask = mask if mask is not None else x.mask if hasattr(x, "mask") else None
+        if isinstance(mask, IndexMask):
+            return self._forward_index_mask(x, mask, temperature), mask
         mask = mask.float() if mask is not None else mask
         xndim = x.dim()
         s = x.size()
@@ -237,29 +423,21 @@ class Softmax(nn.Module):
             if mask is not None:
                 maskshape = mask.size()
                 mask = mask.view(-1, mask.size(-1))
-        x = x / temperature
+        if temperature != 1.:
+            x = x / temperature
         if mask is None:
             if self._log:
                 o_exp = F.log_softmax(x)
             else:
                 o_exp = F.softmax(x)
-        else:
+        elif self._inplace and not x.requires_grad:
+            o_exp = self._masked_softmax_(x, mask)
+        else:       # masked positions get -inf scores, normalized in one stable pass
+            x = x.masked_fill(mask == 0, -float("inf"))
             if self._log:
-                o_exp_sum = self.logsumexp(x, mask)
-                masklog = mask.log()
-                o_exp = x.add(masklog)
-                o_exp.sub_(o_exp_sum)
+                o_exp = F.log_softmax(x)
             else:
-                x_mins, _ = torch.min(x, 1, keepdim=True)
-                x.sub_(x_mins)
-                x = torch.mul(x, mask)
-                x.add_(x_mins)
-                o_exp, _ = torch.max(x, 1, keepdim=True)
-                o_exp = x - o_exp
-                o_exp.exp_()
-                o_exp = torch.mul(o_exp, mask)
-                o_exp_sum = torch.sum(o_exp, 1, keepdim=True)
-                o_exp = torch.div(o_exp, o_exp_sum)
+                o_exp = F.softmax(x)
                 if self._logafter:
                     o_exp = torch.log(o_exp)
         retmask = None
@@ -276,7 +454,37 @@ class Softmax(nn.Module):
             return o_exp
 
 
-class LogSoftmax(Softmax):      # TODO: some numerical instability
+    def _masked_softmax_(self, x, mask):
+        """ in-place masked (log-)softmax of (N, dim) x """
+        x.masked_fill_(mask == 0, -float("inf"))
+        x_max, _ = torch.max(x, 1, keepdim=True)
+        x.sub_(x_max)
+        if self._log:       # exp() in a temporary: exp_() and log_() back would lose the tiny log-probabilities
+            x.sub_(torch.log(torch.sum(torch.exp(x), 1, keepdim=True)))
+        else:
+            x.exp_()
+            x.div_(torch.sum(x, 1, keepdim=True))
+            if self._logafter:
+                x.log_()
+        return x
+
+    def _forward_index_mask(self, x, mask, temperature):
+        """ normalizes only over the allowed ids of every row """
+        if x.dim() != 2:
+            raise Exception("index masks only supported for 2D inputs")
+        if x.size(1) == mask.outdim:            # full scores
+            x = mask.gather(x)
+        x = x / temperature
+        x = x + torch.log(mask.mask)             # padding --> -inf
+        if self._log or self._logafter:
+            o = F.log_softmax(x)
+            return mask.scatter(o, fill=-float("inf"))
+        else:
+            o = F.softmax(x)
+            return mask.scatter(o, fill=0.)
+
+
+class LogSoftmax(Softmax):
     def __init__(self, temperature=1.):
         super(LogSoftmax, self).__init__(temperature=temperature)
         self._log = True
@@ -305,7 +513,14 @@ class Forward(nn.Module):
 
 
 class Distance(nn.Module):
-    pass
+    def prepare(self, data):
+        """ Precomputes what only depends on (batsize, lseqlen, dim) data (e.g. projected keys),
+            to be reused by .score() for many different crits (e.g. every step of a decoder) """
+        return data
+
+    def score(self, prepared, crit):
+        """ Distances between data prepared by .prepare() and (batsize, dim) crit --> (batsize, lseqlen) """
+        return self(prepared, crit)
 
 
 class DotDistance(Distance):
@@ -391,6 +606,15 @@ class ForwardDistance(Distance):
         dists = torch.matmul(linsum, self.agg)  # TODO: check if this works for 3D x 1D and 4D x 1D
         return dists
 
+    def prepare(self, data):            # (batsize, lseqlen, dim) --> (batsize, lseqlen, aggdim)
+        return self.lblock(data)
+
+    def score(self, prepared, crit):    # (batsize, lseqlen, aggdim), (batsize, dim)
+        critlin = self.rblock(crit).unsqueeze(1)
+        linsum = self.activation(prepared + critlin)
+        dists = torch.matmul(linsum, self.agg)
+        return dists
+
 
 class BilinearDistance(Distance):
     memsave = False
@@ -422,6 +646,12 @@ class BilinearDistance(Distance):
             dists = dists.view(*data.size()[:-1])
         return dists
 
+    def prepare(self, data):            # (batsize, lseqlen, ldim) --> (batsize, lseqlen, rdim)
+        return torch.matmul(data, self.block.weight[0])
+
+    def score(self, prepared, crit):    # (batsize, lseqlen, rdim), (batsize, rdim)
+        return torch.bmm(prepared, crit.unsqueeze(2)).squeeze(2)
+
 
 class TrilinearDistance(Distance):
     memsave = False
@@ -447,7 +677,7 @@ class TrilinearDistance(Distance):
         if data.dim() == 3:
             l = data.view(-1, data.size(-1))
             if crit.dim() == 2:
-                r = crit.unsqueeze(1).expand_as(data).contiguous().view(-1, crit.size(-1))  # (batsize * lseqlen, dim)
+                r = crit.unsqueeze(1).expand(crit.size(0), data.size(1), crit.size(-1)).contiguous().view(-1, crit.size(-1))  # (batsize * lseqlen, dim)
             else:       # crit.dim() == 3
                 l = l.unsqueeze(1).repeat(1, r.size(1), 1).contiguous().view(-1, data.size(-1))     # (batsize * lseqlen * rseqlen, dim)
                 r = r.unsqueeze(1).repeat(1, data.size(1), 1, 1).view(-1, crit.size(-1))                                # (batsize * rseqlen * lseqlen, dim)
@@ -460,6 +690,19 @@ class TrilinearDistance(Distance):
             dists = dists.view(*data.size()[:-1])
         return dists
 
+    def score(self, data, crit):        # (batsize, lseqlen, ldim), (batsize, rdim)
+        # caching data projections would take lseqlen * aggdim * rdim memory per example,
+        # project crit instead: once per call, not once per data element
+        weight = self.block.weight          # (aggdim, ldim, rdim)
+        weight = weight.permute(2, 0, 1).contiguous().view(weight.size(2), -1)
+        critlin = torch.mm(crit, weight).view(crit.size(0), self.block.weight.size(0), -1)     # (batsize, aggdim, ldim)
+        bilinsum = torch.bmm(data, critlin.transpose(1, 2))      # (batsize, lseqlen, aggdim)
+        if self.block.bias is not None:
+            bilinsum = bilinsum + self.block.bias
+        bilinsum = self.activation(bilinsum)
+        dists = torch.matmul(bilinsum, self.agg)
+        return dists
+
 
 class SeqBatchNorm1d(nn.Module):
 
@@ -566,7 +809,7 @@ class LayerNormalization(nn.Module):
         self.b_2 = nn.Parameter(torch.zeros(dim), requires_grad=True)
 
     def forward(self, z):
-        if z.size(1) == 1:
+        if z.size(-1) == 1:
             return z
 
         mu = torch.mean(z, keepdim=True, dim=-1)
@@ -0,0 +1,127 @@
+import torch
+from torch import nn
+from torch.autograd import Variable
+from qelos.basic import Stack
+from qelos.rnn import RecStateful
+from qelos.exceptions import SumTingWongException
+from qelos.util import issequence, EmitHooks
+
+
+class _TracedCall(nn.Module):
+    """ Calls model with positional tensor inputs only, for tracing.
+        Tensor kwargs come after the inputs, followed by the (non-None) recurrent states for RecStateful models. """
+    def __init__(self, model, kwnames, fixedkw, stateidx=None, numstates=None):
+        super(_TracedCall, self).__init__()
+        self.model = model
+        self._kwnames, self._fixedkw = kwnames, fixedkw
+        self._stateidx, self._numstates = stateidx, numstates
+        self._numouts = None
+
+    def forward(self, *x):
+        x = list(x)
+        states = None
+        if self._stateidx is not None:
+            states = x[len(x) - len(self._stateidx):]
+            x = x[:len(x) - len(self._stateidx)]
+        kw = dict(self._fixedkw)
+        kw.update(zip(self._kwnames, x[len(x) - len(self._kwnames):]))
+        x = x[:len(x) - len(self._kwnames)]
+        if states is not None:
+            self.model.reset_state()        # nothing from previous (traced) calls is used
+            allstates = [None] * self._numstates
+            for i, state in zip(self._stateidx, states):
+                allstates[i] = state
+            self.model.set_states(*allstates)
+        y = self.model(*x, **kw)
+        y = tuple(y) if issequence(y) else (y,)
+        self._numouts = len(y)
+        if states is not None:
+            newstates = self.model.get_states(x[0].size(0))
+            y += tuple([newstates[i] for i in self._stateidx])
+        return y
+
+
+class Exported(object):
+    """
+    Runs a model traced by export().
+    Called like the original model (same inputs, same tensor kwargs), returns the same outputs.
+    For exported RecStateful models (e.g. decoder cells), recurrent states are kept here
+    and passed through the traced step explicitly.
+    """
+    def __init__(self, traced, kwnames, numouts, init_states=None):
+        self.traced = traced
+        self._kwnames, self._numouts = kwnames, numouts
+        self._init_states = init_states
+        self._states = None
+
+    def reset_state(self):
+        """ next call starts from the states the model had when it was exported """
+        self._states = None
+        return self
+
+    def get_states(self, batsize=None):
+        return self._states
+
+    def set_states(self, *states):
+        """ sets the states that are passed through the traced step (non-None states of the original model) """
+        assert(len(states) == len(self._init_states))
+        self._states = list(states)
+        return self
+
+    def __call__(self, *x, **kw):
+        if set(kw.keys()) != set(self._kwnames):
+            raise SumTingWongException("exported with tensor kwargs {}, got {}".format(self._kwnames, list(kw.keys())))
+        x = tuple(x) + tuple([kw[k] for k in self._kwnames])
+        if self._init_states is not None:
+            x += tuple(self._states if self._states is not None else self._init_states)
+        y = self.traced(*x)
+        y = tuple(y) if issequence(y) else (y,)
+        if self._init_states is not None:
+            self._states = list(y[self._numouts:])
+        y = y[:self._numouts]
+        return y[0] if len(y) == 1 else y
+
+
+def export(model, example_inputs, **kw):
+    """
+    Traces model into a TorchScript graph (requires torch.jit) for low-overhead inference.
+    Python-only bookkeeping (Stack's argmap/argsave routing, emit() calls, isinstance checks) is not part of the graph.
+    Only valid as long as the control flow of model does not depend on the values of the inputs
+    (sequence lengths are fixed by the example inputs for layers that loop over time).
+    :param model:           module to export, put in eval mode first for inference
+    :param example_inputs:  positional input variable or sequence of them
+    :param kw:              keyword arguments to model: variables become inputs of the graph
+                            (must be given again on every call), other values are fixed
+    :return:    Exported, called like model.
+                RecStateful models (e.g. a decoder cell) are exported as one step,
+                with recurrent states kept by the Exported. After .reset_state(), states start
+                from the (non-None) states model has when exported (e.g. after model.reset_state()
+                and model.set_init_states()), for other batch sizes use .set_states().
+    """
+    if not hasattr(torch, "jit") or not hasattr(torch.jit, "trace"):
+        raise SumTingWongException("export requires torch.jit")
+    example_inputs = tuple(example_inputs) if issequence(example_inputs) else (example_inputs,)
+    kwnames = sorted([k for k, v in kw.items() if isinstance(v, Variable)])
+    fixedkw = dict([(k, v) for k, v in kw.items() if k not in kwnames])
+    inputs = example_inputs + tuple([kw[k] for k in kwnames])
+    stateidx = None
+    if isinstance(model, RecStateful):
+        states = list(model.get_states(example_inputs[0].size(0)))
+        stateidx = [i for i, state in enumerate(states) if state is not None]
+        inputs += tuple([states[i] for i in stateidx])
+    stacks = [m for m in model.modules() if isinstance(m, Stack)]
+    saved_slots = [dict(stack._saved_slots) for stack in stacks]
+    emit_enabled = EmitHooks.enabled
+    EmitHooks.enabled = False
+    try:
+        tracee = _TracedCall(model, kwnames, fixedkw, stateidx=stateidx,
+                             numstates=len(states) if stateidx is not None else None)
+        traced = torch.jit.trace(tracee, inputs)
+    finally:
+        EmitHooks.enabled = emit_enabled
+        for stack, slots in zip(stacks, saved_slots):      # don't keep values from tracing around
+            stack._saved_slots = slots
+        if stateidx is not None:       # back to states from before tracing
+            model.set_states(*states)
+    init_states = [states[i] for i in stateidx] if stateidx is not None else None
+    return Exported(traced, kwnames, tracee._numouts, init_states=init_states)
@@ -4,6 +4,8 @@ from torch.autograd import Variable
 import numpy as np
 import qelos as q
 from torch.utils.data import DataLoader
+from torch.utils.data.sampler import Sampler
+from torch.utils.data.dataloader import default_collate
 
 
 class var(object):
@@ -50,19 +52,226 @@ def name2fn(x):
 
 
 def seq_pack(x, mask):  # mask: (batsize, seqlen)
+    """ given N-dim sequence "x" (N>=2), and 2D mask (batsize, seqlen)
+        returns packed sequence (sorted by length) and indexes to un-sort (also used by seq_unpack)
+        sequences with no unmasked elements are treated as length 1 """
+    mask = mask.float()
     # 1. get lengths
     lens = torch.sum(mask, 1)
     # 2. sort by length
+    assert(lens.dim() == 1)
+    _, sortidxs = torch.sort(lens, 0, descending=True)
+    _, unsorter = torch.sort(sortidxs, 0)
     # 3. pack
-    return x
+    sortedseq = torch.index_select(x, 0, sortidxs)
+    sortedlens = torch.index_select(lens, 0, sortidxs)
+    sortedlens = [max(1, int(round(l))) for l in sortedlens.data.cpu().numpy()]
+    packedseq = torch.nn.utils.rnn.pack_padded_sequence(sortedseq, sortedlens, batch_first=True)
+    return packedseq, unsorter
 
 
-def seq_unpack(x):
-    return x, mask
+def seq_unpack(x, order):
+    """ given packed sequence "x" and the un-sorter "order",
+        returns padded sequence (un-sorted by "order") and a binary 2D mask (batsize, seqlen) """
+    out, lens = torch.nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+    out = torch.index_select(out, 0, order)
+    lens = np.asarray(lens)[order.data.cpu().numpy()]
+    mask = (np.arange(out.size(1))[np.newaxis, :] < lens[:, np.newaxis]).astype("int64")
+    mask = q.var(mask).cuda(out).v
+    return out, mask
+
+
+def seq_lengths(x):
+    """ lengths of (numex, seqlen, ...) numpy array or tensor of sequences padded with zeros
+        (up to and including the last timestep with any nonzero element) """
+    x = x.numpy() if torch.is_tensor(x) else np.asarray(x)
+    nonzero = (x != 0).reshape(x.shape[0], x.shape[1], -1).any(axis=2)      # (numex, seqlen)
+    lens = x.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+    lens[~nonzero.any(axis=1)] = 0
+    return lens
+
+
+def _make_batches(lengths, idxs, batch_size=None, max_tokens=None):
+    """ cuts idxs (sorted by length, longest first) into batches of batch_size examples
+        or of as many examples as fit in max_tokens padded tokens (batsize * longest length in batch) """
+    if max_tokens is None:
+        return [idxs[j:j + batch_size] for j in range(0, len(idxs), batch_size)]
+    batches = []
+    start = 0
+    while start < len(idxs):
+        end = start + max(1, max_tokens // max(1, lengths[idxs[start]]))     # first example is the longest
+        if batch_size is not None:
+            end = min(end, start + batch_size)
+        batches.append(idxs[start:end])
+        start = end
+    return batches
+
+
+class BucketSampler(Sampler):
+    """
+    Batch sampler that makes batches of examples with similar lengths to reduce padding.
+    Every epoch, examples are shuffled, split in pools of poolsize batches,
+    sorted by length within every pool and cut into batches. The order of batches is shuffled too.
+    Batches have batch_size examples, or, if max_tokens is given, as many examples as fit in a budget of
+    max_tokens padded tokens (so batches of short sequences are larger than batches of long sequences).
+    """
+    def __init__(self, lengths, batch_size=1, shuffle=True, poolsize=50, drop_last=False, max_tokens=None):
+        """
+        :param lengths:     (numex,) numpy array of example lengths (see seq_lengths())
+        :param batch_size:  number of examples per batch (maximum number if max_tokens is given, None for no maximum)
+        :param poolsize:    number of batches to sort at once, None to sort all examples
+                            (with max_tokens: pools of poolsize * max_tokens tokens)
+        :param drop_last:   drop smaller last batches of every pool (only without max_tokens)
+        :param max_tokens:  token budget per batch: batsize * longest length in batch
+        """
+        self.lengths, self.batch_size, self.shuffle = np.asarray(lengths), batch_size, shuffle
+        self.poolsize, self.drop_last, self.max_tokens = poolsize, drop_last, max_tokens
+        self._next_batches = None       # batches of the next epoch, made by __len__() with max_tokens
+
+    def _batches(self):
+        idxs = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        if self.poolsize is None:
+            pool = len(idxs)
+        elif self.max_tokens is not None:
+            pool = max(1, self.poolsize * self.max_tokens // max(1, int(self.lengths.mean())))
+        else:
+            pool = self.poolsize * self.batch_size
+        batches = []
+        for i in range(0, len(idxs), pool):
+            pool_idxs = idxs[i:i + pool]
+            pool_idxs = pool_idxs[np.argsort(-self.lengths[pool_idxs], kind="mergesort")]
+            batches += _make_batches(self.lengths, pool_idxs, batch_size=self.batch_size, max_tokens=self.max_tokens)
+        if self.drop_last and self.max_tokens is None:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self._next_batches if self._next_batches is not None else self._batches()
+        self._next_batches = None
+        for batch in batches:
+            yield [int(idx) for idx in batch]
+
+    def __len__(self):
+        if self.max_tokens is not None:     # depends on shuffling: batches of the next epoch are made once and kept
+            if self._next_batches is None:
+                self._next_batches = self._batches()
+            return len(self._next_batches)
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class InferenceBatcher(object):
+    """
+    Batched inference over a stream of single examples (e.g. requests to a Decoder or AYNTransformer),
+    results are returned in the order of the examples.
+    Examples are read in windows of `window` examples, sorted by length within a window,
+    cut into batches (see BucketSampler), padded with zeros and run through the model one batch at a time.
+    """
+    def __init__(self, model, batch_size=32, max_tokens=None, window=None, trim=False, cuda=None):
+        """
+        :param model:       called with (batsize, ...) variables, one for every input of an example,
+                            must return a (batsize, ...) variable or a tuple of them
+        :param batch_size:  (maximum) number of examples per batch
+        :param max_tokens:  token budget per batch (see BucketSampler), lengths are those of the first input
+        :param window:      number of examples to read before running them, default 50 batches
+        :param trim:        cut outputs to the example's length along axis 1 (e.g. for decoder outputs)
+        :param cuda:        run on gpu
+        """
+        self.model, self.batch_size, self.max_tokens, self.trim, self.cuda = model, batch_size, max_tokens, trim, cuda
+        self.window = window if window is not None else 50 * (batch_size if batch_size is not None else 1)
+
+    def __call__(self, examples):
+        """
+        :param examples:    iterable of examples (can be a generator), every example is a numpy array
+                            or a tuple of numpy arrays (or lists), of different lengths along the first axis
+        :return:            generator of results (numpy arrays or tuples of them, one for every output of the model)
+        """
+        window = []
+        for example in examples:
+            window.append(example if isinstance(example, tuple) else (example,))
+            if len(window) >= self.window:
+                for result in self._run(window):
+                    yield result
+                window = []
+        if len(window) > 0:
+            for result in self._run(window):
+                yield result
+
+    def _run(self, examples):
+        examples = [[np.asarray(x_e) for x_e in example] for example in examples]
+        lengths = np.asarray([len(example[0]) for example in examples])
+        idxs = np.argsort(-lengths, kind="mergesort")
+        results = [None] * len(examples)
+        for batch in _make_batches(lengths, idxs, batch_size=self.batch_size, max_tokens=self.max_tokens):
+            inputs = []
+            for i in range(len(examples[batch[0]])):
+                x = [examples[j][i] for j in batch]
+                padded = np.zeros((len(x), max([len(x_e) for x_e in x])) + x[0].shape[1:], dtype=x[0].dtype)
+                for k, x_e in enumerate(x):
+                    padded[k, :len(x_e)] = x_e
+                inputs.append(var(padded, volatile=True).cuda(self.cuda).v)
+            outputs = self.model(*inputs)
+            outputs = outputs if q.issequence(outputs) else (outputs,)
+            outputs = [output.data.cpu().numpy() for output in outputs]
+            for k, j in enumerate(batch):
+                result = tuple([output[k, :lengths[j]] if self.trim else output[k] for output in outputs])
+                results[j] = result[0] if len(result) == 1 else result
+        return results
+
+
+class TrimCollate(object):
+    """
+    Collates a batch and trims the time axis (axis 1) of the given tensors
+    to the longest sequence in the batch (see seq_lengths()).
+    """
+    def __init__(self, trim):
+        """ :param trim: indexes of tensors in batch to trim, or groups (lists/tuples) of indexes of
+                         tensors aligned over time, which are trimmed to the same length (longest in group) """
+        self.groups = [tuple(group) if q.issequence(group) else (group,) for group in trim]
+
+    def __call__(self, batch):
+        batch = list(default_collate(batch))
+        for group in self.groups:
+            maxlen = max(1, max([int(seq_lengths(batch[i]).max()) for i in group]))
+            for i in group:
+                batch[i] = batch[i][:, :maxlen].contiguous()
+        return batch
 
 
 def dataload(*tensors, **kw):
+    """
+    Makes a DataLoader over given tensors (see TensorDataset), shuffled by default.
+    :param tensors: tensors or numpy arrays, same number of examples
+    :param bucket:  (optional) index of tensor of zero-padded sequences (e.g. the input sequences)
+                    or numpy array of example lengths:
+                    batches contain examples of similar lengths (see BucketSampler)
+    :param max_tokens: (optional, with bucket) batches of as many examples as fit in max_tokens padded tokens
+                    instead of batch_size examples (see BucketSampler)
+    :param trim:    (optional) indexes of tensors of zero-padded sequences to trim
+                    to the longest sequence in every batch (along axis 1, e.g. also a (numex, seqlen, vocsize) vnt tensor),
+                    or True for all tensors with more than one dimension (each trimmed separately).
+                    Tensors aligned over time (e.g. a vnt and the gold outputs) must be given as a group
+                    (list/tuple of indexes) to be trimmed to the same length, e.g. trim=[0, (1, 2)]
+    :param kw:      other DataLoader arguments (e.g. batch_size)
+    """
     if "shuffle" not in kw:
         kw["shuffle"] = True
+    bucket = kw.pop("bucket", None)
+    trim = kw.pop("trim", None)
+    max_tokens = kw.pop("max_tokens", None)
+    assert(max_tokens is None or bucket is not None)
     tensordataset = q.TensorDataset(*tensors)
-    dataloader = DataLoader(tensordataset, **kw)
\ No newline at end of file
+    if trim is True:
+        trim = [i for i, x in enumerate(tensordataset.tensors) if x.dim() > 1]
+    if trim is not None:
+        kw["collate_fn"] = TrimCollate(trim)
+    if bucket is not None:
+        lengths = seq_lengths(tensordataset.tensors[bucket]) if q.isnumber(bucket) else bucket
+        kw["batch_sampler"] = BucketSampler(lengths, batch_size=kw.pop("batch_size", 1 if max_tokens is None else None),
+                                            shuffle=kw.pop("shuffle"), poolsize=kw.pop("poolsize", 50),
+                                            drop_last=kw.pop("drop_last", False), max_tokens=max_tokens)
+    dataloader = DataLoader(tensordataset, **kw)
+    return dataloader
@@ -1,8 +1,14 @@
 import torch
+import numpy as np
 from torch.autograd import Variable
 from torch import nn
+from torch.nn import functional as F
 import qelos as q
 from qelos.basic import Stack
+try:
+    from torch.utils.checkpoint import checkpoint as _torch_checkpoint
+except ImportError:     # older pytorch versions
+    _torch_checkpoint = None
 
 
 # region I. RNN cells
@@ -69,14 +75,34 @@ class PackedRNUGates(nn.Module):
         if self.rec_bn is True:
             self._rbn.reset_parameters()
 
+    def precompute(self, x):
+        """
+        Projects the first input through its part of the weights (and adds bias).
+        Used for hoisting input projections out of the timestep loop.
+        :param x:   (batsize, xdim) first input, usually all timesteps flattened into the batch
+        :return:    (batsize, outdim) to be passed as xproj= to .forward()
+        """
+        assert(self._rbn is None)       # can't hoist with recurrent batch norm
+        v = torch.mm(x, self.W[:x.size(1)])
+        if self.use_bias:
+            v = v + self.b
+        return v
+
     def forward(self, *args, **kw):
         t = None if "t" not in kw else kw["t"]
-        x = torch.cat(list(args), 1)
-        v = torch.mm(x, self.W)
-        if self._rbn is not None:
-            v = self._rbn(v, t)      # TODO: check masking
-        if self.use_bias:
-            v.add_(self.b)
+        xproj = None if "xproj" not in kw else kw["xproj"]
+        if xproj is not None:       # first input already projected by .precompute()
+            v = xproj
+            if len(args) > 1:
+                h = torch.cat(list(args[1:]), 1)
+                v = torch.addmm(v, h, self.W[args[0].size(1):])
+        else:
+            x = torch.cat(list(args), 1)
+            v = torch.mm(x, self.W)
+            if self._rbn is not None:
+                v = self._rbn(v, t)      # TODO: check masking
+            if self.use_bias:
+                v.add_(self.b)
         ret = []
         for outgate in self.outgates:
             outgateslice = outgate[0]
@@ -101,8 +127,8 @@ class RecStateful(Reccable):
     Stores recurrent state.
     """
     @property
-    def state_spec(self):
-        raise NotImplementedError("use subclass")
+    def state_spec(self):     # AttributeError keeps hasattr() probes (e.g. by torch.jit) working on stateful containers
+        raise AttributeError("use subclass")
 
     @property
     def numstates(self):
@@ -117,6 +143,9 @@ class RecStateful(Reccable):
     def get_init_states(self, arg):
         raise NotImplementedError("use subclass. subclasses must implement this method")
 
+    def detach_states(self):
+        raise NotImplementedError("use subclass. subclasses must implement this method")
+
 
 class RecStatefulContainer(RecStateful):
     """
@@ -130,11 +159,21 @@ class RecStatefulContainer(RecStateful):
 
 
 class RNUBase(RecStateful):
+    _rollout_attrs = ()     # names of attributes that hold per-rollout values other than states (e.g. shared dropout masks)
+
     def __init__(self, *x, **kw):
         super(RecStateful, self).__init__(*x, **kw)
         self._init_states = None
         self._states = None
         self._y_tm1 = None
+        self._zero = torch.zeros(1)         # follows module's device and type (see ._apply())
+        self._init_states_cache = {}
+
+    def _apply(self, fn):
+        ret = super(RNUBase, self)._apply(fn)
+        self._zero = fn(self._zero)
+        self._init_states_cache = {}
+        return ret
 
     def to_layer(self):
         return RNNLayer(self)
@@ -144,6 +183,7 @@ class RNUBase(RecStateful):
         resets states and shared dropout masks.
         """
         self._states = None
+        self._y_tm1 = None
 
     def get_states(self, arg):
         if self._states is None:    # states don't exist yet
@@ -154,11 +194,19 @@ class RNUBase(RecStateful):
             _states = self._states
         return _states
 
+    def detach_states(self):
+        """ cuts the stored states (and carried output) from the graph that computed them,
+        for truncated backpropagation through time """
+        if self._states is not None:
+            self._states = [state.detach() for state in self._states]
+        if self._y_tm1 is not None:
+            self._y_tm1 = self._y_tm1.detach()
+
     def set_states(self, *states):
         if self._states is not None:
             assert(len(states) == len(self._states))
             for i, state in enumerate(states):
-                assert(state.size() == self._states[i].size())
+                assert(state.size()[1:] == self._states[i].size()[1:])     # batch size can change
                 self._states[i] = state
         else:
             self._states = []
@@ -167,40 +215,50 @@ class RNUBase(RecStateful):
 
     def get_init_states(self, arg):
         """
-        :param arg: batch size (will generate and return compatible init states) or None (will return what is stored)
+        :param arg: batch size (will generate and return compatible init states),
+                    0 (returns init states without expanding to batch size) or None (will return what is stored)
         :return: initial states, states that have previously been set or newly generated zero states based on given batch size
+        Generated zero states are cached per device and type: one of the largest batch size asked so far,
+        sliced for smaller batch sizes. Expanded init states are cached for the last batch size only.
         """
         if arg is None:
             return self._init_states
-        assert(q.isnumber(arg) or arg is None)       # is batch size
+        assert(q.isnumber(arg))       # is batch size
         if self._init_states is None:       # no states have been set using .set_init_states()
             _init_states = [None] * self.numstates
         else:
             _init_states = self._init_states
-        # fill up with zeros and expand where necessary
         assert(self.numstates == len(_init_states))
+        device = (self._zero.type(), self._zero.get_device() if self._zero.is_cuda else -1)
+        # fill up with zeros and expand where necessary
+        ret = []
         for i in range(len(_init_states)):
+            key = (i, arg == 0) + device
+            cached = self._init_states_cache[key] if key in self._init_states_cache else None   # (batch size, state)
             statespec = self.state_spec[i]
             initstate = _init_states[i]
             if initstate is None:
-                state_0 = q.var(torch.zeros(statespec)).cuda(next(self.parameters()).is_cuda).v
-                _init_states[i] = state_0
-                initstate = state_0
-            if initstate.dim() == 2:        # init state set differently for different batches
+                if cached is None or cached[0] < arg:
+                    initstate = self._zero.new(*((statespec,) if arg == 0 else (arg, statespec))).zero_()
+                    cached = (arg, q.var(initstate).v)
+                    self._init_states_cache[key] = cached
+                initstate = cached[1] if cached[0] == arg else cached[1][:arg]
+            elif initstate.dim() == 2:        # init state set differently for different batches
                 if arg > initstate.size(0):
                     raise Exception("asked for a bigger batch size than init states")
-                elif arg == initstate.size(0):
-                    pass
-                else:
-                    if arg == 0:
-                        return initstate[0]
-                    else:
-                        return initstate[:arg]
-            elif initstate.dim() == 1 and arg > 0:
-                _init_states[i] = initstate.unsqueeze(0).expand(arg, initstate.size(-1))
+                elif 0 < arg < initstate.size(0):
+                    initstate = initstate[:arg]
+            elif initstate.dim() == 1:
+                if arg > 0 and cached is not None and cached[0] == arg:
+                    initstate = cached[1]
+                elif arg > 0:
+                    initstate = initstate.unsqueeze(0).expand(arg, initstate.size(-1))
+                    if not initstate.requires_grad:     # don't keep graphs of learned init states around
+                        self._init_states_cache[key] = (arg, initstate)
             else:
                 raise Exception("initial states set to wrong dimensional values. Must be 1D (will be repeated) or 2D.")
-        return _init_states
+            ret.append(initstate)
+        return ret
 
     def set_init_states(self, *states):
         """
@@ -209,6 +267,7 @@ class RNUBase(RecStateful):
         :return:
         """
         assert(len(states) <= self.numstates)
+        self._init_states_cache = {}
         self._init_states = []
         i = 0
         for statespec in self.state_spec:
@@ -219,10 +278,23 @@ class RNUBase(RecStateful):
                 self._init_states.append(None)
             i += 1
 
-    def forward(self, x_t, t=None, mask_t=None):
+    def precompute_inputs(self, x):
+        """
+        Computes the input-to-gate projections for all timesteps at once.
+        Override in cells that support hoisting the input projections out of the timestep loop.
+        :param x:   (batsize, seqlen, indim)
+        :return:    (x, xproj) where x has input dropout applied and xproj is (batsize, seqlen, projdim),
+                    or None if not supported
+        """
+        return None
+
+    def forward(self, x_t, t=None, mask_t=None, xproj_t=None):
         batsize = x_t.size(0)
         states = self.get_states(batsize)
-        ret = self._forward(x_t, *states, t=t)
+        if xproj_t is not None:     # input projection precomputed by .precompute_inputs()
+            ret = self._forward(x_t, *states, t=t, xproj_t=xproj_t)
+        else:
+            ret = self._forward(x_t, *states, t=t)
         y_t = ret[0]
         newstates = ret[1:]
         st = []
@@ -311,10 +383,17 @@ class _GRUCell(nn.Module):      # TODO: test rbn
         self.gates.reset_parameters()
         self.main_gate.reset_parameters()
 
-    def forward(self, x_t, h_tm1, t=None):
-        update_gate, reset_gate = self.gates(x_t, h_tm1, t=t)
+    def precompute(self, x):
+        return torch.cat([self.gates.precompute(x), self.main_gate.precompute(x)], 1)
+
+    def forward(self, x_t, h_tm1, t=None, xproj_t=None):
+        gates_xproj, main_xproj = None, None
+        if xproj_t is not None:
+            gates_xproj = xproj_t[:, :self.gates.outdim]
+            main_xproj = xproj_t[:, self.gates.outdim:]
+        update_gate, reset_gate = self.gates(x_t, h_tm1, t=t, xproj=gates_xproj)
         canh = torch.mul(h_tm1, reset_gate)
-        canh = self.main_gate(x_t, canh, t=t)
+        canh = self.main_gate(x_t, canh, t=t, xproj=main_xproj)
         canh = self.activation_fn(canh)
         h_t = (1 - update_gate) * h_tm1 + update_gate * canh
         return h_t
@@ -322,6 +401,7 @@ class _GRUCell(nn.Module):      # TODO: test rbn
 
 class GRUCell(RNUBase):
     debug = False
+    _rollout_attrs = ("shared_dropout_reccer", "shared_zoneouter")
 
     def __init__(self, indim, outdim, use_bias=True,
                  dropout_in=None, dropout_rec=None, zoneout=None,
@@ -369,10 +449,43 @@ class GRUCell(RNUBase):
 
     def apply_nncell(self, *x, **kw):
         t = kw["t"] if "t" in kw else None
+        xproj_t = kw["xproj_t"] if "xproj_t" in kw else None
         if self.use_cudnn_cell:
+            if xproj_t is not None:
+                return self._hoisted_nncell(xproj_t, *x[1:])
             return self.nncell(*x)
         else:
-            return self.nncell(*x, t=t)
+            return self.nncell(*x, t=t, xproj_t=xproj_t)
+
+    @property
+    def _hoistable(self):
+        return self.use_cudnn_cell or not self.recbn
+
+    def precompute_inputs(self, x):
+        if not self._hoistable:
+            return None
+        if self.dropout_in:
+            x = self.dropout_in(x)
+        x = x.contiguous()
+        batsize, seqlen = x.size(0), x.size(1)
+        flatx = x.view(batsize * seqlen, x.size(2))
+        if self.use_cudnn_cell:
+            xproj = F.linear(flatx, self.nncell.weight_ih, self.nncell.bias_ih)
+        else:
+            xproj = self.nncell.precompute(flatx)
+        xproj = xproj.view(batsize, seqlen, xproj.size(1))
+        return x, xproj
+
+    def _hoisted_nncell(self, xproj_t, h_tm1):
+        """ step of nn.GRUCell given precomputed input projection """
+        hproj = F.linear(h_tm1, self.nncell.weight_hh, self.nncell.bias_hh)
+        x_r, x_z, x_n = xproj_t.chunk(3, 1)
+        h_r, h_z, h_n = hproj.chunk(3, 1)
+        reset_gate = torch.sigmoid(x_r + h_r)
+        update_gate = torch.sigmoid(x_z + h_z)
+        canh = torch.tanh(x_n + reset_gate * h_n)
+        h_t = (1 - update_gate) * canh + update_gate * h_tm1
+        return h_t
 
     def reset_parameters(self):
         # self.gates.reset_parameters()
@@ -390,8 +503,8 @@ class GRUCell(RNUBase):
     def state_spec(self):
         return self.outdim,
 
-    def _forward(self, x_t, h_tm1, t=None):      # (batsize, indim), (batsize, outdim)
-        if self.dropout_in:
+    def _forward(self, x_t, h_tm1, t=None, xproj_t=None):      # (batsize, indim), (batsize, outdim)
+        if self.dropout_in and xproj_t is None:     # if hoisted, dropout already applied in .precompute_inputs()
             x_t = self.dropout_in(x_t)
         if self.dropout_rec:
             h_tm1 = self.dropout_rec(h_tm1)
@@ -399,20 +512,20 @@ class GRUCell(RNUBase):
             if self.shared_dropout_reccer is None:
                 ones = q.var(torch.ones(h_tm1.size())).cuda(crit=h_tm1).v
                 self.shared_dropout_reccer = [self.shared_dropout_rec(ones)]
-            h_tm1 = torch.mul(h_tm1, self.shared_dropout_reccer[0])
+            h_tm1 = torch.mul(h_tm1, self.shared_dropout_reccer[0][:h_tm1.size(0)])
 
-        h_t = self.apply_nncell(x_t, h_tm1, t=t)
+        h_t = self.apply_nncell(x_t, h_tm1, t=t, xproj_t=xproj_t)
 
         if self.zoneout:
-            if self.zoner is None:
+            if self.zoner is None or self.zoner.size(0) < h_t.size(0):
                 self.zoner = q.var(torch.ones(h_t.size())).cuda(crit=h_t).v
-            zoner = self.zoneout(self.zoner)
+            zoner = self.zoneout(self.zoner[:h_t.size(0)])
             h_t = torch.mul(1 - zoner, h_tm1) + torch.mul(zoner, h_t)
         if self.shared_zoneout:
             if self.shared_zoneouter is None:
                 ones = q.var(torch.ones(h_t.size())).cuda(crit=h_t).v
                 self.shared_zoneouter = [self.shared_zoneout(ones)]
-            h_t = torch.mul(1 - self.shared_zoneouter[0], h_tm1) + torch.mul(self.shared_zoneouter[0], h_t)
+            h_t = torch.mul(1 - self.shared_zoneouter[0][:h_t.size(0)], h_tm1) + torch.mul(self.shared_zoneouter[0][:h_t.size(0)], h_t)
         return h_t, h_t
 
 
@@ -442,9 +555,12 @@ class _LSTMCell(nn.Module):
     def reset_parameters(self):
         self.gates.reset_parameters()
 
-    def forward(self, x_t, states, t=None):
+    def precompute(self, x):
+        return self.gates.precompute(x)
+
+    def forward(self, x_t, states, t=None, xproj_t=None):
         y_tm1, c_tm1 = states
-        forget_gate, input_gate, output_gate, main_gate = self.gates(x_t, y_tm1)
+        forget_gate, input_gate, output_gate, main_gate = self.gates(x_t, y_tm1, xproj=xproj_t)
         c_t = torch.mul(c_tm1, forget_gate) + torch.mul(main_gate, input_gate)
         c_t = self.activation_fn(c_t)
         y_t = torch.mul(c_t, output_gate)
@@ -459,6 +575,19 @@ class LSTMCell(GRUCell):
             self.nncell = _LSTMCell(self.indim, self.outdim, bias=self.use_bias,
                                     gate_activation=self.gate_activation, activation=self.activation)
 
+    @property
+    def _hoistable(self):
+        return True
+
+    def _hoisted_nncell(self, xproj_t, states):
+        """ step of nn.LSTMCell given precomputed input projection """
+        y_tm1, c_tm1 = states
+        gates = xproj_t + F.linear(y_tm1, self.nncell.weight_hh, self.nncell.bias_hh)
+        input_gate, forget_gate, main_gate, output_gate = gates.chunk(4, 1)
+        c_t = torch.sigmoid(forget_gate) * c_tm1 + torch.sigmoid(input_gate) * torch.tanh(main_gate)
+        y_t = torch.sigmoid(output_gate) * torch.tanh(c_t)
+        return y_t, c_t
+
     @property
     def y_0(self):
         return self.get_init_states(0)[1]
@@ -471,9 +600,9 @@ class LSTMCell(GRUCell):
     def state_spec(self):
         return self.outdim, self.outdim
 
-    def _forward(self, x_t, c_tm1, y_tm1, t=None):
+    def _forward(self, x_t, c_tm1, y_tm1, t=None, xproj_t=None):
         # region apply dropouts
-        if self.dropout_in:
+        if self.dropout_in and xproj_t is None:
             x_t = self.dropout_in(x_t)
         if self.dropout_rec:
             y_tm1 = self.dropout_rec(y_tm1)
@@ -482,22 +611,22 @@ class LSTMCell(GRUCell):
             if self.shared_dropout_reccer is None:
                 ones = q.var(torch.ones(c_tm1.size())).cuda(crit=c_tm1).v
                 self.shared_dropout_reccer = [self.shared_dropout_rec(ones), self.shared_dropout_rec(ones)]
-            y_tm1 = torch.mul(c_tm1, self.shared_dropout_reccer[0])
-            c_tm1 = torch.mul(y_tm1, self.shared_dropout_reccer[1])
+            y_tm1 = torch.mul(c_tm1, self.shared_dropout_reccer[0][:c_tm1.size(0)])
+            c_tm1 = torch.mul(y_tm1, self.shared_dropout_reccer[1][:c_tm1.size(0)])
         # endregion
-        y_t, c_t = self.apply_nncell(x_t, (y_tm1, c_tm1), t=t)
+        y_t, c_t = self.apply_nncell(x_t, (y_tm1, c_tm1), t=t, xproj_t=xproj_t)
         if self.zoneout:
-            if self.zoner is None:
+            if self.zoner is None or self.zoner.size(0) < c_t.size(0):
                 self.zoner = q.var(torch.ones(c_t.size())).cuda(crit=c_t).v
-            zoner = self.zoneout(self.zoner)
+            zoner = self.zoneout(self.zoner[:c_t.size(0)])
             c_t = torch.mul(1 - zoner, c_tm1) + torch.mul(zoner, c_t)
             y_t = torch.mul(1 - zoner, y_tm1) + torch.mul(zoner, y_t)
         if self.shared_zoneout:
             if self.shared_zoneouter is None:
                 ones = q.var(torch.ones(c_t.size())).cuda(crit=c_t).v
                 self.shared_zoneouter = [self.shared_zoneout(ones), self.shared_zoneout(ones)]
-            c_t = torch.mul(1 - self.shared_zoneouter[0], c_tm1) + torch.mul(self.shared_zoneouter[0], c_t)
-            y_t = torch.mul(1 - self.shared_zoneouter[1], y_tm1) + torch.mul(self.shared_zoneouter[1], y_t)
+            c_t = torch.mul(1 - self.shared_zoneouter[0][:c_t.size(0)], c_tm1) + torch.mul(self.shared_zoneouter[0][:c_t.size(0)], c_t)
+            y_t = torch.mul(1 - self.shared_zoneouter[1][:c_t.size(0)], y_tm1) + torch.mul(self.shared_zoneouter[1][:c_t.size(0)], y_t)
         return y_t, c_t, y_t
 
 
@@ -520,8 +649,11 @@ class _SRUCell(nn.Module):
     def reset_parameters(self):
         self.gates.reset_parameters()
 
-    def forward(self, x_t, c_tm1, t=None):
-        forget_gate, reset_gate, x_hat = self.gates(x_t, t=t)
+    def precompute(self, x):
+        return self.gates.precompute(x)
+
+    def forward(self, x_t, c_tm1, t=None, xproj_t=None):
+        forget_gate, reset_gate, x_hat = self.gates(x_t, t=t, xproj=xproj_t)
         c_t = forget_gate * c_tm1 + (1 - forget_gate) * x_hat
         y_t = reset_gate * self.activation_fn(c_t) + (1 - reset_gate) * x_t
         return y_t, c_t
@@ -545,7 +677,7 @@ class SRUCell(GRUCell):
 
     def setcell(self):
         if self.use_cudnn_cell:
-            raise NotImplemented("TODO: plug in cuda implementation from paper")
+            raise NotImplementedError("TODO: plug in cuda implementation from paper. Use SRULayer for fast unrolling.")
         else:
             self.nncell = _SRUCell(self.indim, bias=self.use_bias,
                                     gate_activation=self.gate_activation, activation=self.activation)
@@ -554,8 +686,8 @@ class SRUCell(GRUCell):
     def state_spec(self):
         return self.outdim,
 
-    def _forward(self, x_t, c_tm1, t=None):
-        if self.dropout_in:
+    def _forward(self, x_t, c_tm1, t=None, xproj_t=None):
+        if self.dropout_in and xproj_t is None:
             x_t = self.dropout_in(x_t)
         if self.dropout_rec:
             c_tm1 = self.dropout_rec(c_tm1)
@@ -563,20 +695,20 @@ class SRUCell(GRUCell):
             if self.shared_dropout_reccer is None:
                 ones = q.var(torch.ones(c_tm1.size())).cuda(crit=c_tm1).v
                 self.shared_dropout_reccer = [self.shared_dropout_rec(ones)]
-            c_tm1 = torch.mul(c_tm1, self.shared_dropout_reccer[0])
+            c_tm1 = torch.mul(c_tm1, self.shared_dropout_reccer[0][:c_tm1.size(0)])
 
-        y_t, c_t = self.apply_nncell(x_t, c_tm1, t=t)
+        y_t, c_t = self.apply_nncell(x_t, c_tm1, t=t, xproj_t=xproj_t)
 
         if self.zoneout:
-            if self.zoner is None:
+            if self.zoner is None or self.zoner.size(0) < c_t.size(0):
                 self.zoner = q.var(torch.ones(c_t.size())).cuda(crit=c_t).v
-            zoner = self.zoneout(self.zoner)
+            zoner = self.zoneout(self.zoner[:c_t.size(0)])
             c_t = torch.mul(1 - zoner, c_tm1) + torch.mul(zoner, c_t)
         if self.shared_zoneout:
             if self.shared_zoneouter is None:
                 ones = q.var(torch.ones(c_t.size())).cuda(crit=c_t).v
                 self.shared_zoneouter = [self.shared_zoneout(ones)]
-            c_t = torch.mul(1 - self.shared_zoneouter[0], c_tm1) + torch.mul(self.shared_zoneouter[0], c_t)
+            c_t = torch.mul(1 - self.shared_zoneouter[0][:c_t.size(0)], c_tm1) + torch.mul(self.shared_zoneouter[0][:c_t.size(0)], c_t)
         return y_t, c_t
 
 # endregion
@@ -585,6 +717,90 @@ class Recurrent(object):
     pass
 
 
+def _checkpointed(run, states, inputs, rnus):
+    """
+    Runs a segment of timesteps with activation checkpointing:
+    only the segment's inputs and outputs are kept, intermediates are recomputed during backward.
+    Random numbers are the same during recomputation (see torch.utils.checkpoint)
+    and per-rollout attributes of the given RNUBase modules (shared dropout masks) are restored before,
+    so recomputation is identical to the original run.
+    :param run:     function(states, inputs) -> (outputs, new states), lists of tensors (states may contain None)
+    :param states:  list of recurrent states at the start of the segment (may contain None)
+    :param inputs:  list of tensors used in the segment (passed explicitly so that gradients flow to them)
+    :param rnus:    RNUBase modules used in the segment
+    :return:        (outputs, new states)
+    """
+    if _torch_checkpoint is None:
+        raise q.SumTingWongException("activation checkpointing needs torch.utils.checkpoint (pytorch >= 0.4)")
+    rollout = [(rnu, [(attr, getattr(rnu, attr, None)) for attr in rnu._rollout_attrs]) for rnu in rnus]
+    stateidxs = [i for i, state in enumerate(states) if state is not None]
+    spec = {}
+
+    def f(dummy, *args):
+        for rnu, attrs in rollout:
+            for attr, value in attrs:
+                setattr(rnu, attr, value)
+        _states = list(states)
+        for j, i in enumerate(stateidxs):
+            _states[i] = args[j]
+        outputs, newstates = run(_states, list(args[len(stateidxs):]))
+        spec["numouts"] = len(outputs)
+        spec["newstates"] = [state is not None for state in newstates]
+        return tuple(outputs) + tuple([state for state in newstates if state is not None])
+
+    dummy = q.var(torch.zeros(1), requires_grad=True).v     # makes sure segment gets gradients if no input requires grad
+    ret = _torch_checkpoint(f, dummy, *([states[i] for i in stateidxs] + list(inputs)))
+    if not q.issequence(ret):
+        ret = (ret,)
+    outputs = list(ret[:spec["numouts"]])
+    newstates = list(ret[spec["numouts"]:])
+    newstates = [newstates.pop(0) if notnone else None for notnone in spec["newstates"]]
+    return outputs, newstates
+
+
+class _TimestepOutputs(object):
+    """
+    Collects outputs of the timesteps of an unrolling.
+    By default, keeps a list and stacks at the end.
+    If preallocate=True, writes every timestep's outputs into output tensors allocated at the first timestep,
+    so peak memory holds only one copy of the outputs.
+    If a consumer is given, calls consumer(t, *y_t) for every timestep instead and keeps nothing.
+    """
+    def __init__(self, seqlen, preallocate=False, consumer=None):
+        self.seqlen, self.preallocate, self.consumer = seqlen, preallocate, consumer
+        self._list = []
+        self._out = None
+
+    def add(self, t, *y_t):
+        if self.consumer is not None:
+            self.consumer(t, *y_t)
+        elif self.preallocate:
+            if self._out is None:
+                self._out = []
+                for y_t_e in y_t:
+                    out_e = y_t_e.data.new(y_t_e.size(0), self.seqlen, *y_t_e.size()[1:]).zero_()
+                    self._out.append(Variable(out_e))
+            for out_e, y_t_e in zip(self._out, y_t):
+                out_e[:, t] = y_t_e
+        else:
+            self._list.append((t, y_t))
+
+    def get(self):
+        """ :return: tuple of (batsize, seqlen, ...) outputs or None if given to consumer """
+        if self.consumer is not None:
+            return None
+        if self.preallocate:
+            return tuple(self._out) if self._out is not None else None
+        if len(self._list) == 0:
+            return None
+        self._list.sort(key=lambda x: x[0])
+        ret = tuple()
+        for i in range(len(self._list[0][1])):
+            ret += (torch.stack([y_t[i] for _, y_t in self._list], 1),)
+        self._list = []
+        return ret
+
+
 class RNNLayer(nn.Module, Recurrent):
     """
     Unrolling an RNN cell over timesteps of a sequence
@@ -595,6 +811,92 @@ class RNNLayer(nn.Module, Recurrent):
         self._return_final = False
         self._return_all = True
         self._return_mask = False
+        self._hoist_inputs = False
+        self._early_exit = True
+        self._stateful = False
+        self._detach_states = False
+        self._preallocate_output = False
+        self._output_consumer = None
+        self._checkpoint_every = None
+        self._layerwise = True
+        self._layerwise_layers = []     # per-layer unrollers for layer-wise unrolling (not registered as submodules)
+
+    def layerwise(self, truth=True):
+        """ If the cell is a RecStack of only RNU cells (e.g. GRUCell, LSTMCell), unroll it layer by layer,
+            every layer over the whole sequence with hoisted input projections, instead of timestep by timestep (default).
+            Other stacks (e.g. with argmaps or non-recurrent modules) are always unrolled timestep by timestep. """
+        self._layerwise = truth
+        return self
+
+    @property
+    def _layerwise_cells(self):
+        if not isinstance(self.cell, RecStack):
+            return None
+        cells = list(self.cell.layers)
+        for cell in cells:
+            if not isinstance(cell, RNUBase) or isinstance(cell, Recurrent):
+                return None
+        return cells if len(cells) > 0 else None
+
+    def checkpoint(self, every=None):
+        """ Activation checkpointing during training: only keep states every `every` timesteps
+            and recompute the timesteps in between during backward,
+            so memory for intermediates grows with seqlen/every instead of seqlen.
+            Results are identical (incl. dropouts and zoneout). Disables early exit. None to switch off. """
+        self._checkpoint_every = every
+        return self
+
+    def preallocate_output(self, truth=True):
+        """ Write every timestep's output into a preallocated (batsize, seqlen, outdim) output
+            instead of stacking a list of outputs at the end (only one copy of the outputs at peak).
+            Unrolls timestep by timestep (disables early exit). """
+        self._preallocate_output = truth
+        return self
+
+    def output_to(self, consumer):
+        """ Stream outputs to consumer, called as consumer(t, y_t) for every timestep,
+            instead of returning all outputs (return_all is ignored). Disables early exit. """
+        self._output_consumer = consumer
+        return self
+
+    def stateful(self, truth=True, detach=False):
+        """ Streaming mode: keep the cell's states between calls to .forward(),
+            so a long sequence can be fed chunk by chunk.
+            Streams are restarted by .reset_state() or by passing init_states to .forward().
+            :param detach:  if True, states carried over from the previous call are detached from the graph
+                            (truncated backpropagation through time, one chunk at a time) """
+        self._stateful = truth
+        self._detach_states = detach
+        return self
+
+    def reset_state(self):
+        self.cell.reset_state()
+
+    def set_init_states(self, *states):
+        self.cell.set_init_states(*states)
+
+    def get_states(self, batsize):
+        """ exports current states of the cell (as a tuple of (batsize, dim) tensors, bottom layers first) """
+        return tuple(self.cell.get_states(batsize))
+
+    def set_states(self, *states):
+        """ imports states (e.g. previously returned by .get_states()) to continue from in stateful mode """
+        self.cell.set_states(*states)
+
+    def detach_states(self):
+        self.cell.detach_states()
+
+    def early_exit(self, truth=True):
+        """ When a mask is given, only run the cell on sequences that haven't finished yet (see ._unroll_active()).
+            On by default. Disable to run the cell on all sequences at every timestep and blend using the mask. """
+        self._early_exit = truth
+        return self
+
+    def hoist_inputs(self, truth=True):
+        """ Compute input-to-gate projections for all timesteps in one matmul before unrolling.
+            Only has effect for cells that support it (see RNUBase.precompute_inputs()). """
+        self._hoist_inputs = truth
+        return self
 
     def return_all(self, truth=True):
         if truth == "only":
@@ -620,34 +922,191 @@ class RNNLayer(nn.Module, Recurrent):
             if not q.issequence(init_states):
                 init_states = (init_states,)
             self.cell.set_init_states(*init_states)
-        self.cell.reset_state()
+            self.cell.reset_state()
+        elif not self._stateful:
+            self.cell.reset_state()
+        elif self._detach_states:
+            self.cell.detach_states()
         mask = mask if mask is not None else x.mask if hasattr(x, "mask") else None
-        y_list = []
-        y_tm1 = None
+        layerwise_cells = self._layerwise_cells if self._layerwise else None
+        if layerwise_cells is not None:
+            y_t, y = self._unroll_layerwise(layerwise_cells, x, mask=mask, reverse=reverse)
+            return self._format_output(y_t, y, mask)
+        xproj = None
+        if self._hoist_inputs and isinstance(self.cell, RNUBase):
+            hoisted = self.cell.precompute_inputs(x)
+            if hoisted is not None:
+                x, xproj = hoisted
+        collector = _TimestepOutputs(x.size(1), preallocate=self._preallocate_output,
+                                     consumer=self._output_consumer)
+        checkpointing = self._checkpoint_every is not None and self.training
+        if mask is not None and self._early_exit and not self._stateful and not checkpointing \
+                and not self._preallocate_output and self._output_consumer is None:    # sorting would mix up shared dropouts between calls
+            unrolled = self._unroll_active(x, mask, xproj=xproj, reverse=reverse)
+            if unrolled is not None:
+                y_t, y = unrolled
+                return self._format_output(y_t, y, mask)
+        timesteps = list(range(x.size(1)))
+        if reverse:
+            timesteps.reverse()
+        collect = self._return_all or self._output_consumer is not None
         y_t = None
-        i = x.size(1)
-        while i > 0:
-            t = i-1 if reverse else x.size(1) - i
-            mask_t = mask[:, t].unsqueeze(1) if mask is not None else None
-            x_t = x[:, t]
-            cellout = self.cell(x_t, mask_t=mask_t, t=t)
-            y_t = cellout
-            # mask
-            # if mask_t is not None:  # moved to cells (recBN is affected here)
-            #     if y_tm1 is None:
-            #         y_tm1 = q.var(torch.zeros(y_t.size())).cuda(crit=y_t).v
-            #         if x.is_cuda: y_tm1 = y_tm1.cuda()
-            #     y_t = y_t * mask_t + y_tm1 * (1 - mask_t)
-            #     y_tm1 = y_t
-            if self._return_all:
-                y_list.append(y_t)
-            i -= 1
+        if checkpointing:
+            for i in range(0, len(timesteps), self._checkpoint_every):
+                segment = timesteps[i:i+self._checkpoint_every]
+                y_ts = self._unroll_checkpointed(segment, x, mask=mask, xproj=xproj)
+                y_t = y_ts[-1]
+                if collect:
+                    for t, y_t_e in zip(segment, y_ts):
+                        collector.add(t, y_t_e)
+        else:
+            for t in timesteps:
+                y_t = self._step(t, x, mask=mask, xproj=xproj)
+                if collect:
+                    collector.add(t, y_t)
+        y = collector.get()
+        y = y[0] if y is not None else None
+        return self._format_output(y_t, y, mask)
+
+    def _unroll_layerwise(self, cells, x, mask=None, reverse=False):
+        """ unrolls every cell of the stack over the whole sequence, bottom cell first
+            :return: (final output, all outputs or None) """
+        if [layer.cell for layer in self._layerwise_layers] != cells:
+            self._layerwise_layers = [RNNLayer(cell) for cell in cells]
+        y = x
+        y_t = None
+        for i, layer in enumerate(self._layerwise_layers):
+            top = i == len(self._layerwise_layers) - 1
+            layer.training = self.training
+            layer.return_final(top).return_all(not top or self._return_all).hoist_inputs()\
+                .early_exit(self._early_exit).stateful(self._stateful).checkpoint(self._checkpoint_every)\
+                .preallocate_output(top and self._preallocate_output)\
+                .output_to(self._output_consumer if top else None)
+            ret = layer(y, mask=mask, reverse=reverse)
+            if top:
+                y_t, y = ret if q.issequence(ret) else (ret, None)
+            else:
+                y = ret
+        return y_t, y
+
+    def _step(self, t, x, mask=None, xproj=None):
+        mask_t = mask[:, t].unsqueeze(1) if mask is not None else None
+        x_t = x[:, t]
+        if xproj is not None:
+            return self.cell(x_t, mask_t=mask_t, t=t, xproj_t=xproj[:, t])
+        else:
+            return self.cell(x_t, mask_t=mask_t, t=t)
+
+    def _unroll_checkpointed(self, segment, x, mask=None, xproj=None):
+        """ runs given timesteps as one checkpointed segment, returns list of outputs """
+        batsize = x.size(0)
+        rnus = [module for module in self.cell.modules() if isinstance(module, RNUBase)]
+        states = list(self.cell.get_states(batsize))
+        numstates = len(states)
+        states += [rnu._y_tm1 for rnu in rnus]      # outputs carried over masked timesteps
+
+        def run(states, inputs):
+            # recomputation during backward must not change the cell's current states
+            prevstates = list(self.cell.get_states(batsize)) + [rnu._y_tm1 for rnu in rnus]
+            self.cell.set_states(*states[:numstates])
+            for rnu, y_tm1 in zip(rnus, states[numstates:]):
+                rnu._y_tm1 = y_tm1
+            _x = inputs.pop(0)
+            _mask = inputs.pop(0) if mask is not None else None
+            _xproj = inputs.pop(0) if xproj is not None else None
+            outputs = [self._step(t, _x, mask=_mask, xproj=_xproj) for t in segment]
+            newstates = list(self.cell.get_states(batsize)) + [rnu._y_tm1 for rnu in rnus]
+            self.cell.set_states(*prevstates[:numstates])
+            for rnu, y_tm1 in zip(rnus, prevstates[numstates:]):
+                rnu._y_tm1 = y_tm1
+            return outputs, newstates
+
+        inputs = [e for e in [x, mask, xproj] if e is not None]
+        outputs, newstates = _checkpointed(run, states, inputs, rnus)
+        self.cell.set_states(*newstates[:numstates])
+        for rnu, y_tm1 in zip(rnus, newstates[numstates:]):
+            rnu._y_tm1 = y_tm1
+        return outputs
+
+    def _unroll_active(self, x, mask, xproj=None, reverse=False):
+        """
+        Length-aware unrolling: sequences are sorted by length and at every timestep,
+        the cell is only run on the sequences that haven't finished yet (like packed sequences),
+        so compute scales with the number of unmasked tokens rather than batsize * seqlen.
+        Outputs are scattered back in one go at the end.
+        Same results as the masked unrolling (incl. carried-forward outputs and final states).
+        Only for right-padded masks (ones followed by zeros). Returns None if not applicable.
+        :return:    (final output (batsize, outdim), all outputs (batsize, seqlen, outdim) or None)
+        """
+        batsize, seqlen = x.size(0), x.size(1)
+        mask_np = mask.data.cpu().numpy() != 0
+        lens = mask_np.sum(1)
+        maxlen = lens.max() if batsize > 0 else 0
+        if maxlen == 0 or not (mask_np == (np.arange(seqlen)[None, :] < lens[:, None])).all():
+            return None
+        for module in self.cell.modules():     # batch stats would depend on which sequences are active
+            if getattr(module, "recbn", None):
+                return None
+        if reverse:     # left-align reversed sequences, then unroll forward
+            x = _reverse_seq(x, mask=mask)
+            xproj = _reverse_seq(xproj, mask=mask) if xproj is not None else None
+        sortidxs = np.argsort(-lens, kind="mergesort")
+        positions = np.argsort(sortidxs)        # position of every example in sorted batch
+        sortedlens = lens[sortidxs]
+        sorter = q.var(sortidxs).cuda(x).v
+        x = torch.index_select(x, 0, sorter)
+        xproj = torch.index_select(xproj, 0, sorter) if xproj is not None else None
+        states = [torch.index_select(state, 0, sorter)
+                  for state in self.cell.get_init_states(batsize)]
+        batch_sizes = [int((sortedlens > t).sum()) for t in range(maxlen)]
+        offsets = np.cumsum([0] + batch_sizes)
+
+        finished = []       # states of sequences that stopped being active, last finished first
+        active = batch_sizes[0]
+        if active < batsize:
+            finished.append([state[active:] for state in states])
+        self.cell.set_states(*[state[:active] for state in states])
+        y_list = []
+        for t in range(maxlen):
+            if batch_sizes[t] < active:
+                states = self.cell.get_states(active)
+                finished.append([state[batch_sizes[t]:] for state in states])
+                active = batch_sizes[t]
+                self.cell.set_states(*[state[:active] for state in states])
+            x_t = x[:active, t]
+            if xproj is not None:
+                y_t = self.cell(x_t, t=t, xproj_t=xproj[:active, t])
+            else:
+                y_t = self.cell(x_t, t=t)
+            y_list.append(y_t)
+        states = self.cell.get_states(active)
+        finished.reverse()
+        states = [torch.cat([state] + [f[i] for f in finished], 0) if len(finished) > 0 else state
+                  for i, state in enumerate(states)]
+        unsorter = q.var(positions).cuda(x).v
+        self.cell.set_states(*[torch.index_select(state, 0, unsorter) for state in states])
+
+        # scatter outputs back: flat packed outputs + a zero row for padding positions
+        flat_y = torch.cat(y_list, 0)
+        flat_y = torch.cat([flat_y, q.var(torch.zeros(1, flat_y.size(1))).cuda(flat_y).v], 0)
+        last = np.where(lens > 0, offsets[np.maximum(lens - 1, 0)] + positions, offsets[-1])
+        y_t = torch.index_select(flat_y, 0, q.var(last).cuda(x).v)
+        y = None
+        if self._return_all:
+            timesteps = np.arange(seqlen)[None, :]
+            steps = (lens[:, None] - 1 - timesteps) if reverse else timesteps
+            idx = offsets[np.clip(steps, 0, maxlen - 1)] + positions[:, None]
+            idx = np.where(timesteps < lens[:, None], idx,
+                           last[:, None] if not reverse else offsets[-1])
+            y = torch.index_select(flat_y, 0, q.var(idx.reshape(-1)).cuda(x).v)
+            y = y.view(batsize, seqlen, flat_y.size(1))
+        return y_t, y
+
+    def _format_output(self, y_t, y, mask):
         ret = tuple()
         if self._return_final:
             ret += (y_t,)
-        if self._return_all:
-            if reverse: y_list.reverse()
-            y = torch.stack(y_list, 1)
+        if self._return_all and y is not None:
             ret += (y,)
         if self._return_mask:
             ret += (mask,)
@@ -671,6 +1130,50 @@ def _reverse_seq(x, mask=None):
     return retx
 
 
+def _select_states(states, idx, dim=1):
+    """ index_select() on (tuples of) states of nn.RNN's, e.g. for sorting and unsorting batches """
+    if q.issequence(states):
+        return tuple([_select_states(state, idx, dim=dim) for state in states])
+    return torch.index_select(states, dim, idx)
+
+
+def _run_nnlayer(nnlayer, x, h_0, mask=None):
+    """ Runs nn.GRU/nn.LSTM (batch_first) on x.
+        If mask is given, runs on packed sequence: no compute on padding, correct final states, zero outputs on padding.
+        :return: (outputs (batsize, seqlen, dim), final states) """
+    if mask is None:
+        return nnlayer(x, h_0)
+    packedx, unsorter = q.seq_pack(x, mask)
+    _, sorter = torch.sort(unsorter, 0)
+    packedy, s_t = nnlayer(packedx, _select_states(h_0, sorter))
+    s_t = _select_states(s_t, unsorter)
+    y, _ = q.seq_unpack(packedy, unsorter)
+    if y.size(1) < x.size(1):       # pad back to original seqlen
+        y_pad = q.var(torch.zeros(y.size(0), x.size(1) - y.size(1), y.size(2))).cuda(y).v
+        y = torch.cat([y, y_pad], 1)
+    return y, s_t
+
+
+def _linear_scan(a, b, h_0=None):
+    """
+    Evaluates the elementwise linear recurrence h_t = a_t * h_tm1 + b_t over all timesteps
+    using a parallel (doubling) prefix scan: log2(seqlen) vectorized steps instead of a loop over time.
+    :param a:   (batsize, seqlen, dim) multiplicative coefficients
+    :param b:   (batsize, seqlen, dim) additive terms
+    :param h_0: (batsize, dim) initial state or None (zeros)
+    :return:    (batsize, seqlen, dim) all states h_1 ... h_T
+    """
+    if h_0 is not None:     # fold initial state into first timestep
+        b = torch.cat([(a[:, 0] * h_0 + b[:, 0]).unsqueeze(1), b[:, 1:]], 1)
+    seqlen = a.size(1)
+    d = 1
+    while d < seqlen:
+        b = torch.cat([b[:, :d], a[:, d:] * b[:, :-d] + b[:, d:]], 1)
+        a = torch.cat([a[:, :d], a[:, d:] * a[:, :-d]], 1)
+        d *= 2
+    return b
+
+
 class GRULayer(RNUBase, Recurrent):
     def __init__(self, indim, outdim, use_bias=True, reverse=False):
         super(GRULayer, self).__init__()
@@ -716,11 +1219,8 @@ class GRULayer(RNUBase, Recurrent):
         h_0 = self._get_init_states(x.size(0))
         if self._reverse:
             x = _reverse_seq(x, mask=mask)
-            if mask is not None:
-                x = x * mask.unsqueeze(2).float()
-        y, s_t = self.nnlayer(x, h_0)
-        self.set_states(s_t)        # DON'T TRUST FINAL STATES WHEN MASK IS NOT NONE
-        #return y
+        y, s_t = _run_nnlayer(self.nnlayer, x, h_0, mask=mask)
+        self.set_states(s_t)
 
         if mask is None:
             y_t = y[:, -1, :]
@@ -738,8 +1238,8 @@ class GRULayer(RNUBase, Recurrent):
         if self._return_all:
             if self._reverse:
                 y = _reverse_seq(y, mask=mask)
-            if mask is not None:
-                y = y * mask.unsqueeze(2).float()
+                if mask is not None:
+                    y = y * mask.unsqueeze(2).float()
             ret += (y,)
         if self._return_mask:
             ret += (mask,)
@@ -794,8 +1294,8 @@ class LSTMLayer(GRULayer):
 
     def _get_init_states(self, arg):
         initstate = super(LSTMLayer, self)._get_init_states(arg)
-        ret = (initstate[:initstate.size(0)/2],
-               initstate[initstate.size(0)/2:])
+        ret = (initstate[:initstate.size(0)//2],
+               initstate[initstate.size(0)//2:])
         return ret
 
     def set_states(self, *states):
@@ -803,6 +1303,129 @@ class LSTMLayer(GRULayer):
         super(LSTMLayer, self).set_states(state)
         
 
+class SRULayer(RNUBase, Recurrent):
+    """
+    SRU unrolled over a whole sequence without a loop over timesteps.
+    All gates are computed for all timesteps in one shot and
+    the elementwise recurrence is evaluated with a parallel scan.
+    Same parameters (see .nncell) and dropout/zoneout/masking semantics as SRUCell.
+    """
+    def __init__(self, dim, use_bias=True,
+                 dropout_in=None, dropout_rec=None, zoneout=None,
+                 shared_dropout_rec=None, shared_zoneout=None,
+                 activation="tanh", gate_activation="sigmoid"):
+        super(SRULayer, self).__init__()
+        self.indim, self.outdim, self.dim, self.use_bias = dim, dim, dim, use_bias
+        self.activation, self.gate_activation = activation, gate_activation
+        self.nncell = _SRUCell(dim, bias=use_bias, gate_activation=gate_activation, activation=activation)
+        self.dropout_in = nn.Dropout(p=dropout_in) if dropout_in else None
+        self.dropout_rec = nn.Dropout(p=dropout_rec) if dropout_rec else None
+        self.zoneout = nn.Dropout(p=zoneout) if zoneout else None
+        self.shared_dropout_rec = nn.Dropout(p=shared_dropout_rec) if shared_dropout_rec else None
+        self.shared_zoneout = nn.Dropout(p=shared_zoneout) if shared_zoneout else None
+        self._return_final = False
+        self._return_all = True
+        self._return_mask = False
+
+    def return_all(self, truth=True):
+        if truth == "only":
+            self._return_final = False
+            truth = True
+        self._return_all = truth
+        return self
+
+    def return_final(self, truth=True):
+        if truth == "only":
+            self._return_all = False
+            truth = True
+        self._return_final = truth
+        return self
+
+    def return_mask(self, truth=True):
+        self._return_mask = truth
+        return self
+
+    def reset_parameters(self):
+        self.nncell.reset_parameters()
+
+    @property
+    def state_spec(self):
+        return self.outdim,
+
+    def forward(self, x, mask=None, init_states=None):     # (batsize, seqlen, dim), (batsize, seqlen)
+        batsize, seqlen, dim = x.size()
+        if init_states is not None:
+            if not q.issequence(init_states):
+                init_states = (init_states,)
+            self.set_init_states(*init_states)
+        self.reset_state()
+        c_0 = self.get_init_states(batsize)[0]
+        mask = mask if mask is not None else x.mask if hasattr(x, "mask") else None
+
+        if self.dropout_in:
+            x = self.dropout_in(x)
+        x = x.contiguous()
+        gates = self.nncell.gates(x.view(batsize * seqlen, dim))    # all gates for all timesteps at once
+        forget_gate, reset_gate, x_hat = [gate.contiguous().view(batsize, seqlen, dim) for gate in gates]
+
+        # dropouts on previous state (c_tm1 --> c_tm1 * recdrop) and zoneouts (c_t --> c_tm1 + zoner * (c_t - c_tm1))
+        ones = None
+        recdrop, zoner = None, None
+        if self.dropout_rec or self.shared_dropout_rec or self.zoneout or self.shared_zoneout:
+            ones = q.var(torch.ones(batsize, seqlen, dim)).cuda(x).v
+        if self.dropout_rec:
+            recdrop = self.dropout_rec(ones)
+        if self.shared_dropout_rec:     # same mask for all timesteps
+            shared_recdrop = self.shared_dropout_rec(ones[:, 0:1])
+            recdrop = shared_recdrop if recdrop is None else recdrop * shared_recdrop
+        if self.zoneout:
+            zoner = self.zoneout(ones)
+        if self.shared_zoneout:
+            shared_zoner = self.shared_zoneout(ones[:, 0:1])
+            zoner = shared_zoner if zoner is None else zoner * shared_zoner
+
+        # c_t = a_t * c_tm1 + b_t
+        a = forget_gate
+        b = (1 - forget_gate) * x_hat
+        if zoner is not None:
+            a = 1 - zoner + zoner * a
+            b = zoner * b
+        if recdrop is not None:
+            a = a * recdrop
+        fmask = mask.float().unsqueeze(2) if mask is not None else None
+        if fmask is not None:
+            a = fmask * a + (1 - fmask)
+            b = fmask * b
+        c = _linear_scan(a, b, c_0)
+
+        # outputs use the (unzoned) new memory computed from previous states
+        c_tm1 = torch.cat([c_0.unsqueeze(1), c[:, :-1]], 1)
+        if recdrop is not None:
+            c_tm1 = c_tm1 * recdrop
+        c_new = forget_gate * c_tm1 + (1 - forget_gate) * x_hat
+        y = reset_gate * self.nncell.activation_fn(c_new) + (1 - reset_gate) * x
+        if fmask is not None:   # masked timesteps repeat previous output (zeros before first)
+            y = _linear_scan((1 - fmask).expand_as(y), y * fmask)
+
+        self.set_states(c[:, -1])
+        y_t = y[:, -1]
+
+        ret = tuple()
+        if self._return_final:
+            ret += (y_t,)
+        if self._return_all:
+            ret += (y,)
+        if self._return_mask:
+            ret += (mask,)
+        if len(ret) == 1:
+            return ret[0]
+        elif len(ret) == 0:
+            print("no output specified")
+            return
+        else:
+            return ret
+
+
 class _BidirRNNLayer(nn.Module, Recurrent):
     """ For creating bidir layers from layer class.
         Initial states must be set on fwd and rev layers individually. TODO
@@ -816,6 +1439,52 @@ class _BidirRNNLayer(nn.Module, Recurrent):
         self._return_all = True
         self._return_mask = False
         self._reverse_net = None
+        self._fused = True
+        # single bidirectional nn.GRU/nn.LSTM running both directions, uses the parameters of layer_fwd and layer_rev
+        # (kept in a list to not register it as a submodule)
+        self._fused_nnlayer = [self.layer_fwd._nn_unit()(indim, outdim, bias=use_bias, batch_first=True,
+                                                         bidirectional=True, num_layers=1)]
+        self._sync_fused_nnlayer()
+
+    def fused(self, truth=True):
+        """ Run both directions in one bidirectional nn.GRU/nn.LSTM (default). Otherwise runs the two layers separately. """
+        self._fused = truth
+        return self
+
+    def _sync_fused_nnlayer(self):
+        fused_nnlayer = self._fused_nnlayer[0]
+        for name, param in self.layer_fwd.nnlayer.named_parameters():
+            setattr(fused_nnlayer, name, param)
+        for name, param in self.layer_rev.nnlayer.named_parameters():
+            setattr(fused_nnlayer, name + "_reverse", param)
+        return fused_nnlayer
+
+    def _forward_fused(self, x, mask=None):
+        self.layer_fwd.reset_state()
+        self.layer_rev.reset_state()
+        h_0_fwd = self.layer_fwd._get_init_states(x.size(0))
+        h_0_rev = self.layer_rev._get_init_states(x.size(0))
+        if q.issequence(h_0_fwd):     # LSTM: (h_0, c_0)
+            h_0 = tuple([torch.cat([a, b], 0) for a, b in zip(h_0_fwd, h_0_rev)])
+        else:
+            h_0 = torch.cat([h_0_fwd, h_0_rev], 0)
+        y, s_t = _run_nnlayer(self._sync_fused_nnlayer(), x, h_0, mask=mask)
+        if q.issequence(s_t):
+            self.layer_fwd.set_states(tuple([s_t_e[0:1] for s_t_e in s_t]))
+            self.layer_rev.set_states(tuple([s_t_e[1:2] for s_t_e in s_t]))
+            h_t = s_t[0]
+        else:
+            self.layer_fwd.set_states(s_t[0:1])
+            self.layer_rev.set_states(s_t[1:2])
+            h_t = s_t
+        fwd_ret, rev_ret = [], []
+        if self._return_final:      # fwd: output at last element, rev: output at first element
+            fwd_ret.append(h_t[0])
+            rev_ret.append(h_t[1])
+        if self._return_all:
+            fwd_ret.append(y[:, :, :y.size(2)//2])
+            rev_ret.append(y[:, :, y.size(2)//2:])
+        return fwd_ret, rev_ret
 
     def return_all(self, truth=True):
         self.layer_fwd.return_all(truth)
@@ -840,8 +1509,11 @@ class _BidirRNNLayer(nn.Module, Recurrent):
         return self
     
     def forward(self, x, mask=None):
-        fwd_ret = self.layer_fwd(x, mask=mask)
-        rev_ret = self.layer_rev(x, mask=mask)
+        if self._fused:
+            fwd_ret, rev_ret = self._forward_fused(x, mask=mask)
+        else:
+            fwd_ret = self.layer_fwd(x, mask=mask)
+            rev_ret = self.layer_rev(x, mask=mask)
         
         merge_fn = (lambda a, b: torch.cat([a, b], -1)) if self.mode == "cat" else (lambda a, b: a + b)
 
@@ -888,6 +1560,7 @@ class BiRNNLayer(nn.Module, Recurrent):
         self.rnnlayer2 = cell2.to_layer()
         self.mode = mode
         self.returns = set()        # "all", "final"
+        self._fused = True
 
     def return_all(self):
         self.rnnlayer1.return_all()
@@ -901,25 +1574,47 @@ class BiRNNLayer(nn.Module, Recurrent):
         self.returns.add("final")
         return self
 
+    def fused(self, truth=True):
+        """ Step both directions in one loop with stacked weights (default), if the cells allow it (see ._fusable). """
+        self._fused = truth
+        return self
+
+    @property
+    def _fusable(self):
+        """ both cells are cudnn-style GRUCells or LSTMCells of the same shape without recurrent dropouts """
+        cell1, cell2 = self.cell1, self.cell2
+        if type(cell1) != type(cell2) or type(cell1) not in (GRUCell, LSTMCell):
+            return False
+        for cell in (cell1, cell2):
+            if not cell.use_cudnn_cell or cell.dropout_rec or cell.zoneout \
+                    or cell.shared_dropout_rec or cell.shared_zoneout:
+                return False
+        return cell1.indim == cell2.indim and cell1.outdim == cell2.outdim and cell1.use_bias == cell2.use_bias
+
     def forward(self, x, mask=None, init_states=None):
         states1, states2 = None, None
         if init_states is not None:
             states1 = init_states[:len(init_states)//2]
             states2 = init_states[len(init_states)//2:]
-        rets1 = self.rnnlayer1(x, mask=mask, init_states=states1)
-        rets2 = self.rnnlayer2(x, mask=mask, init_states=states2, reverse=True)
+        if self._fused and self._fusable:
+            rets1, rets2 = self._forward_fused(x, mask=mask, init_states=(states1, states2))
+        else:
+            rets1 = self.rnnlayer1(x, mask=mask, init_states=states1)
+            rets2 = self.rnnlayer2(x, mask=mask, init_states=states2, reverse=True)
+            if not q.issequence(rets1):     # sublayers also return all outputs by default (see RNNLayer)
+                rets1, rets2 = (rets1,), (rets2,)
         ret = tuple()
         if "final" in self.returns:
             if self.mode == "cat":
                 ret += (torch.cat([rets1[0], rets2[0]], 1),)
             else:
-                ret += rets1[0] + rets2[0]
+                ret += (rets1[0] + rets2[0],)
             rets1, rets2 = rets1[1:], rets2[1:]
         if "all" in self.returns:
             if self.mode == "cat":
                 ret += (torch.cat([rets1[0], rets2[0]], 2),)
             else:
-                ret += rets1[0] + rets2[0]
+                ret += (rets1[0] + rets2[0],)
         if len(ret) == 1:
             return ret[0]
         elif len(ret) == 0:
@@ -927,6 +1622,82 @@ class BiRNNLayer(nn.Module, Recurrent):
         else:
             return ret
 
+    def _forward_fused(self, x, mask=None, init_states=(None, None)):
+        """
+        Unrolls both directions in one loop: the input projections are computed for all timesteps up front
+        and at every timestep, the recurrent projections of both directions are computed with one batched matmul
+        over stacked weights. Same results as unrolling the cells separately.
+        :return: outputs of forward direction, outputs of reverse direction (final and/or all)
+        """
+        cells = [self.cell1, self.cell2]
+        batsize, seqlen = x.size(0), x.size(1)
+        lstm = isinstance(self.cell1, LSTMCell)
+        states = []
+        for cell, cell_init_states in zip(cells, init_states):
+            if cell_init_states is not None:
+                cell.set_init_states(*cell_init_states)
+            cell.reset_state()
+            states.append(cell.get_init_states(batsize))
+        states = [torch.stack(list(state), 0) for state in zip(*states)]     # (2, batsize, dim) each
+        rev_idx = q.var(torch.arange(seqlen - 1, -1, -1).long()).cuda(x).v
+        # input projections for all timesteps, reverse direction reversed in time
+        xproj = [cell.precompute_inputs(x)[1] for cell in cells]
+        xproj = torch.stack([xproj[0], torch.index_select(xproj[1], 1, rev_idx)], 0)   # (2, batsize, seqlen, projdim)
+        if mask is not None:
+            mask = mask.float()
+            mask = torch.stack([mask, torch.index_select(mask, 1, rev_idx)], 0).unsqueeze(3)
+        # stacked recurrent weights
+        weight_hh = torch.stack([cell.nncell.weight_hh.t() for cell in cells], 0)   # (2, dim, projdim)
+        bias_hh = torch.stack([cell.nncell.bias_hh for cell in cells], 0).unsqueeze(1) \
+            if self.cell1.use_bias else None
+        y_tm1 = None
+        y_list = []
+        for i in range(seqlen):
+            if lstm:
+                c_tm1, h_tm1 = states
+            else:
+                h_tm1, = states
+            hproj = torch.bmm(h_tm1, weight_hh)
+            if bias_hh is not None:
+                hproj = hproj + bias_hh
+            xproj_t = xproj[:, :, i]
+            if lstm:
+                gates = xproj_t + hproj
+                input_gate, forget_gate, main_gate, output_gate = gates.chunk(4, 2)
+                c_t = torch.sigmoid(forget_gate) * c_tm1 + torch.sigmoid(input_gate) * torch.tanh(main_gate)
+                y_t = torch.sigmoid(output_gate) * torch.tanh(c_t)
+                newstates = [c_t, y_t]
+            else:
+                x_r, x_z, x_n = xproj_t.chunk(3, 2)
+                h_r, h_z, h_n = hproj.chunk(3, 2)
+                reset_gate = torch.sigmoid(x_r + h_r)
+                update_gate = torch.sigmoid(x_z + h_z)
+                canh = torch.tanh(x_n + reset_gate * h_n)
+                y_t = (1 - update_gate) * canh + update_gate * h_tm1
+                newstates = [y_t]
+            if mask is not None:        # keep states and carry outputs over masked timesteps
+                mask_t = mask[:, :, i]
+                newstates = [newstate * mask_t + oldstate * (1 - mask_t)
+                             for newstate, oldstate in zip(newstates, states)]
+                if y_tm1 is None:
+                    y_tm1 = q.var(torch.zeros(y_t.size())).cuda(y_t).v
+                y_t = y_t * mask_t + y_tm1 * (1 - mask_t)
+                y_tm1 = y_t
+            states = newstates
+            if "all" in self.returns:
+                y_list.append(y_t)
+        for j, cell in enumerate(cells):
+            cell.set_states(*[state[j] for state in states])
+        rets1, rets2 = tuple(), tuple()
+        if "final" in self.returns:     # forward: last timestep, reverse: first timestep
+            rets1 += (y_t[0],)
+            rets2 += (y_t[1],)
+        if "all" in self.returns:
+            y = torch.stack(y_list, 2)      # (2, batsize, seqlen, dim)
+            rets1 += (y[0],)
+            rets2 += (torch.index_select(y[1], 1, rev_idx),)
+        return rets1, rets2
+
 
 # region II. RNN stacks
 class ReccableWrap(Reccable, nn.Module):
@@ -984,7 +1755,7 @@ class RecStack(RecStatefulContainer, Stack):        # contains rec statefuls, no
         return initstates
 
     def set_states(self, *states):
-        assert(len(states) == len(self.numstates))
+        assert(len(states) == self.numstates)
         for layer in self.layers:
             if isinstance(layer, RecStateful):
                 statesforlayer = states[:layer.numstates]
@@ -998,6 +1769,11 @@ class RecStack(RecStatefulContainer, Stack):        # contains rec statefuls, no
                 states += layer.get_states(batsize)
         return states
 
+    def detach_states(self):
+        for layer in self.layers:
+            if isinstance(layer, RecStateful):
+                layer.detach_states()
+
     def to_layer(self):
         return RNNLayer(self)
 
@@ -1009,12 +1785,14 @@ class RecurrentWrapper(Recurrent, nn.Module):
         super(RecurrentWrapper, self).__init__()
         self.block = block
 
-    def forward(self, *x):       # TODO: multiple inputs and outputs
+    def forward(self, *x, **kw):       # TODO: multiple inputs and outputs
         x = [xe.contiguous() for xe in x]
         x0 = x[0]
         batsize, seqlen = x0.size(0), x0.size(1)
         i = [xe.view(batsize * seqlen, *xe.size()[2:]) for xe in x]
-        y = self.block(*i)
+        ikw = dict([(k, v.contiguous().view(batsize * seqlen, *v.size()[2:]) if isinstance(v, Variable) else v)
+                    for k, v in kw.items()])     # (batsize, seqlen, ...) kwargs, e.g. masks
+        y = self.block(*i, **ikw)
         if not q.issequence(y):
             y = (y,)
         yo = []
@@ -129,7 +129,7 @@ def load_questions_inone(p=defaultqp):
     return questions, queries, qids, tx_sep
 
 
-def load_vnt_mats(qids=None, p=defaultqp, tgtdict=None):   # tgtdict: get from makereps.py get_all_reps() tgt_emb or tgt_lin
+def load_vnt_mats(qids=None, p=defaultqp, tgtdict=None, sparse=False):   # tgtdict: get from makereps.py get_all_reps() tgt_emb or tgt_lin
     tt = q.ticktock("vnt loader")
     tt.tick("loading vnts")
     trainvntp = p+".train.butd.vnt"
@@ -140,11 +140,26 @@ def load_vnt_mats(qids=None, p=defaultqp, tgtdict=None):   # tgtdict: get from m
     print(len(testvnt))
     tt.tock("loaded vnts")
     tt.tick("making vnt mat")
-    vntmat = get_vnt_mat(qids, tgtdict, [trainvnt, testvnt])
+    if sparse:
+        vntmat = get_vnt_sparse(qids, tgtdict, [trainvnt, testvnt])
+    else:
+        vntmat = get_vnt_mat(qids, tgtdict, [trainvnt, testvnt])
     tt.tock("made vnt mat")
     return vntmat
 
 
+def get_vnt_sparse(qids, tgtdict, vnts):
+    """ same as get_vnt_mat() but returns a q.SparseVNT (lists of allowed ids) instead of dense matrix """
+    vnt = {}
+    for vnte in vnts:
+        vnt.update(vnte)
+    vntlists = [[[tgtdict[timestep_vnt_element] for timestep_vnt_element in timestep_vnt]
+                 for timestep_vnt in vnt[qid]]
+                for qid in qids]
+    maxlen = max([len(vnt[example_vnt]) for example_vnt in vnt])
+    return q.SparseVNT(vntlists, max(tgtdict.values()) + 1), (len(qids), maxlen + 1, max(tgtdict.values()) + 1)
+
+
 def get_vnt_mat(qids, tgtdict, vnts):
     vnt = {}
     for vnte in vnts:
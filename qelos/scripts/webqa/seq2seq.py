@@ -177,9 +177,9 @@ def run(lr=0.1,
     train_vnt, valid_vnt = train_vnt[:tv_sep], train_vnt[tv_sep:]
 
     # make data loaders
-    train_dataloader = q.dataload(train_questions, train_vnt, train_queries, batch_size=batsize)
-    valid_dataloader = q.dataload(valid_questions, valid_vnt, valid_queries, batch_size=batsize)
-    test_dataloader = q.dataload(test_questions, test_vnt, test_queries, batch_size=batsize)
+    train_dataloader = q.dataload(train_questions, train_vnt, train_queries, batch_size=batsize, bucket=0, trim=[0, (1, 2)])
+    valid_dataloader = q.dataload(valid_questions, valid_vnt, valid_queries, batch_size=batsize, bucket=0, trim=[0, (1, 2)])
+    test_dataloader = q.dataload(test_questions, test_vnt, test_queries, batch_size=batsize, bucket=0, trim=[0, (1, 2)])
     tt.tock("made data loaders")
     # endregion
 
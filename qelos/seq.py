@@ -1,7 +1,11 @@
 import torch
 from torch import nn
-from qelos.basic import DotDistance, CosineDistance, ForwardDistance, BilinearDistance, TrilinearDistance, Softmax, Lambda
-from qelos.rnn import RecStack, Reccable, RecStatefulContainer, RecStateful, RecurrentStack, RecurrentWrapper
+from torch.autograd import Variable
+from qelos.basic import DotDistance, CosineDistance, ForwardDistance, BilinearDistance, TrilinearDistance, Softmax, Lambda, \
+    IndexMask, SparseVNT
+from qelos.rnn import RecStack, Reccable, RecStatefulContainer, RecStateful, RecurrentStack, RecurrentWrapper, RNUBase, \
+    RNNLayer, _TimestepOutputs, _checkpointed
+from qelos.exceptions import SumTingWongException
 from qelos.util import issequence
 
 
@@ -16,10 +20,22 @@ class AttentionGenerator(nn.Module):
         self.dropout = nn.Dropout(p=dropout) if dropout > 0. else None
         self.scale = scale
 
-    def forward(self, data, crit, mask=None):   # should work for 3D/2D and 3D/3D
+    def prepare(self, data):
+        """ Precomputes keys from (batsize, seqlen, dim) data, pass them as prepared= to .forward()
+            to score many crits against the same data (e.g. every step of a decoder) """
+        if not hasattr(self.dist, "prepare"):
+            return None
         if self.data_selector is not None:
             data = self.data_selector(data)
-        scores = self.dist(data, crit)      # (batsize, seqlen)
+        return self.dist.prepare(data)
+
+    def forward(self, data, crit, mask=None, prepared=None):   # should work for 3D/2D and 3D/3D
+        if prepared is not None and crit.dim() == 2:
+            scores = self.dist.score(prepared, crit)    # (batsize, seqlen)
+        else:
+            if self.data_selector is not None:
+                data = self.data_selector(data)
+            scores = self.dist(data, crit)      # (batsize, seqlen)
         if scores.dim() == 3:       # (batsize, dseqlen, cseqlen)
             assert(crit.dim() == 3)
             scores = scores.permute(0, 2, 1)        # because scores for 3D3D are given from data to crit, here we need from crit to data
@@ -27,7 +43,7 @@ class AttentionGenerator(nn.Module):
                 mask = mask.unsqueeze(1).repeat(1, scores.size(1), 1)
         if mask is not None:
             assert(mask.size() == scores.size(), "mask should be same size as scores")
-            scores.data.masked_fill_((-1*mask+1).byte().data, -float("inf"))
+            scores = scores.masked_fill(mask == 0, -float("inf"))     # not on .data, so it's part of export()ed graphs
         if self.scale != 1.:
             scores = scores / self.scale
         weights = self.normalizer(scores)
@@ -51,11 +67,54 @@ class AttentionConsumer(nn.Module):
         return torch.sum(ret, -2)
 
 
+def chunked_attention(scores_fn, values, numq, query_chunk=None, key_chunk=256, dropout=None):
+    """ Attention summaries computed over blocks of queries and keys using an online softmax,
+        without materializing the full (batsize, numq, numk) scores or attention weights.
+        Peak memory is linear in numq and numk for fixed chunk sizes.
+        :param scores_fn:   function (qstart, qend, kstart, kend) -> (batsize, qend-qstart, kend-kstart) scores
+                            for the given block of queries and keys, masked positions must be -inf
+        :param values:      (batsize, numk, dim) values to summarize
+        :param numq:        number of queries
+        :param query_chunk: number of queries per block, all at once if None
+        :param key_chunk:   number of keys per block, all at once if None
+        :param dropout:     dropout module to apply to the (unnormalized) attention weights
+        :return:            (batsize, numq, dim) summaries, same as softmax(scores) @ values
+    """
+    numk = values.size(1)
+    query_chunk = numq if query_chunk is None else query_chunk
+    key_chunk = numk if key_chunk is None else key_chunk
+    floor = -3.4e38      # instead of -inf for running maxes, to keep fully masked blocks nan-free
+    summaries = []
+    for qs in range(0, numq, query_chunk):
+        qe = min(qs + query_chunk, numq)
+        runmax, runsum, acc = None, None, None
+        for ks in range(0, numk, key_chunk):
+            ke = min(ks + key_chunk, numk)
+            scores = scores_fn(qs, qe, ks, ke)              # (batsize, qn, kn)
+            blockmax, _ = torch.max(scores, -1, keepdim=True)
+            newmax = blockmax.clamp(min=floor) if runmax is None else torch.max(runmax, blockmax.clamp(min=floor))
+            weights = torch.exp(scores - newmax)            # (batsize, qn, kn)
+            blocksum = torch.sum(weights, -1, keepdim=True)
+            if dropout is not None:
+                weights = dropout(weights)
+            blockacc = torch.bmm(weights, values[:, ks:ke])     # (batsize, qn, dim)
+            if runmax is None:
+                runsum, acc = blocksum, blockacc
+            else:
+                correction = torch.exp(runmax - newmax)
+                runsum = runsum * correction + blocksum
+                acc = acc * correction + blockacc
+            runmax = newmax
+        summaries.append(acc / runsum)
+    return torch.cat(summaries, 1) if len(summaries) > 1 else summaries[0]
+
+
 class Attention(nn.Module):
     def __init__(self):
         super(Attention, self).__init__()
         self.attgen = AttentionGenerator()
         self.attcon = AttentionConsumer()
+        self._chunks = None
 
     def split_data(self):       # splits datasets in two along dim axis, one goes to gen, other to cons
         def attgen_ds(data):        # (batsize, seqlen, dim)
@@ -74,11 +133,47 @@ class Attention(nn.Module):
         self.attgen.dropout = nn.Dropout(rate)
         return self
 
-    def forward(self, data, crit):
-        weights = self.attgen(data, crit)
+    def chunked(self, query_chunk=64, key_chunk=256):
+        """ Compute summaries in .forward() block by block with an online softmax (see chunked_attention()),
+            without materializing the full attention weights. Only for a plain Softmax normalizer.
+            Chunking is disabled if query_chunk and key_chunk are both None. """
+        self._chunks = (query_chunk, key_chunk) if query_chunk is not None or key_chunk is not None else None
+        return self
+
+    def forward(self, data, crit, mask=None):
+        if self._chunks is not None:
+            return self._forward_chunked(data, crit, mask=mask)
+        weights = self.attgen(data, crit, mask=mask)
         summary = self.attcon(data, weights)
         return summary
 
+    def _forward_chunked(self, data, crit, mask=None):
+        attgen = self.attgen
+        if type(attgen.normalizer) is not Softmax or attgen.normalizer._log or attgen.normalizer._logafter:
+            raise SumTingWongException("chunked attention only supported with a plain Softmax normalizer")
+        keys = attgen.data_selector(data) if attgen.data_selector is not None else data
+        values = self.attcon.data_selector(data) if self.attcon.data_selector is not None else data
+        critdim = crit.dim()
+        if critdim == 2:
+            crit = crit.unsqueeze(1)        # (batsize, 1, dim)
+            mask = mask.unsqueeze(1) if mask is not None else None
+        scale = attgen.scale * attgen.normalizer.temperature
+
+        def scores_fn(qs, qe, ks, ke):
+            scores = attgen.dist(keys[:, ks:ke], crit[:, qs:qe]).permute(0, 2, 1)   # (batsize, qn, kn)
+            if mask is not None:
+                blockmask = mask[:, :, ks:ke] if mask.dim() == 3 and mask.size(1) == 1 \
+                    else mask[:, qs:qe, ks:ke] if mask.dim() == 3 else mask[:, ks:ke].unsqueeze(1)
+                scores = scores.masked_fill((blockmask == 0).expand_as(scores), -float("inf"))
+            if scale != 1.:
+                scores = scores / scale
+            return scores
+
+        query_chunk, key_chunk = self._chunks
+        summary = chunked_attention(scores_fn, values, crit.size(1), query_chunk=query_chunk,
+                                    key_chunk=key_chunk, dropout=attgen.dropout)
+        return summary.squeeze(1) if critdim == 2 else summary
+
     def dot_gen(self):
         self.attgen.dist = DotDistance()
         return self
@@ -113,6 +208,35 @@ class Decoder(nn.Module):
         super(Decoder, self).__init__()
         #assert(isinstance(decodercell, DecoderCell))
         self.block = decodercell
+        self._preallocate_output = False
+        self._output_consumer = None
+        self._checkpoint_every = None
+        self._parallel = True
+
+    def parallel(self, truth=True):
+        """ Teacher-forced decoding of all timesteps at once if the decoder cell supports it for its wiring
+            (see AttentionDecoderCell.parallelizable), otherwise timestep by timestep. On by default. """
+        self._parallel = truth
+        return self
+
+    def checkpoint(self, every=None):
+        """ Activation checkpointing during training: only keep states every `every` timesteps
+            and recompute the timesteps in between during backward (identical results, incl. dropouts).
+            The decoder cell must implement .get_states() and .set_states(). None to switch off. """
+        self._checkpoint_every = every
+        return self
+
+    def preallocate_output(self, truth=True):
+        """ Write every timestep's outputs into preallocated (batsize, seqlen, ...) outputs
+            instead of stacking lists of outputs at the end (only one copy of the outputs at peak). """
+        self._preallocate_output = truth
+        return self
+
+    def output_to(self, consumer):
+        """ Stream outputs to consumer, called as consumer(t, *y_t) for every timestep.
+            Nothing is returned by .forward() then. """
+        self._output_consumer = consumer
+        return self
 
     def reset_state(self):
         self.block.reset_state()
@@ -123,38 +247,261 @@ class Decoder(nn.Module):
     def set_init_states(self, *x):
         self.block.set_init_states(*x)
 
-    def forward(self, *x, **kw):  # first input must be (batsize, seqlen,...)
+    def _start(self, *x, **kw):
+        """ resets states and sets initial states computed from decoder inputs """
         self.reset_state()
-        batsize = x[0].size(0)
-        maxtime = x[0].size(1) if "maxtime" not in kw else kw["maxtime"]
         new_init_states = self._compute_init_states(*x, **kw)
         if new_init_states is not None:
             if not issequence(new_init_states):
                 new_init_states = (new_init_states,)
-            self.set_init_states(*new_init_states)
-        y_list = []
+            self.block.set_init_states(*new_init_states)
+
+    def _select_rows(self, idx, batsize, y_t):
+        """ keeps only rows idx (LongTensor) of the block's current states and previous outputs y_t """
+        idx = Variable(idx)
+        states = self.block.get_states(batsize)
+        self.block.set_states(*[torch.index_select(state, 0, idx) if state is not None else None
+                                for state in states])
+        return [torch.index_select(y_t_e, 0, idx) for y_t_e in y_t]
+
+    def forward(self, *x, **kw):  # first input must be (batsize, seqlen,...)
+        batsize = x[0].size(0)
+        maxtime = x[0].size(1) if "maxtime" not in kw else kw["maxtime"]
+        self._start(*x, **kw)
+        if self._parallel and getattr(self.block, "parallelizable", False) and "maxtime" not in kw \
+                and self._checkpoint_every is None and self._output_consumer is None \
+                and not isinstance(kw["outmask"] if "outmask" in kw else None, SparseVNT):
+            return self.block.forward_parallel(*x, **kw)
+        outputs = _TimestepOutputs(maxtime, preallocate=self._preallocate_output,
+                                   consumer=self._output_consumer)
         y_t = None
-        for t in range(maxtime):
-            #x_t = [x_e[:, t] if x_e.sequence else x_e for x_e in x]
-            x_t, x_t_kw = self.block._get_inputs_t(t=t, x=x, xkw=kw, y_t=y_t)        # let the Rec definition decide what to input
-            if not issequence(x_t):
-                x_t = [x_t]
-            x_t = tuple(x_t)
-            x_t_kw["t"] = t
-            blockret = self.block(*x_t, **x_t_kw)
-            if not issequence(blockret):
-                blockret = [blockret]
-            y_t = blockret
-            #y_t = [y_t_e.unsqueeze(1) for y_t_e in blockret[:self.block.numstates]]
-            y_list.append(y_t)
-        y = tuple()
-        for i in range(len(y_list[0])):
-            yl_e = [y_list[j][i] for j in range(len(y_list))]
-            y += (torch.stack(yl_e, 1),)
-        if len(y) == 1:
+        if self._checkpoint_every is not None and self.training:
+            for i in range(0, maxtime, self._checkpoint_every):
+                segment = list(range(i, min(i + self._checkpoint_every, maxtime)))
+                y_ts = self._unroll_checkpointed(segment, x, kw, y_t)
+                for t, y_t in zip(segment, y_ts):
+                    outputs.add(t, *y_t)
+        else:
+            for t in range(maxtime):
+                y_t = self._step(t, x, kw, y_t)
+                outputs.add(t, *y_t)
+        y = outputs.get()
+        if y is not None and len(y) == 1:
             y = y[0]
         return y
 
+    def _step(self, t, x, kw, y_tm1):
+        #x_t = [x_e[:, t] if x_e.sequence else x_e for x_e in x]
+        x_t, x_t_kw = self.block._get_inputs_t(t=t, x=x, xkw=kw, y_t=y_tm1)        # let the Rec definition decide what to input
+        if not issequence(x_t):
+            x_t = [x_t]
+        x_t = tuple(x_t)
+        x_t_kw["t"] = t
+        blockret = self.block(*x_t, **x_t_kw)
+        if not issequence(blockret):
+            blockret = [blockret]
+        return blockret
+
+    def _unroll_checkpointed(self, segment, x, kw, y_tm1):
+        """ runs given timesteps as one checkpointed segment, returns list of outputs for every timestep """
+        batsize = x[0].size(0)
+        rnus = [module for module in self.block.modules() if isinstance(module, RNUBase)]
+        states = list(self.block.get_states(batsize))
+        numstates = len(states)
+        states += list(y_tm1) if y_tm1 is not None else []      # previous outputs can be fed back
+        xidxs = [i for i, x_e in enumerate(x) if isinstance(x_e, Variable)]
+        kwkeys = [k for k in sorted(kw.keys()) if isinstance(kw[k], Variable)]
+        inputs = [x[i] for i in xidxs] + [kw[k] for k in kwkeys]
+        numouts = []
+
+        def run(states, inputs):
+            _x = list(x)
+            for i in xidxs:
+                _x[i] = inputs.pop(0)
+            _kw = dict(kw)
+            for k in kwkeys:
+                _kw[k] = inputs.pop(0)
+            prevstates = list(self.block.get_states(batsize))   # recomputation must not change current states
+            self.block.set_states(*states[:numstates])
+            _y_t = list(states[numstates:]) if len(states) > numstates else None
+            outputs = []
+            for t in segment:
+                _y_t = self._step(t, _x, _kw, _y_t)
+                outputs += list(_y_t)
+                numouts.append(len(_y_t))
+            newstates = list(self.block.get_states(batsize))
+            self.block.set_states(*prevstates)
+            return outputs, newstates
+
+        outputs, newstates = _checkpointed(run, states, inputs, rnus)
+        self.block.set_states(*newstates)
+        y_ts = []
+        for numout in numouts[:len(segment)]:
+            y_ts.append(outputs[:numout])
+            outputs = outputs[numout:]
+        return y_ts
+
+
+def _expand_to_beams(x, beamsize, batsize):
+    """ (batsize, ...) -> (batsize * beamsize, ...), beams of the same example next to each other.
+        This is a copy: a broadcast (stride 0) beam axis can't be merged into the batch axis by a view. """
+    if isinstance(x, SparseVNT):
+        return x.index_select(0, torch.arange(0, batsize).long().unsqueeze(1).repeat(1, beamsize).view(-1))
+    if not isinstance(x, Variable):
+        return x
+    size = tuple(x.size()[1:])
+    return x.unsqueeze(1).expand(*((x.size(0), beamsize) + size)).contiguous().view(*((-1,) + size))
+
+
+class BeamDecoder(Decoder):
+    """
+    Batched beam search using a decoder cell (see DecoderCell.to_beam_decoder()).
+    First input to .forward() must contain the start symbols: (batsize,) or (batsize, seqlen) (only first column used).
+    Other (batch-first) inputs and kwargs (e.g. ctx, ctxmask) are copied to batsize * beamsize rows once per call
+    (the cell's modules work on batch-first (batsize * beamsize, ...) inputs, e.g. attention keys prepared from ctx),
+    beams of the same example share them so they never have to be reordered.
+    Recurrent states of the cell (see .get_states()) are reordered by the back-pointers after every timestep.
+    The first output of the cell at every timestep must be (log-)probabilities over the output vocabulary.
+    """
+    def __init__(self, decodercell, beamsize=5, maxtime=50, end_symbol=None, logprobs=True):
+        """
+        :param beamsize:    number of beams per example
+        :param maxtime:     maximum number of decoding timesteps
+        :param end_symbol:  id of end symbol, beams that produced it are finished,
+                            decoding stops when all beams are finished
+        :param logprobs:    whether the cell outputs log-probabilities (otherwise probabilities)
+        """
+        super(BeamDecoder, self).__init__(decodercell)
+        self.beamsize, self.maxtime, self.end_symbol, self.logprobs = beamsize, maxtime, end_symbol, logprobs
+
+    def set_init_states(self, *x):
+        """ batch-first (batsize, dim) init states are expanded to all beams """
+        x = [_expand_to_beams(x_e, self.beamsize, x_e.size(0)) if x_e is not None and x_e.dim() > 1 else x_e
+             for x_e in x]
+        self.block.set_init_states(*x)
+
+    def forward(self, *x, **kw):
+        """
+        :return:    (batsize, beamsize, seqlen) sequences, best first (0 after end symbol)
+                    and (batsize, beamsize) their log-probabilities
+        """
+        start = x[0] if x[0].dim() == 1 else x[0][:, 0]
+        batsize, beamsize = start.size(0), self.beamsize
+        maxtime = kw["maxtime"] if "maxtime" in kw else self.maxtime
+        x = [_expand_to_beams(x_e, beamsize, batsize) for x_e in x]
+        kw = dict([(k, _expand_to_beams(v, beamsize, batsize)) for k, v in kw.items()])
+        self._start(*x, **kw)                                # init states computed from expanded inputs
+        tokens = _expand_to_beams(start, beamsize, batsize).data       # (batsize * beamsize,)
+        scores = start.data.new(batsize, beamsize).float().fill_(-float("inf"))
+        scores[:, 0] = 0                                      # all beams start the same, only expand first one
+        finished = start.data.new(batsize * beamsize).zero_().byte()
+        offsets = (torch.arange(0, batsize).long() * beamsize).unsqueeze(1)
+        offsets = offsets.cuda() if start.is_cuda else offsets
+        backptrs, symbols = [], []
+        y_t = None
+        for t in range(maxtime):
+            # feed back selected symbols as x[0][:, t]
+            tokens_t = Variable(tokens.unsqueeze(1).expand(tokens.size(0), t + 1))
+            y_t = self._step(t, [tokens_t] + x[1:], kw, y_t)
+            logprobs_t = y_t[0].data.float()
+            if not self.logprobs:
+                logprobs_t = torch.log(logprobs_t)
+            vocsize = logprobs_t.size(1)
+            if self.end_symbol is not None and finished.any():     # finished beams can only continue with end symbol
+                finished_idx = finished.nonzero().squeeze(1)
+                logprobs_t.index_fill_(0, finished_idx, -float("inf"))
+                logprobs_t[:, self.end_symbol].index_fill_(0, finished_idx, 0)
+            candscores = scores.unsqueeze(2) + logprobs_t.view(batsize, beamsize, vocsize)
+            scores, best = torch.topk(candscores.view(batsize, beamsize * vocsize), beamsize, 1)
+            tokens = best % vocsize
+            backptr = ((best - tokens) / vocsize).long()            # (batsize, beamsize)
+            backptrs.append(backptr)
+            symbols.append(tokens)
+            tokens = tokens.view(-1)
+            # reorder states of beams
+            order = (backptr + offsets).view(-1)
+            y_t = self._select_rows(order, batsize * beamsize, y_t)
+            if self.end_symbol is not None:
+                finished = torch.index_select(finished, 0, order) | (tokens == self.end_symbol)
+                if finished.all():
+                    break
+        # follow back-pointers
+        seqs = []
+        k = torch.arange(0, beamsize).long().unsqueeze(0).expand(batsize, beamsize)
+        k = k.cuda() if start.is_cuda else k
+        for backptr, symbols_t in zip(reversed(backptrs), reversed(symbols)):
+            seqs.append(torch.gather(symbols_t, 1, k))
+            k = torch.gather(backptr, 1, k)
+        seqs.reverse()
+        seqs = torch.stack(seqs, 2)         # (batsize, beamsize, seqlen)
+        if self.end_symbol is not None:     # zero out everything after end symbol
+            ended = (seqs == self.end_symbol).long()
+            seqs[(torch.cumsum(ended, 2) - ended) > 0] = 0
+        return Variable(seqs), Variable(scores)
+
+
+class GreedyDecoder(Decoder):
+    """
+    Free-running greedy decoding using a decoder cell (see DecoderCell.to_greedy_decoder()).
+    The argmax of the cell's first output is fed back as next input symbol.
+    First input to .forward() must contain the start symbols: (batsize,) or (batsize, seqlen) (only first column used).
+    Rows that produced the end symbol are dropped from the active batch (together with their inputs, kwargs and states),
+    decoding stops when all rows are finished.
+    """
+    def __init__(self, decodercell, maxtime=50, end_symbol=None):
+        """
+        :param maxtime:     maximum number of decoding timesteps
+        :param end_symbol:  id of end symbol, rows that produced it are finished
+        """
+        super(GreedyDecoder, self).__init__(decodercell)
+        self.maxtime, self.end_symbol = maxtime, end_symbol
+
+    def forward(self, *x, **kw):
+        """
+        :return:    (batsize, seqlen) decoded sequences (0 after end symbol)
+                    and (batsize, seqlen, ...) first outputs of the cell (0 after end symbol)
+        """
+        start = x[0] if x[0].dim() == 1 else x[0][:, 0]
+        batsize = start.size(0)
+        maxtime = kw["maxtime"] if "maxtime" in kw else self.maxtime
+        x = list(x)
+        self._start(*x, **kw)
+        tokens = start.data
+        active = torch.arange(0, batsize).long()      # original rows of current active batch
+        active = active.cuda() if start.is_cuda else active
+        outputs = []        # (active rows, tokens, outputs) for every timestep
+        y_t = None
+        for t in range(maxtime):
+            tokens_t = Variable(tokens.unsqueeze(1).expand(tokens.size(0), t + 1))
+            y_t = self._step(t, [tokens_t] + x[1:], kw, y_t)
+            _, tokens = torch.max(y_t[0].data, 1)
+            outputs.append((active, tokens, y_t[0]))
+            if self.end_symbol is not None:
+                unfinished = (tokens != self.end_symbol).nonzero()
+                if len(unfinished) == 0:
+                    break
+                unfinished = unfinished.squeeze(1)
+                if len(unfinished) < len(active):       # drop finished rows
+                    y_t = self._select_rows(unfinished, len(active), y_t)
+                    tokens, active = tokens[unfinished], active[unfinished]
+                    unfinished = Variable(unfinished)
+                    x = [x_e.index_select(0, unfinished) if hasattr(x_e, "index_select") else x_e
+                         for x_e in x]
+                    kw = dict([(k, v.index_select(0, unfinished) if hasattr(v, "index_select") else v)
+                               for k, v in kw.items()])
+        # scatter back to original rows, finished rows get zeros
+        seqs = start.data.new(batsize, len(outputs)).zero_()
+        ys = []
+        for t, (active_t, tokens_t, y_t) in enumerate(outputs):
+            seqs[:, t].index_copy_(0, active_t, tokens_t)
+            if len(active_t) < batsize:
+                scatter = active_t.new(batsize).fill_(len(active_t))       # points to zero row
+                scatter.index_copy_(0, active_t, torch.arange(0, len(active_t)).type_as(active_t))
+                y_t = torch.cat([y_t, Variable(y_t.data.new(1, *y_t.size()[1:]).zero_())], 0)
+                y_t = torch.index_select(y_t, 0, Variable(scatter))
+            ys.append(y_t)
+        return Variable(seqs), torch.stack(ys, 1)
+
 
 class ContextDecoder(Decoder):
     """
@@ -166,6 +513,12 @@ class ContextDecoder(Decoder):
         self.embedder = embedder
         self.ctx_to_decinp = kw["ctx_to_decinp"] if "ctx_to_decinp" in kw else True
         self.init_state_gen = kw["ctx_to_h0"] if "ctx_to_h0" in kw else None
+        self._init_state_computer = None
+
+    def set_init_states_computer(self, callabla):
+        """ like DecoderCell.set_init_states_computer(): called with the decoder's inputs (x, ctx, **kw),
+            overrides init_state_gen """
+        self._init_state_computer = callabla
 
     def forward(self, x, ctx):
         """
@@ -187,8 +540,10 @@ class ContextDecoder(Decoder):
         y = self.block(i)
         return y
 
-    def _compute_init_states(self, x, ctx):
-        if self.init_state_gen is not None:
+    def _compute_init_states(self, x, ctx, **kw):
+        if self._init_state_computer is not None:
+            return self._init_state_computer(x, ctx, **kw)
+        elif self.init_state_gen is not None:
             h_0 = self.init_state_gen(ctx)
             return h_0
         else:
@@ -222,13 +577,14 @@ class AttentionDecoder(ContextDecoder):
         self.return_out = return_out
         self.return_att = return_att
 
-    def forward(self, x, ctx, ctxmask=None):
+    def forward(self, x, ctx, ctxmask=None, outmask=None):
         """
         :param x:   (batsize, seqlen) of integers or (batsize, seqlen, dim) of vectors if embedder is None
         :param ctx: (batsize, dim) of context vectors
+        :param outmask: (batsize, seqlen, outdim) output mask, given to smo as mask=
         :return:
         """
-        new_init_states = self._compute_init_states(x, ctx)
+        new_init_states = self._compute_init_states(x, ctx, ctxmask=ctxmask)
         if new_init_states is not None:
             if not issequence(new_init_states):
                 new_init_states = (new_init_states,)
@@ -244,7 +600,8 @@ class AttentionDecoder(ContextDecoder):
         if self.ctx_to_smo:     cat_to_smo.append(dctx)
         if self.decinp_to_smo:  cat_to_smo.append(x_emb)
         smoinp = torch.cat(cat_to_smo, 2) if len(cat_to_smo) > 1 else cat_to_smo[0]
-        output = self.smo(smoinp) if self.smo is not None else smoinp
+        smokw = {"mask": outmask.float()} if outmask is not None else {}
+        output = self.smo(smoinp, **smokw) if self.smo is not None else smoinp
         # returns
         ret = tuple()
         if self.return_out:
@@ -268,8 +625,35 @@ class AttentionDecoder(ContextDecoder):
         res = self.attention.attcon(ctx, att_weights)
         return res, att_weights
 
+    def to_cell(self):
+        """ Makes an AttentionDecoderCell with the same parameters (for incremental decoding, e.g. beam search).
+            Only for cores consisting of RNNLayers (e.g. RecurrentStack(GRUCell(...).to_layer(), ...)). """
+        core = self.block
+        if isinstance(core, RNNLayer):
+            core = core.cell
+        elif isinstance(core, RecStack):
+            if not all([isinstance(layer, RNNLayer) for layer in core.layers]):
+                raise SumTingWongException("only cores of RNNLayers can be converted to cells")
+            core = RecStack(*[layer.cell for layer in core.layers])
+        else:
+            raise SumTingWongException("only cores of RNNLayers can be converted to cells")
+        cell = AttentionDecoderCell(attention=self.attention, embedder=self.embedder, core=core,
+                                    smo=self.smo.block if self.smo is not None else None,
+                                    attention_transform=self.att_transform.block if self.att_transform is not None else None,
+                                    att_after_update=True, ctx_to_decinp=False,
+                                    ctx_to_smo=self.ctx_to_smo, state_to_smo=self.state_to_smo,
+                                    decinp_to_att=self.decinp_to_att, decinp_to_smo=self.decinp_to_smo,
+                                    return_out=self.return_out, return_att=self.return_att)
+        if self._init_state_computer is not None:
+            cell.set_init_states_computer(self._init_state_computer)
+        elif self.init_state_gen is not None:
+            init_state_gen = self.init_state_gen
 
-        pass # TODO
+            def init_state_computer(x, ctx, **kw):      # cell's own state (ctx_0) is not used without ctx_to_decinp
+                states = init_state_gen(ctx)
+                return (None,) + (tuple(states) if issequence(states) else (states,))
+            cell.set_init_states_computer(init_state_computer)
+        return cell
 
 
 class DecoderCell(RecStatefulContainer):
@@ -303,6 +687,12 @@ class DecoderCell(RecStatefulContainer):
 
     def get_init_states(self, batsize):
         return self.core.get_init_states(batsize)
+
+    def get_states(self, batsize):
+        return self.core.get_states(batsize)
+
+    def set_states(self, *states):
+        self.core.set_states(*states)
     # endregion
 
     def teacher_force(self, frac=1):        # set teacher forcing
@@ -371,6 +761,14 @@ class DecoderCell(RecStatefulContainer):
         """ Makes a decoder from this decoder cell """
         return Decoder(self)
 
+    def to_greedy_decoder(self, maxtime=50, end_symbol=None):
+        """ Makes a free-running greedy decoder from this decoder cell (see GreedyDecoder) """
+        return GreedyDecoder(self, maxtime=maxtime, end_symbol=end_symbol)
+
+    def to_beam_decoder(self, beamsize=5, maxtime=50, end_symbol=None, logprobs=True):
+        """ Makes a beam search decoder from this decoder cell (see BeamDecoder) """
+        return BeamDecoder(self, beamsize=beamsize, maxtime=maxtime, end_symbol=end_symbol, logprobs=logprobs)
+
 
 class ContextDecoderCell(DecoderCell):
     def __init__(self, embedder=None, *layers):
@@ -450,6 +848,76 @@ class AttentionDecoderCell(DecoderCell):
         self.return_att = return_att
         # states
         self._state = [None]
+        self._prepared_ctx = [None, None]      # (ctx, attention keys prepared from ctx)
+        self._core_layer = []       # RNNLayer unrolling core for .forward_parallel() (not registered as submodule)
+
+    @property
+    def parallelizable(self):
+        """ Teacher-forced decoding can be run for all timesteps at once (see .forward_parallel())
+            if the core's inputs don't depend on the attention (ctx_to_decinp=False) """
+        return not self.ctx_to_decinp and self._inputs_t_getter is None and isinstance(self.core, RecStateful)
+
+    def forward_parallel(self, x, ctx, ctxmask=None, outmask=None, **kw):
+        """
+        Teacher-forced decoding of all timesteps at once (only if .parallelizable):
+        the core is unrolled over the whole sequence first, then attention is computed for all timesteps together.
+        Same outputs as running .forward() timestep by timestep (see Decoder.parallel()).
+        :param x:       (batsize, seqlen) inputs
+        :param ctx:     (batsize, inpseqlen, dim) whole context
+        :param ctxmask: (batsize, inpseqlen) context mask
+        :param outmask: (batsize, seqlen, outdim) output mask
+        :return: (batsize, seqlen, ...) output probabilities and/or attention weights
+        """
+        assert(self.parallelizable)
+        batsize, seqlen = x.size(0), x.size(1)
+        x_emb = self.embedder(x)
+        if len(x_emb) == 2 and isinstance(x_emb, tuple):
+            x_emb, _ = x_emb
+        if len(self._core_layer) == 0 or self._core_layer[0].cell is not self.core:
+            self._core_layer = [RNNLayer(self.core)]
+        core_layer = self._core_layer[0]
+        core_layer.training = self.training
+        o = core_layer(x_emb)       # (batsize, seqlen, dim)
+        if self.att_after_update:
+            h = o
+        else:                       # attention with previous outputs of core
+            h = torch.cat([self._state[0].unsqueeze(1), o[:, :-1]], 1)
+        if self.state_split:
+            h = h[:, :, :h.size(2)//2]
+        if self.decinp_to_att:
+            h = torch.cat([h, x_emb], 2)
+        h = h.contiguous()
+        if self.att_transform is not None:
+            h = self.att_transform(h.view(batsize * seqlen, -1))
+            h = h.view(batsize, seqlen, *h.size()[1:])
+        att_weights = self.attention.attgen(ctx, h, mask=ctxmask)       # (batsize, seqlen, inpseqlen)
+        ctx_t = self.attention.attcon(ctx, att_weights)                 # (batsize, seqlen, dim)
+        cat_to_smo = []
+        o_to_smo = o[:, :, o.size(2)//2:] if self.state_split else o
+        if self.state_to_smo:   cat_to_smo.append(o_to_smo)
+        if self.ctx_to_smo:     cat_to_smo.append(ctx_t)
+        if self.decinp_to_smo:  cat_to_smo.append(x_emb)
+        smoinp = torch.cat(cat_to_smo, 2) if len(cat_to_smo) > 1 else cat_to_smo[0]
+        smoinp = smoinp.contiguous().view(batsize * seqlen, -1)
+        smokw = {}      # like stepwise decoding (see .get_inputs_t()), other kwargs don't go to smo
+        if outmask is not None:
+            smokw["mask"] = outmask.float().contiguous().view(batsize * seqlen, -1)
+        y = self.smo(smoinp, **smokw) if self.smo is not None else smoinp
+        y = y.view(batsize, seqlen, *y.size()[1:])
+        # returns
+        ret = tuple()
+        if self.return_out:
+            ret += (y,)
+        if self.return_att:
+            ret += (att_weights,)
+        # store rec state
+        if self.att_after_update:
+            self._state[0] = ctx_t[:, -1]
+        else:
+            self._state[0] = o[:, -1]
+        if len(ret) == 1:
+            ret = ret[0]
+        return ret
 
 
     # region implement DecoderCell signature
@@ -485,7 +953,7 @@ class AttentionDecoderCell(DecoderCell):
         smokw = {}
         smokw.update(kw)
         if outmask_t is not None:
-            smokw["mask"] = outmask_t.float()
+            smokw["mask"] = outmask_t if isinstance(outmask_t, IndexMask) else outmask_t.float()
         y_t = self.smo(smoinp_t, **smokw) if self.smo is not None else smoinp_t
         # returns
         ret = tuple()
@@ -518,23 +986,47 @@ class AttentionDecoderCell(DecoderCell):
             h = torch.cat([h, x_emb], 1)
         if self.att_transform is not None:
             h = self.att_transform(h)
-        att_weights = self.attention.attgen(ctx, h, mask=ctxmask)
+        if self._prepared_ctx[0] is not ctx:       # ctx doesn't change during a rollout, prepare attention keys once
+            self._prepared_ctx = [ctx, self.attention.attgen.prepare(ctx)]
+        att_weights = self.attention.attgen(ctx, h, mask=ctxmask, prepared=self._prepared_ctx[1])
         res = self.attention.attcon(ctx, att_weights)
         return res, att_weights
 
+    def to_layer_decoder(self):
+        """ Makes an AttentionDecoder with the same parameters, only for att_after_update=True and ctx_to_decinp=False.
+            Note that Decoder (see .to_decoder()) already decodes all timesteps at once if possible (see Decoder.parallel()). """
+        if not self.parallelizable or not self.att_after_update or self.state_split:
+            raise SumTingWongException("only cells with att_after_update=True, ctx_to_decinp=False and state_split=False "
+                                       "can be converted to AttentionDecoder")
+        decoder = AttentionDecoder(attention=self.attention, embedder=self.embedder, core=RNNLayer(self.core),
+                                   smo=self.smo, att_transform=self.att_transform,
+                                   ctx_to_smo=self.ctx_to_smo, state_to_smo=self.state_to_smo,
+                                   decinp_to_att=self.decinp_to_att, decinp_to_smo=self.decinp_to_smo,
+                                   return_out=self.return_out, return_att=self.return_att)
+        if self._init_state_computer is not None:
+            init_state_computer = self._init_state_computer
+
+            def core_init_state_computer(x, ctx, **kw):     # drop cell's own state
+                states = init_state_computer(x, ctx, **kw)
+                return tuple(states)[1:] if issequence(states) else None
+            decoder.set_init_states_computer(core_init_state_computer)
+        return decoder
+
     def get_inputs_t(self, t=None, x=None, xkw=None, y_t=None):      # TODO implement teacher forcing
         outargs = (x[0][:, t], x[1])    # (prev_token, ctx)
         outkwargs = {"t": t}
         if "ctxmask" in xkw:        # copy over ctxmask (shared over decoder steps)
             outkwargs["ctxmask"] = xkw["ctxmask"]
         if "outmask" in xkw:        # slice out the time from outmask
-            outkwargs["outmask_t"] = xkw["outmask"][:, t]
+            outmask = xkw["outmask"]
+            outkwargs["outmask_t"] = outmask.step(t, x[0][:, t]) if isinstance(outmask, SparseVNT) else outmask[:, t]
         return outargs, outkwargs
     # endregion
 
     # region RecStatefulContainer signature
     def reset_state(self):
         #self._state[0] = None
+        self._prepared_ctx = [None, None]
         self.core.reset_state()
 
     def set_init_states(self, ownstate, *states):
@@ -545,5 +1037,12 @@ class AttentionDecoderCell(DecoderCell):
         """
         self._state[0] = ownstate
         self.core.set_init_states(*states)
+
+    def get_states(self, batsize):
+        return [self._state[0]] + list(self.core.get_states(batsize))
+
+    def set_states(self, ownstate, *states):
+        self._state[0] = ownstate
+        self.core.set_states(*states)
     # endregion
 
@@ -4,6 +4,9 @@ import inspect
 import re
 import signal
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime as dt
 import dill as pickle
 
@@ -11,6 +14,8 @@ import nltk
 import numpy as np
 import unidecode
 from IPython import embed
+import torch
+from torch.autograd import Variable
 
 
 # torch-independent utils
@@ -370,14 +375,159 @@ def dtoo(d):
     return DictObj(d)
 
 
-class EmitStorage(object):
-    storage = {}
+class _EmitHooks(threading.local):
+    """ Per-thread registry of emit() subscribers. """
+    def __init__(self):
+        self.subscribers = {}       # name (None: all names) -> list of subscribers
+        self.enabled = True         # switched off by export() while tracing
+        self.recorder = None        # used by get_emitted(), set by record_emitted()
+
+
+EmitHooks = _EmitHooks()
+
+
+def subscribe(subscriber, *names):
+    """
+    Calls subscriber(name, value) on every emit(name, value) in the current thread.
+    :param subscriber:  callable taking name and emitted value, e.g. an EmitRecorder
+    :param names:       names to subscribe to, all names if none given
+    :return:            subscriber
+    """
+    names = names if len(names) > 0 else (None,)
+    for name in names:
+        subscribers = EmitHooks.subscribers.setdefault(name, [])
+        if subscriber not in subscribers:
+            subscribers.append(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber, *names):
+    """ Removes subscriber from given names (from all names it is subscribed to if none given). """
+    names = names if len(names) > 0 else list(EmitHooks.subscribers.keys())
+    for name in names:
+        subscribers = EmitHooks.subscribers.get(name, [])
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if len(subscribers) == 0 and name in EmitHooks.subscribers:
+            del EmitHooks.subscribers[name]
+    return subscriber
+
+
+def emitting(name):
+    """ Whether emit(name, ...) reaches any subscriber, to skip building costly values. """
+    hooks = EmitHooks
+    return hooks.enabled and (name in hooks.subscribers or None in hooks.subscribers)
+
+
+def emit(name, value):
+    """ Passes value to the subscribers of name in the current thread, nothing is kept if there are none. """
+    hooks = EmitHooks
+    if not hooks.subscribers or not hooks.enabled:
+        return
+    for subscriber in hooks.subscribers.get(name, []) + hooks.subscribers.get(None, []):
+        subscriber(name, value)
+
+
+@contextmanager
+def timed(name):
+    """ Emits the seconds spent in the with-block as name (only timed if name has subscribers). """
+    if not emitting(name):
+        yield
+        return
+    start = time.time()
+    yield
+    emit(name, time.time() - start)
+
+
+class EmitRecorder(object):
+    """
+    Subscriber that records emitted values by name.
+    Recorded values are kept alive until .reset(), so subscribe only while needed.
+    :param keep:    "last" keeps only the last value for every name, "all" keeps a list of all values
+    """
+    def __init__(self, keep="last"):
+        assert(keep in ("last", "all"))
+        self.keep = keep
+        self.emitted = {}
+
+    def summarize(self, value):
+        """ what is recorded for an emitted value, override in subclasses """
+        return value
+
+    def reset(self):
+        self.emitted = {}
+        return self
+
+    def __call__(self, name, value):
+        value = self.summarize(value)
+        if self.keep == "all":
+            self.emitted.setdefault(name, []).append(value)
+        else:
+            self.emitted[name] = value
+
+    def __getitem__(self, name):
+        return self.emitted[name]
+
+    def __contains__(self, name):
+        return name in self.emitted
+
+
+def _map_tensors(f, value):
+    """ applies f to every tensor (or variable) in value, which can be (nested) dicts, lists or tuples of them """
+    if isinstance(value, dict):
+        return dict([(k, _map_tensors(f, v)) for k, v in value.items()])
+    elif isinstance(value, (list, tuple)):
+        return type(value)([_map_tensors(f, v) for v in value])
+    elif isinstance(value, Variable):
+        return f(value.data)
+    elif torch.is_tensor(value):
+        return f(value)
+    else:
+        return value
+
+
+class ShapeRecorder(EmitRecorder):
+    """ Records the shapes of emitted tensors (doesn't keep the tensors themselves). """
+    def summarize(self, value):
+        return _map_tensors(lambda x: tuple(x.size()), value)
+
+
+class StatsRecorder(EmitRecorder):
+    """ Records mean, std, min, max and L2 norm of emitted tensors (doesn't keep the tensors themselves). """
+    def summarize(self, value):
+        def _stats(x):
+            x = x.float()
+            return {"mean": float(x.mean()), "std": float(x.std()) if x.numel() > 1 else 0.,
+                    "min": float(x.min()), "max": float(x.max()), "norm": float(x.norm())}
+        return _map_tensors(_stats, value)
+
+
+class TimeRecorder(EmitRecorder):
+    """ Records the time of every emit (keeps all by default), e.g. to time between emit points. """
+    def __init__(self, keep="all"):
+        super(TimeRecorder, self).__init__(keep=keep)
+
+    def summarize(self, value):
+        return time.time()
+
+
+def record_emitted(*names):
+    """ Starts recording the last emitted values of given names (all if none given) for get_emitted() in the current thread. """
+    if EmitHooks.recorder is None:
+        EmitHooks.recorder = EmitRecorder()
+    return subscribe(EmitHooks.recorder, *names)
 
 
-def emit(name, dic):
-    EmitStorage.storage[name] = dic
+def stop_recording_emitted():
+    """ Stops recording for get_emitted() in the current thread and drops the recorded values. """
+    if EmitHooks.recorder is not None:
+        unsubscribe(EmitHooks.recorder)
+        EmitHooks.recorder = None
 
 
 def get_emitted(name):
-    return EmitStorage.storage[name]
+    """ Last value emitted as name, only recorded after record_emitted(). """
+    if EmitHooks.recorder is None:
+        raise KeyError("nothing recorded for {}, call record_emitted() first".format(name))
+    return EmitHooks.recorder[name]
 
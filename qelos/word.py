@@ -451,6 +451,12 @@ class WordLinout(WordLinoutBase):
         return vec
 
     def forward(self, x, mask=None):
+        if isinstance(mask, q.IndexMask):       # only compute scores of allowed ids --> (batsize, numids)
+            weight = self.lin.weight.index_select(0, mask.ids.view(-1)).view(mask.ids.size(0), mask.ids.size(1), -1)
+            ret = torch.bmm(weight, x.unsqueeze(2)).squeeze(2)
+            if self.lin.bias is not None:
+                ret = ret + self.lin.bias.index_select(0, mask.ids.view(-1)).view(mask.ids.size())
+            return ret * mask.mask
         ret = self.lin(x)
         ret = ret.mul(mask if mask is not None else 1)
         return ret#, mask ?
@@ -491,7 +497,29 @@ class ComputedWordLinout(WordLinoutBase):
             stdv = 1. / math.sqrt(self.bias.size(0))
             self.bias.data.uniform_(-stdv, stdv)
 
+    def _forward_index_mask(self, x, mask):     # (batsize, indim), IndexMask
+        """ computes vectors only for ids allowed in some row, returns (batsize, numids) scores of allowed ids """
+        compute_ids = np.unique(mask.ids.data.cpu().numpy()[mask.mask.data.cpu().numpy() > 0])
+        compute_ids = compute_ids if len(compute_ids) > 0 else np.zeros((1,), dtype="int64")
+        index_transform = np.zeros((self.outdim,), dtype="int64")       # id --> row in weight
+        index_transform[compute_ids] = np.arange(1, len(compute_ids) + 1)
+        compute_ids = q.var(torch.from_numpy(compute_ids)).cuda(x).v
+        index_transform = q.var(torch.from_numpy(index_transform)).cuda(x).v
+        comp_weight = self.computer(self.data[compute_ids]).contiguous()     # (num_compute_ids, indim)
+        indim = comp_weight.size(1)
+        if self.base_weight is None or self.base_weight.size(1) != indim:
+            self.base_weight = q.var(torch.zeros(1, indim)).cuda(x).v
+        weight = torch.cat([self.base_weight, comp_weight], 0)
+        weight = weight.index_select(0, index_transform.index_select(0, mask.ids.view(-1)))
+        weight = weight.view(mask.ids.size(0), mask.ids.size(1), indim)
+        out = torch.bmm(weight, x.unsqueeze(2)).squeeze(2)
+        if self.bias is not None:
+            out = out + self.bias.index_select(0, mask.ids.view(-1)).view(mask.ids.size())
+        return out * mask.mask
+
     def forward(self, x, mask=None):        # (batsize, indim), (batsize, outdim)
+        if isinstance(mask, q.IndexMask):
+            return self._forward_index_mask(x, mask)
         if mask is not None:
             mask = mask.long()
             # select data, compute vectors, build switcher
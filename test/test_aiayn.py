@@ -60,3 +60,69 @@ class AYNEncoderTest(TestCase):
 
         loss = out.sum()
         loss.backward()
+
+
+class AYNIncrementalDecoderTest(TestCase):
+    def test_step_same_as_forward(self):
+        wdic = "<MASK> a b c d e f g h i j k l m n o p".split()
+        wdic = dict(zip(wdic, range(len(wdic))))
+        emb = q.WordEmb(10, worddic=wdic)
+        m = q.AYNDecoder(emb, n_max_seq=7, n_layers=3, n_head=2,
+                         d_k=4, d_v=6, d_pos_vec=6, d_model=16,
+                         d_inner_hid=20, dropout=0)
+        tgt_seq = q.var(np.random.randint(1, max(wdic.values()), (5, 7))).v
+        tgt_seq.data[0, 5:] = 0
+        ctx = q.var(np.random.random((5, 8, 16)).astype("float32")).v
+        ctx_seq_mask = np.ones((5, 8), dtype="int64")
+        ctx_seq_mask[1, 5:] = 0
+        ctx_seq_mask = q.var(ctx_seq_mask).v.byte()
+
+        out = m(tgt_seq, ctx, ctx_seq_mask).data.numpy()
+
+        m.reset_state()
+        stepouts = []
+        for t in range(tgt_seq.size(1)):
+            stepouts.append(m.step(tgt_seq[:, t], ctx, ctx_seq_mask).data.numpy())
+        stepouts = np.stack(stepouts, 1)
+
+        self.assertEqual(stepouts.shape, (5, 7, 16))
+        self.assertTrue(np.allclose(out, stepouts, atol=1e-6))
+
+        # cache is reset
+        m.reset_state()
+        firstout = m.step(tgt_seq[:, 0], ctx, ctx_seq_mask).data.numpy()
+        self.assertTrue(np.allclose(out[:, 0], firstout, atol=1e-6))
+
+
+class AYNCachedMasksTest(TestCase):
+    def test_default_positions_and_masks(self):
+        wdic = "<MASK> a b c d e f g h i j k l m n o p".split()
+        wdic = dict(zip(wdic, range(len(wdic))))
+        emb = q.WordEmb(10, worddic=wdic)
+        m = q.AYNDecoder(emb, n_max_seq=7, n_layers=2, n_head=2,
+                         d_k=4, d_v=6, d_pos_vec=6, d_model=16,
+                         d_inner_hid=20, dropout=0)
+        tgt_seq = q.var(np.random.randint(1, max(wdic.values()), (5, 7))).v
+        tgt_seq.data[0, 5:] = 0
+        tgt_pos = q.var(np.arange(0, 7, dtype="int64")).v.unsqueeze(0).repeat(5, 1)
+        ctx = q.var(np.random.random((5, 8, 16)).astype("float32")).v
+
+        out = m(tgt_seq, ctx)
+        refout = m(tgt_seq, ctx, tgt_pos=tgt_pos)
+        self.assertTrue(np.allclose(out.data.numpy(), refout.data.numpy(), atol=1e-6))
+
+        submask = m.get_subsequent_mask(5, ctx)
+        self.assertEqual(submask.size(), (1, 5, 5))
+        self.assertTrue(np.allclose(submask.numpy(), np.tril(np.ones((5, 5)))[None, :, :]))
+        refsubmask = -1 * q.aiayn.get_attn_subsequent_mask(tgt_seq[:, :5]) + 1
+        self.assertTrue(np.allclose(submask.numpy(), refsubmask.numpy()))
+        self.assertEqual(len(m._subsequent_masks), 1)
+        m.get_subsequent_mask(7, ctx)
+        self.assertEqual(len(m._subsequent_masks), 1)
+
+        enc = q.AYNEncoder(emb, n_max_seq=7, n_layers=2, n_head=2,
+                           d_k=4, d_v=6, d_pos_vec=6, d_model=16,
+                           d_inner_hid=20, dropout=0)
+        out = enc(tgt_seq)
+        refout = enc(tgt_seq, src_pos=tgt_pos)
+        self.assertTrue(np.allclose(out.data.numpy(), refout.data.numpy(), atol=1e-6))
@@ -139,6 +139,7 @@ class TestMultiHeadAttention(TestCase):
                               [1, 1, 1, 1, 1, 1],])).v
         V = q.var(np.random.random((5, 6, 16)).astype("float32")).v
 
+        q.record_emitted("mha", "mymha")
         outs, atts = m(Q, K, V, (-1*M+1).byte().data.unsqueeze(1).repeat(1, 2, 1))
 
         self.assertEqual(outs.size(), (5, 2, 16))
@@ -148,6 +149,7 @@ class TestMultiHeadAttention(TestCase):
 
         m_em = q.get_emitted("mha")
         mym_em = q.get_emitted("mymha")
+        q.stop_recording_emitted()
         # for k in m_em:
         #     self.assertTrue(np.allclose(m_em[k].data.numpy(), mym_em[k].data.numpy()))
 
@@ -156,3 +158,78 @@ class TestMultiHeadAttention(TestCase):
         print(outs[0])
         self.assertTrue(np.allclose(myouts.data.numpy(), outs.data.numpy(), atol=1e-7))
 
+
+    def test_fused_self_attention_equivalent_to_original(self):
+        m = OriginalMultiHeadAttention(4, 16, 10, 10, 0)
+        mym = q.MultiHeadAttention(4, 16, 10, 10, 0)
+        mym.w_qs.data = m.w_qs.permute(1,0,2).contiguous().view(16, -1).data
+        mym.w_ks.data = m.w_ks.permute(1,0,2).contiguous().view(16, -1).data
+        mym.w_vs.data = m.w_vs.permute(1,0,2).contiguous().view(16, -1).data
+        mym.proj, mym.layer_norm = m.proj, m.layer_norm
+
+        X = q.var(np.random.random((5, 6, 16)).astype("float32")).v
+        M = q.var(np.asarray([
+                              [1, 0, 0, 0, 0, 0],
+                              [1, 1, 1, 0, 0, 0],
+                              [1, 1, 1, 0, 0, 0],
+                              [1, 1, 1, 1, 0, 0],
+                              [1, 1, 1, 1, 1, 1],])).v
+        M3 = M.unsqueeze(1).repeat(1, 6, 1)
+
+        outs, atts = m(X, X, X, (-1*M3+1).byte().data)
+        for mask in [M, M3]:        # 2D and 3D masks
+            myouts, myatts = mym(X, X, X, mask)
+            self.assertEqual(myatts.size(), (20, 6, 6))
+            self.assertTrue(np.allclose(myatts.data.numpy(), atts.data.numpy(), atol=1e-6))
+            self.assertTrue(np.allclose(myouts.data.numpy(), outs.data.numpy(), atol=1e-6))
+
+        # fused key/value projection equals separate projections
+        k_s, v_s = mym.project_kv(X, X)
+        ref_k_s, = mym._project(X, mym.w_ks)
+        ref_v_s, = mym._project(X, mym.w_vs)
+        self.assertTrue(np.allclose(k_s.data.numpy(), ref_k_s.data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(v_s.data.numpy(), ref_v_s.data.numpy(), atol=1e-6))
+
+
+class TestChunkedAttention(TestCase):
+    def test_same_as_unchunked(self):
+        data = q.var(np.random.random((5, 11, 8)).astype("float32"), requires_grad=True).v
+        crit3 = q.var(np.random.random((5, 7, 8)).astype("float32")).v
+        crit2 = q.var(np.random.random((5, 8)).astype("float32")).v
+        mask2 = np.ones((5, 11), dtype="int64")
+        mask2[0, 4:] = 0
+        mask2[3, 9:] = 0
+        mask2 = q.var(mask2).v
+        mask3 = mask2.unsqueeze(1).repeat(1, 7, 1)
+        mask3.data[1, 2:, 5:] = 0
+
+        for att in [q.Attention().dot_gen().scale(8 ** 0.5), q.Attention().forward_gen(8, 8, 6)]:
+            for crit, mask in [(crit3, None), (crit3, mask2), (crit3, mask3), (crit2, mask2), (crit2, None)]:
+                att.chunked(None, None)
+                data.grad = None
+                ref = att(data, crit, mask=mask)
+                ref.sum().backward()
+                refgrad = data.grad.data.numpy() + 0
+                for chunks in [(3, 4), (None, 2), (2, None)]:
+                    att.chunked(*chunks)
+                    data.grad = None
+                    out = att(data, crit, mask=mask)
+                    self.assertEqual(out.size(), ref.size())
+                    self.assertTrue(np.allclose(out.data.numpy(), ref.data.numpy(), atol=1e-6))
+                    out.sum().backward()
+                    self.assertTrue(np.allclose(data.grad.data.numpy(), refgrad, atol=1e-5))
+
+    def test_multihead_same_as_unchunked(self):
+        mym = q.MultiHeadAttention(4, 16, 10, 10, 0)
+        X = q.var(np.random.random((5, 9, 16)).astype("float32")).v
+        M = np.ones((5, 9), dtype="int64")
+        M[1, 4:] = 0
+        M = q.var(M).v
+        causal = q.var(np.tril(np.ones((9, 9), dtype="int64"))[None, :, :]).v
+        for mask in [None, M, causal]:
+            refouts, refatts = mym(X, X, X, mask)
+            mym.chunked(4, 3)
+            outs, atts = mym(X, X, X, mask)
+            mym.attention.chunked(None, None)
+            self.assertEqual(atts, None)
+            self.assertTrue(np.allclose(outs.data.numpy(), refouts.data.numpy(), atol=1e-6))
@@ -1,6 +1,7 @@
 from __future__ import print_function
 from unittest import TestCase
-from qelos.basic import Softmax, LogSoftmax, SoftmaxLog, DotDistance, CosineDistance, ForwardDistance, BilinearDistance, TrilinearDistance, LNormDistance
+from qelos.basic import Softmax, LogSoftmax, SoftmaxLog, DotDistance, CosineDistance, ForwardDistance, BilinearDistance, TrilinearDistance, LNormDistance, \
+    IndexMask, SparseVNT
 import torch
 from torch.autograd import Variable
 import numpy as np
@@ -152,6 +153,74 @@ class TestLogsoftmax(TestCase):
         self.assertTrue(np.allclose(pred[:, 1], np.log(np.zeros_like(pred[:, 1]))))
 
 
+class TestFusedMaskedSoftmax(TestCase):
+    def test_inplace_same_as_normal(self):
+        d = np.random.random((5, 4, 6)).astype("float32")
+        m = np.ones_like(d)
+        m[:, :, 4:] = 0
+        m[2, 1, 1:] = 0
+        m = Variable(torch.FloatTensor(m))
+        for sm in [Softmax, LogSoftmax, SoftmaxLog]:
+            ref, _ = sm()(Variable(torch.FloatTensor(d)), m)
+            x = Variable(torch.FloatTensor(d))
+            pred, _ = sm().inplace()(x, m)
+            self.assertTrue(np.allclose(ref.data.numpy(), pred.data.numpy()))
+            self.assertTrue(np.allclose(x.data.numpy(), pred.data.numpy()))    # overwritten
+
+    def test_inplace_not_used_with_grad(self):
+        x = Variable(torch.FloatTensor(np.random.random((5, 6))), requires_grad=True)
+        m = np.ones((5, 6))
+        m[:, 3:] = 0
+        m = Variable(torch.FloatTensor(m))
+        pred, _ = LogSoftmax().inplace()(x, m)
+        pred[:, :3].sum().backward()
+        grad = x.grad.data.numpy()
+        self.assertFalse(np.any(np.isnan(grad)))
+        self.assertTrue(np.allclose(grad[:, 3:], 0))
+
+
+class TestIndexMask(TestCase):
+    def test_softmax_same_as_dense(self):
+        lists = [[0, 2, 3], [2, 6], [1, 2, 3, 4, 5, 6, 0], [5]]
+        msk = IndexMask.from_lists(lists, 7)
+        dense = msk.to_dense()
+        self.assertEqual(dense.size(), (4, 7))
+        self.assertEqual(msk.ids.size(), (4, 8))
+        for i, l in enumerate(lists):
+            self.assertEqual(sorted(l), list(np.argwhere(dense.data.numpy()[i] > 0)[:, 0]))
+        x = Variable(torch.randn(4, 7))
+        for sm in [Softmax(), LogSoftmax(), Softmax(temperature=2.)]:
+            pred, _ = sm(x, mask=dense)
+            ipred, _ = sm(x, mask=msk)                  # full scores
+            cpred, _ = sm(msk.gather(x), mask=msk)      # compact scores
+            pred, ipred, cpred = pred.data.numpy(), ipred.data.numpy(), cpred.data.numpy()
+            allowed = dense.data.numpy() > 0
+            self.assertTrue(np.allclose(pred[allowed], ipred[allowed], atol=1e-5))
+            self.assertTrue(np.allclose(cpred, ipred))
+            self.assertTrue(np.all(ipred[~allowed] == (-np.inf if sm._log else 0)))
+
+    def test_sparse_vnt(self):
+        import scipy.sparse as sparse
+        lists = [[[1, 2], [3], [0]], [[4], [5, 6]]]
+        csr = sparse.lil_matrix((2 * 3, 7))
+        for i, example in enumerate(lists):
+            for t, l in enumerate(example):
+                for k in l:
+                    csr[i * 3 + t, k] = 1
+        csr = csr.tocsr()
+        callable_lists = lambda t, x_t, rows: [lists[i][t] if t < len(lists[i]) else [] for i in rows]
+        for vnt in [SparseVNT(lists, 7), SparseVNT(csr, 7, seqlen=3), SparseVNT(callable_lists, 7)]:
+            x_t = Variable(torch.LongTensor([0, 0]))
+            self.assertEqual([[1, 2], [4]], [list(np.argwhere(row > 0)[:, 0])
+                                             for row in vnt.step(0, x_t).to_dense().data.numpy()])
+            self.assertEqual([[0], []], [list(np.argwhere(row > 0)[:, 0])
+                                         for row in vnt.step(2, x_t).to_dense().data.numpy()])
+            selected = vnt.index_select(0, torch.LongTensor([1, 1, 0]))
+            self.assertEqual([[5, 6], [5, 6], [3]], [list(np.argwhere(row > 0)[:, 0]) for row in
+                                                     selected.step(1, Variable(torch.LongTensor([0, 0, 0])))
+                                                         .to_dense().data.numpy()])
+
+
 class TestDistance(TestCase):
     def dorun_shape_tst_3D2D(self):
         a = Variable(torch.FloatTensor(np.random.random((5,3,4))))
@@ -171,6 +240,24 @@ class TestDistance(TestCase):
         self.m = TrilinearDistance(4, 4, 8)
         self.dorun_shape_tst_3D2D()
 
+    def dorun_prepared_tst(self):
+        a = Variable(torch.FloatTensor(np.random.random((5,3,4))))
+        b = Variable(torch.FloatTensor(np.random.random((5,6))))
+        d = self.m(a, b).data.numpy()
+        prepared = self.m.prepare(a)
+        pd = self.m.score(prepared, b).data.numpy()
+        self.assertTrue(np.allclose(d, pd, atol=1e-6))
+
+    def test_all_dist_prepared_same_as_forward(self):
+        self.m = ForwardDistance(4, 6, 8)
+        self.dorun_prepared_tst()
+        self.m = BilinearDistance(4, 6)
+        self.dorun_prepared_tst()
+        self.m = TrilinearDistance(4, 6, 8)
+        self.dorun_prepared_tst()
+        self.m = TrilinearDistance(4, 6, 8, use_bias=True)
+        self.dorun_prepared_tst()
+
     def dorun_shape_tst_2D2D(self):
         a = Variable(torch.FloatTensor(np.random.random((5,4))))
         b = Variable(torch.FloatTensor(np.random.random((5,4))))
@@ -29,6 +29,27 @@ class TestDecoder(TestCase):
         self.assertEqual(decoded.shape, (batsize, seqlen, vocsize))     # shape check
         self.assertTrue(np.allclose(np.sum(decoded, axis=-1), np.ones_like(np.sum(decoded, axis=-1))))  # prob check
 
+    def test_preallocated_and_consumer_output(self):
+        batsize, seqlen, vocsize = 5, 4, 7
+        embdim, encdim = 10, 16
+        decoder = q.DecoderCell(
+            nn.Embedding(vocsize, embdim, padding_idx=0),
+            q.GRUCell(embdim, encdim),
+            q.Forward(encdim, vocsize),
+            q.Softmax()
+        ).to_decoder()
+        data = Variable(torch.LongTensor(np.random.randint(0, vocsize, (batsize, seqlen))))
+        decoded = decoder(data)
+        predecoded = decoder.preallocate_output()(data)
+        self.assertTrue(np.allclose(decoded.data.numpy(), predecoded.data.numpy()))
+        predecoded.sum().backward()
+        consumed = []
+        ret = decoder.output_to(lambda t, y_t: consumed.append((t, y_t.data.numpy())))(data)
+        self.assertEqual(None, ret)
+        self.assertEqual(list(range(seqlen)), [t for t, _ in consumed])
+        for t, y_t in consumed:
+            self.assertTrue(np.allclose(decoded.data.numpy()[:, t], y_t))
+
     def test_context_decoder_shape(self):
         batsize, seqlen, vocsize = 5, 4, 7
         embdim, encdim, outdim, ctxdim = 10, 16, 10, 8
@@ -118,6 +139,330 @@ class TestAttentionDecoderCell(TestCase):
         print(decoded.size())
 
 
+    def test_prepared_attention_same_as_unprepared(self):
+        batsize, seqlen, inpdim = 5, 7, 8
+        vocsize, embdim, encdim = 20, 9, 10
+        for attention in [q.Attention().forward_gen(inpdim, encdim + embdim, encdim),
+                          q.Attention().bilinear_gen(inpdim, encdim + embdim),
+                          q.Attention().trilinear_gen(inpdim, encdim + embdim, encdim)]:
+            decoder = q.AttentionDecoderCell(
+                attention=attention,
+                embedder=nn.Embedding(vocsize, embdim),
+                core=q.RecStack(q.GRUCell(embdim + inpdim, encdim)),
+                smo=q.Stack(q.Forward(encdim + inpdim, vocsize), q.Softmax()),
+                decinp_to_att=True
+            ).to_decoder()
+            ctx = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, inpdim))), requires_grad=True)
+            ctxmask = np.ones((batsize, seqlen))
+            ctxmask[:, -2:] = 0
+            ctxmask = Variable(torch.FloatTensor(ctxmask))
+            inp = Variable(torch.LongTensor(np.random.randint(0, vocsize, (batsize, seqlen))))
+            o_0 = Variable(torch.FloatTensor(np.random.random((batsize, encdim))))
+            rets = []
+            for i in range(2):
+                ctx.grad = None
+                decoder.set_init_states(o_0)
+                decoded = decoder(inp, ctx, ctxmask=ctxmask)
+                decoded.sum().backward()
+                rets.append((decoded.data.numpy(), ctx.grad.data.numpy().copy()))
+                attention.attgen.prepare = lambda data: None       # no precomputed keys
+            (y, grad), (uy, ugrad) = rets
+            self.assertTrue(np.allclose(y, uy, atol=1e-6))
+            self.assertTrue(np.allclose(grad, ugrad, atol=1e-6))
+
+
+class TestParallelAttentionDecoderCell(TestCase):
+    def setUp(self):
+        self.batsize, self.seqlen, self.inpdim = 5, 7, 8
+        self.vocsize, self.embdim, self.encdim = 20, 9, 10
+        self.ctx = Variable(torch.FloatTensor(np.random.random((self.batsize, self.seqlen, self.inpdim))),
+                            requires_grad=True)
+        ctxmask = np.ones((self.batsize, self.seqlen))
+        ctxmask[:, -2:] = 0
+        self.ctxmask = Variable(torch.FloatTensor(ctxmask))
+        self.inp = Variable(torch.LongTensor(np.random.randint(0, self.vocsize, (self.batsize, self.seqlen))))
+        outmask = np.random.randint(0, 2, (self.batsize, self.seqlen, self.vocsize))
+        outmask[:, :, 0] = 1
+        self.outmask = Variable(torch.from_numpy(outmask))
+
+    def make_cell(self, **kw):
+        state_split = kw["state_split"] if "state_split" in kw else False
+        attdim = self.encdim // 2 if state_split else self.encdim
+        smodim = (self.encdim // 2 if state_split else self.encdim) + self.inpdim
+        return q.AttentionDecoderCell(
+            attention=q.Attention().forward_gen(self.inpdim, attdim + self.embdim, self.encdim),
+            embedder=nn.Embedding(self.vocsize, self.embdim),
+            core=q.RecStack(
+                q.GRUCell(self.embdim, self.encdim),
+                q.GRUCell(self.encdim, self.encdim),
+            ),
+            smo=q.Stack(
+                q.argsave.spec(mask={"mask"}),
+                q.WordLinout(smodim, worddic=dict([("w{}".format(i), i) for i in range(self.vocsize)])),
+                q.argmap.spec(0, mask=["mask"]),
+                q.LogSoftmax(),
+                q.argmap.spec(0),
+            ),
+            ctx_to_decinp=False,
+            decinp_to_att=True,
+            **kw)
+
+    def run_decoder(self, decoder, init_states):
+        self.ctx.grad = None
+        decoder.zero_grad()
+        decoder.set_init_states(*init_states)
+        y = decoder(self.inp, self.ctx, ctxmask=self.ctxmask, outmask=self.outmask)
+        y.masked_fill(self.outmask == 0, 0).sum().backward()
+        return y.data.numpy(), self.ctx.grad.data.numpy().copy(), \
+               [param.grad.data.numpy().copy() for param in decoder.parameters()]
+
+    def test_same_as_stepwise(self):
+        o_0 = Variable(torch.FloatTensor(np.random.random((self.batsize, self.encdim))))
+        for kw in [dict(att_after_update=True), dict(att_after_update=False),
+                   dict(att_after_update=False, state_split=True)]:
+            decoder = self.make_cell(**kw).to_decoder()
+            self.assertTrue(decoder.block.parallelizable)
+            y, ctxgrad, grads = self.run_decoder(decoder, [o_0])
+            sy, sctxgrad, sgrads = self.run_decoder(decoder.parallel(False), [o_0])
+            self.assertTrue(np.allclose(y[self.outmask.data.numpy() > 0], sy[self.outmask.data.numpy() > 0], atol=1e-5))
+            self.assertTrue(np.allclose(ctxgrad, sctxgrad, atol=1e-5))
+            for grad, sgrad in zip(grads, sgrads):
+                self.assertTrue(np.allclose(grad, sgrad, atol=1e-5))
+
+    def test_extra_kwargs_like_stepwise(self):
+        o_0 = Variable(torch.FloatTensor(np.random.random((self.batsize, self.encdim))))
+        decoder = self.make_cell().to_decoder()
+        ys = []
+        for parallel in [True, False]:
+            decoder.parallel(parallel)
+            decoder.set_init_states(o_0)
+            y = decoder(self.inp, self.ctx, ctxmask=self.ctxmask, outmask=self.outmask, extra=1)
+            ys.append(y.data.numpy())
+        self.assertTrue(np.allclose(ys[0][self.outmask.data.numpy() > 0], ys[1][self.outmask.data.numpy() > 0], atol=1e-5))
+
+    def test_not_parallelizable(self):
+        cell = self.make_cell()
+        cell.ctx_to_decinp = True
+        self.assertFalse(cell.parallelizable)
+        self.assertRaises(q.SumTingWongException, cell.to_layer_decoder)
+
+    def test_layer_decoder_conversion(self):
+        cell = self.make_cell(att_after_update=True)
+        h_0 = Variable(torch.FloatTensor(np.random.random((self.batsize, self.encdim))))
+        layerdecoder = cell.to_layer_decoder()
+        self.assertEqual(set(cell.parameters()), set(layerdecoder.parameters()))
+        y, ctxgrad, grads = self.run_decoder(layerdecoder, [h_0])
+        sy, sctxgrad, sgrads = self.run_decoder(cell.to_decoder().parallel(False), [None, h_0])
+        self.assertTrue(np.allclose(y[self.outmask.data.numpy() > 0], sy[self.outmask.data.numpy() > 0], atol=1e-5))
+        self.assertTrue(np.allclose(ctxgrad, sctxgrad, atol=1e-5))
+        # and back
+        backcell = layerdecoder.to_cell()
+        self.assertEqual(set(cell.parameters()), set(backcell.parameters()))
+        by, _, _ = self.run_decoder(backcell.to_decoder().parallel(False), [None, h_0])
+        self.assertTrue(np.allclose(by, sy))
+
+
+class TestCheckpointedDecoder(TestCase):
+    def test_same_as_plain(self):
+        batsize, seqlen, inpdim = 5, 7, 8
+        vocsize, embdim, encdim = 20, 9, 10
+        decoder = q.AttentionDecoderCell(
+            attention=q.Attention().forward_gen(inpdim, encdim+embdim, encdim),
+            embedder=nn.Embedding(vocsize, embdim),
+            core=q.RecStack(
+                q.GRUCell(embdim + inpdim, encdim, dropout_in=0.2, shared_dropout_rec=0.3),
+                q.GRUCell(encdim, encdim, zoneout=0.2),
+            ),
+            smo=q.Stack(
+                q.Forward(encdim+inpdim, vocsize),
+                q.Softmax()
+            ),
+            ctx_to_decinp=True,
+            ctx_to_smo=True,
+            state_to_smo=True,
+            decinp_to_att=True
+        ).to_decoder()
+        ctx = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, inpdim))), requires_grad=True)
+        ctxmask = np.ones((batsize, seqlen))
+        ctxmask[:, -2:] = 0
+        ctxmask = Variable(torch.FloatTensor(ctxmask))
+        inp = Variable(torch.LongTensor(np.random.randint(0, vocsize, (batsize, seqlen))))
+        o_0 = Variable(torch.FloatTensor(np.random.random((batsize, encdim))))
+        rets = []
+        for every in [None, 3]:
+            torch.manual_seed(1337)
+            decoder.checkpoint(every)
+            decoder.zero_grad()
+            ctx.grad = None
+            decoder.set_init_states(o_0)
+            decoded = decoder(inp, ctx, ctxmask=ctxmask)
+            (decoded * Variable(torch.FloatTensor(np.arange(vocsize)))).sum().backward()
+            rets.append((decoded.data.numpy(), ctx.grad.data.numpy().copy(),
+                         [param.grad.data.numpy().copy() for param in decoder.parameters()]))
+        (y, ctxgrad, grads), (cy, cctxgrad, cgrads) = rets
+        self.assertTrue(np.array_equal(y, cy))
+        self.assertTrue(np.allclose(ctxgrad, cctxgrad, atol=1e-6))
+        for grad, cgrad in zip(grads, cgrads):
+            self.assertTrue(np.allclose(grad, cgrad, atol=1e-6))
+
+
+class _AttentionDecoderCellSetup(TestCase):
+    def setUp(self):
+        batsize, seqlen, inpdim = 5, 7, 8
+        vocsize, embdim, encdim = 20, 9, 10
+        self.cell = q.AttentionDecoderCell(
+            attention=q.Attention().forward_gen(inpdim, encdim+embdim, encdim),
+            embedder=nn.Embedding(vocsize, embdim),
+            core=q.RecStack(
+                q.GRUCell(embdim + inpdim, encdim),
+                q.GRUCell(encdim, encdim),
+            ),
+            smo=q.Stack(
+                q.Forward(encdim+inpdim, vocsize),
+                q.LogSoftmax()
+            ),
+            ctx_to_decinp=True,
+            ctx_to_smo=True,
+            state_to_smo=True,
+            decinp_to_att=True
+        )
+        self.ctx = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, inpdim))))
+        ctxmask = np.ones((batsize, seqlen))
+        ctxmask[:, -2:] = 0
+        self.ctxmask = Variable(torch.FloatTensor(ctxmask))
+        self.o_0 = Variable(torch.FloatTensor(np.random.random((batsize, encdim))))
+        self.start = Variable(torch.LongTensor(np.ones((batsize,), dtype="int64")))
+        self.batsize, self.vocsize = batsize, vocsize
+
+    def rescore(self, seqs):
+        """ teacher-forced log-probabilities of given (batsize, seqlen) sequences """
+        decoder = self.cell.to_decoder()
+        decoder.set_init_states(self.o_0)
+        inp = torch.cat([self.start.unsqueeze(1), seqs[:, :-1]], 1)
+        logprobs = decoder(inp, self.ctx, ctxmask=self.ctxmask)
+        return torch.gather(logprobs, 2, seqs.unsqueeze(2)).squeeze(2).data.numpy()
+
+
+class TestBeamDecoder(_AttentionDecoderCellSetup):
+    def test_beamsize_one_is_greedy(self):
+        decoder = self.cell.to_beam_decoder(beamsize=1, maxtime=6)
+        decoder.set_init_states(self.o_0)
+        seqs, scores = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        self.assertEqual((self.batsize, 1, 6), seqs.size())
+        seqs = seqs[:, 0]
+        # greedy: every token is argmax given the previous ones
+        teacher = self.cell.to_decoder()
+        teacher.set_init_states(self.o_0)
+        inp = torch.cat([self.start.unsqueeze(1), seqs[:, :-1]], 1)
+        logprobs = teacher(inp, self.ctx, ctxmask=self.ctxmask)
+        _, argmaxes = torch.max(logprobs, 2)
+        self.assertTrue(np.array_equal(argmaxes.data.numpy(), seqs.data.numpy()))
+        self.assertTrue(np.allclose(scores[:, 0].data.numpy(), self.rescore(seqs).sum(1), atol=1e-5))
+
+    def test_beam_scores(self):
+        decoder = self.cell.to_beam_decoder(beamsize=4, maxtime=5)
+        decoder.set_init_states(self.o_0)
+        seqs, scores = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        self.assertEqual((self.batsize, 4, 5), seqs.size())
+        scores = scores.data.numpy()
+        self.assertTrue(np.all(scores[:, :-1] >= scores[:, 1:]))       # sorted
+        for k in range(4):
+            self.assertTrue(np.allclose(scores[:, k], self.rescore(seqs[:, k]).sum(1), atol=1e-5))
+        greedy = self.cell.to_beam_decoder(beamsize=1, maxtime=5)
+        greedy.set_init_states(self.o_0)
+        _, greedyscores = greedy(self.start, self.ctx, ctxmask=self.ctxmask)
+        self.assertTrue(np.all(scores[:, 0] >= greedyscores[:, 0].data.numpy() - 1e-5))
+
+    def test_end_symbol(self):
+        maxtime = 30
+        # make end symbol likely
+        self.cell.smo.layers[0].lin.bias.data[2] = 3.
+        decoder = self.cell.to_beam_decoder(beamsize=3, maxtime=maxtime, end_symbol=2)
+        decoder.set_init_states(self.o_0)
+        seqs, scores = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        seqs = seqs.data.numpy()
+        self.assertTrue(seqs.shape[2] < maxtime)        # stopped early
+        for seq in seqs.reshape((-1, seqs.shape[2])):
+            self.assertTrue(2 in list(seq))
+            end = list(seq).index(2)
+            self.assertTrue(np.all(seq[end+1:] == 0))
+
+
+class TestSparseVNTDecoder(TestCase):
+    def test_same_as_dense_outmask(self):
+        batsize, seqlen, inpdim = 5, 7, 8
+        vocsize, embdim, encdim = 20, 9, 10
+        worddic = dict(zip(["<MASK>"] + ["w{}".format(i) for i in range(1, vocsize)], range(vocsize)))
+        decoder = q.AttentionDecoderCell(
+            attention=q.Attention().forward_gen(inpdim, encdim + embdim, encdim),
+            embedder=nn.Embedding(vocsize, embdim),
+            core=q.RecStack(q.GRUCell(embdim + inpdim, encdim)),
+            smo=q.Stack(
+                q.argsave.spec(mask={"mask"}),
+                q.WordLinout(encdim + inpdim, worddic=worddic),
+                q.argmap.spec(0, mask=["mask"]),
+                q.LogSoftmax(),
+                q.argmap.spec(0),
+            ),
+            decinp_to_att=True
+        ).to_decoder()
+        ctx = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, inpdim))))
+        inp = Variable(torch.LongTensor(np.random.randint(0, vocsize, (batsize, seqlen))))
+        o_0 = Variable(torch.FloatTensor(np.random.random((batsize, encdim))))
+        vnt = [[list(np.random.choice(vocsize, np.random.randint(1, 6), replace=False)) for t in range(seqlen)]
+               for i in range(batsize)]
+        densevnt = np.zeros((batsize, seqlen, vocsize), dtype="int64")
+        for i in range(batsize):
+            for t in range(seqlen):
+                densevnt[i, t, vnt[i][t]] = 1
+        decoder.set_init_states(o_0)
+        pred = decoder(inp, ctx, outmask=Variable(torch.from_numpy(densevnt))).data.numpy()
+        decoder.set_init_states(o_0)
+        spred = decoder(inp, ctx, outmask=q.SparseVNT(vnt, vocsize)).data.numpy()
+        self.assertTrue(np.allclose(pred[densevnt > 0], spred[densevnt > 0], atol=1e-5))
+        self.assertTrue(np.all(spred[densevnt == 0] == -np.inf))
+        # free-running decoding only produces allowed tokens
+        greedy = decoder.block.to_greedy_decoder(maxtime=seqlen)
+        greedy.set_init_states(o_0)
+        seqs, _ = greedy(inp[:, 0], ctx, outmask=q.SparseVNT(vnt, vocsize))
+        for i in range(batsize):
+            for t in range(seqlen):
+                self.assertTrue(seqs.data.numpy()[i, t] in vnt[i][t])
+
+
+class TestGreedyDecoder(_AttentionDecoderCellSetup):
+    def test_same_as_beamsize_one(self):
+        decoder = self.cell.to_greedy_decoder(maxtime=6)
+        decoder.set_init_states(self.o_0)
+        seqs, logprobs = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        self.assertEqual((self.batsize, 6), seqs.size())
+        self.assertEqual((self.batsize, 6, self.vocsize), logprobs.size())
+        beamdecoder = self.cell.to_beam_decoder(beamsize=1, maxtime=6)
+        beamdecoder.set_init_states(self.o_0)
+        beamseqs, _ = beamdecoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        self.assertTrue(np.array_equal(beamseqs[:, 0].data.numpy(), seqs.data.numpy()))
+        self.assertTrue(np.allclose(np.exp(logprobs.data.numpy()).sum(2), 1))
+
+    def test_end_symbol(self):
+        maxtime = 30
+        self.cell.smo.layers[0].lin.bias.data[2] = 3.
+        decoder = self.cell.to_greedy_decoder(maxtime=maxtime)
+        decoder.set_init_states(self.o_0)
+        fullseqs, fulllogprobs = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        decoder.end_symbol = 2
+        decoder.set_init_states(self.o_0)
+        seqs, logprobs = decoder(self.start, self.ctx, ctxmask=self.ctxmask)
+        seqs, logprobs = seqs.data.numpy(), logprobs.data.numpy()
+        fullseqs, fulllogprobs = fullseqs.data.numpy(), fulllogprobs.data.numpy()
+        self.assertTrue(seqs.shape[1] < maxtime)        # stopped early
+        for i in range(self.batsize):
+            end = list(fullseqs[i]).index(2)
+            self.assertTrue(np.array_equal(fullseqs[i, :end+1], seqs[i, :end+1]))
+            self.assertTrue(np.all(seqs[i, end+1:] == 0))
+            self.assertTrue(np.allclose(fulllogprobs[i, :end+1], logprobs[i, :end+1], atol=1e-6))
+            self.assertTrue(np.all(logprobs[i, end+1:] == 0))
+
+
 class TestAttentionDecoder(TestCase):
     def test_shapes(self):
         batsize, seqlen, inpdim = 5, 7, 8
@@ -0,0 +1,97 @@
+from unittest import TestCase
+import qelos as q
+import numpy as np
+import torch
+from torch import nn
+from torch.autograd import Variable
+
+
+class TestExport(TestCase):
+    def test_stack_same_as_eager(self):
+        if not hasattr(torch, "jit"):
+            return
+        a, b = q.Forward(5, 5), q.Forward(10, 7)
+        stack = q.Stack(
+            q.Lambda(lambda x, mask=None: x * mask),
+            q.argsave.spec(a=0),
+            q.Lambda(lambda x, mask=None: a(x), register_modules=a),
+            q.argmap.spec(0, ["a"]),
+            q.Lambda(lambda x, y, mask=None: b(torch.cat([x, y], 1)), register_modules=b),
+        )
+        data = q.var(np.random.random((3, 5)).astype("float32")).v
+        mask = q.var(np.random.randint(0, 2, (3, 5)).astype("float32")).v
+        exported = q.export(stack, data, mask=mask)
+        self.assertEqual(stack._saved_slots, {})
+        for batsize in [3, 6]:
+            data = q.var(np.random.random((batsize, 5)).astype("float32")).v
+            mask = q.var(np.random.randint(0, 2, (batsize, 5)).astype("float32")).v
+            out = exported(data, mask=mask)
+            ref = stack(data, mask=mask)
+            self.assertEqual(out.size(), (batsize, 7))
+            self.assertTrue(np.allclose(out.data.numpy(), ref.data.numpy(), atol=1e-6))
+
+    def test_encoder_same_as_eager_without_emits(self):
+        if not hasattr(torch, "jit"):
+            return
+        embedder = nn.Embedding(17, 10, padding_idx=0)
+        emb = q.Lambda(lambda x: (embedder(x), (x != 0).float()), register_modules=embedder)   # masking embedder
+        m = q.AYNEncoder(emb, n_max_seq=7, n_layers=2, n_head=2,
+                         d_k=4, d_v=6, d_pos_vec=6, d_model=16,
+                         d_inner_hid=20, dropout=0)
+        rec = q.subscribe(q.EmitRecorder(), "mymha")
+        src_seq = q.var(np.random.randint(1, 17, (5, 7))).v
+        src_seq.data[1, 4:] = 0
+        exported = q.export(m, src_seq)
+        self.assertFalse("mymha" in rec)
+        src_seq = q.var(np.random.randint(1, 17, (4, 7))).v
+        src_seq.data[0, 5:] = 0
+        src_seq.data[2, 2:] = 0
+        out = exported(src_seq)
+        ref = m(src_seq)
+        self.assertTrue("mymha" in rec)
+        q.unsubscribe(rec)
+        self.assertTrue(np.allclose(out.data.numpy(), ref.data.numpy(), atol=1e-5))
+
+    def test_decoder_cell_step_same_as_eager(self):
+        if not hasattr(torch, "jit"):
+            return
+        batsize, seqlen, inpdim = 5, 7, 8
+        vocsize, embdim, encdim = 20, 9, 10
+        cell = q.AttentionDecoderCell(
+            attention=q.Attention().forward_gen(inpdim, encdim+embdim, encdim),
+            embedder=nn.Embedding(vocsize, embdim),
+            core=q.RecStack(
+                q.GRUCell(embdim + inpdim, encdim),
+                q.GRUCell(encdim, encdim),
+            ),
+            smo=q.Stack(
+                q.Forward(encdim+inpdim, vocsize),
+                q.LogSoftmax()
+            ),
+            ctx_to_decinp=True,
+            ctx_to_smo=True,
+            state_to_smo=True,
+            decinp_to_att=True
+        )
+        ctx = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, inpdim))))
+        ctxmask = np.ones((batsize, seqlen))
+        ctxmask[:, -2:] = 0
+        ctxmask = Variable(torch.FloatTensor(ctxmask))
+        o_0 = Variable(torch.FloatTensor(np.random.random((batsize, encdim))))
+        x = Variable(torch.LongTensor(np.random.randint(0, vocsize, (batsize, 4))))
+
+        cell.reset_state()
+        cell.set_init_states(o_0)
+        exported = q.export(cell, (x[:, 0], ctx), ctxmask=ctxmask)
+
+        refs = []
+        cell.reset_state()
+        for t in range(x.size(1)):
+            refs.append(cell(x[:, t], ctx, ctxmask=ctxmask).data.numpy())
+
+        exported.reset_state()
+        for t in range(x.size(1)):
+            out = exported(x[:, t], ctx, ctxmask=ctxmask)
+            self.assertEqual(out.size(), (batsize, vocsize))
+            self.assertTrue(np.allclose(out.data.numpy(), refs[t], atol=1e-5))
+        self.assertEqual(len(exported.get_states()), 3)     # o_tm1 and two GRU states
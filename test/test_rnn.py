@@ -182,6 +182,77 @@ class TestSRU(TestCase):
         self.assertEqual((5, 10), y_t.data.numpy().shape)
 
 
+class TestInitStates(TestCase):
+    def test_cached_zeros(self):
+        cell = q.LSTMCell(9, 10)
+        a = cell.get_init_states(5)
+        self.assertEqual((5, 10), a[0].size())
+        self.assertTrue(np.allclose(a[1].data.numpy(), 0))
+        b = cell.get_init_states(5)
+        self.assertTrue(a[0] is b[0] and a[1] is b[1])
+        self.assertFalse(a[0] is cell.get_init_states(4)[0])
+        cell.double()
+        self.assertFalse(a[0] is cell.get_init_states(5)[0])
+
+    def test_cache_bounded_over_batch_sizes(self):
+        cell = q.LSTMCell(9, 10)
+        for batsize in [5, 3, 8, 2, 7]:
+            a = cell.get_init_states(batsize)
+            self.assertEqual((batsize, 10), a[0].size())
+            self.assertTrue(np.allclose(a[0].data.numpy(), 0))
+        self.assertEqual(len(cell._init_states_cache), cell.numstates)     # one (largest) zero state each
+        self.assertTrue(cell.get_init_states(8)[0] is cell.get_init_states(8)[0])
+        cell.set_init_states(Variable(torch.FloatTensor(np.random.random((10,)))))
+        for batsize in [5, 3, 8]:
+            self.assertEqual((batsize, 10), cell.get_init_states(batsize)[0].size())
+        self.assertEqual(len(cell._init_states_cache), cell.numstates)
+
+    def test_invalidated_by_set_init_states(self):
+        cell = q.GRUCell(9, 10)
+        a = cell.get_init_states(5)[0]
+        h_0 = Variable(torch.FloatTensor(np.random.random((10,))))
+        cell.set_init_states(h_0)
+        b = cell.get_init_states(5)[0]
+        self.assertEqual((5, 10), b.size())
+        self.assertTrue(np.allclose(b.data.numpy(), h_0.data.numpy()[None, :]))
+        self.assertTrue(cell.get_init_states(5)[0] is b)
+        self.assertTrue(np.allclose(cell.h_0.data.numpy(), h_0.data.numpy()))
+
+
+class TestSRULayer(TestCase):
+    def test_same_as_sru_cell(self):
+        batsize, seqlen, dim = 3, 9, 10
+        cell = q.SRUCell(dim)
+        layer = q.SRULayer(dim).return_final().return_all()
+        layer.load_state_dict(cell.state_dict())
+        celllayer = cell.to_layer().return_final().return_all()
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, dim))))
+        m_val = np.ones((batsize, seqlen))
+        m_val[0, 5:] = 0
+        m_val[1, 1:] = 0
+        m = Variable(torch.FloatTensor(m_val))
+        c_0 = Variable(torch.FloatTensor(np.random.random((batsize, dim))))
+        cell_y_t, cell_y = celllayer(x, mask=m, init_states=c_0)
+        y_t, y = layer(x, mask=m, init_states=c_0)
+        self.assertTrue(np.allclose(cell_y.data.numpy(), y.data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(cell_y_t.data.numpy(), y_t.data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(cell.get_states(0)[0].data.numpy(), layer.get_states(0)[0].data.numpy(), atol=1e-6))
+
+    def test_dropouts(self):
+        batsize, seqlen, dim = 3, 5, 10
+        layer = q.SRULayer(dim, dropout_in=0.2, dropout_rec=0.2, zoneout=0.2,
+                           shared_dropout_rec=0.2, shared_zoneout=0.2)
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, dim))))
+        y = layer(x)
+        self.assertEqual((batsize, seqlen, dim), y.size())
+        y.sum().backward()
+        self.assertTrue(layer.nncell.gates.W.grad is not None)
+        layer.eval()
+        pred1 = layer(x)
+        pred2 = layer(x)
+        self.assertTrue(np.allclose(pred1.data.numpy(), pred2.data.numpy()))
+
+
 class Test_RNNLayer(TestCase):
     def test_lstm_layer_shapes(self):
         batsize = 5
@@ -248,6 +319,246 @@ class Test_RNNLayer(TestCase):
         # TODO write assertions
 
 
+class TestFusedBiRNNLayer(TestCase):
+    def dorun_same_as_unfused(self, cell1, cell2, mode="cat", mask=True):
+        batsize, seqlen = 4, 5
+        layer = q.BiRNNLayer(cell1, cell2, mode=mode).return_final().return_all()
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))))
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0, 0], [1, 0, 0, 0, 0], [1, 1, 1, 1, 1], [1, 1, 1, 1, 0]]))) \
+            if mask else None
+        init_states = [Variable(torch.FloatTensor(np.random.random((batsize, statedim))))
+                       for statedim in cell1.state_spec + cell2.state_spec]
+        self.assertTrue(layer._fusable)
+        rets = []
+        for fused in [False, True]:
+            y_t, y = layer.fused(fused)(x, mask=m, init_states=init_states)
+            states = [state.data.numpy() for state in cell1.get_states(batsize) + cell2.get_states(batsize)]
+            rets.append((y_t.data.numpy(), y.data.numpy(), states))
+        (y_t, y, states), (fy_t, fy, fstates) = rets
+        self.assertTrue(np.allclose(y_t, fy_t, atol=1e-6))
+        self.assertTrue(np.allclose(y, fy, atol=1e-6))
+        for state, fstate in zip(states, fstates):
+            self.assertTrue(np.allclose(state, fstate, atol=1e-6))
+
+    def test_gru(self):
+        self.dorun_same_as_unfused(q.GRUCell(9, 6), q.GRUCell(9, 6))
+        self.dorun_same_as_unfused(q.GRUCell(9, 6), q.GRUCell(9, 6), mode="sum", mask=False)
+
+    def test_lstm(self):
+        self.dorun_same_as_unfused(q.LSTMCell(9, 6), q.LSTMCell(9, 6))
+
+    def test_single_returns_same_as_unfused(self):
+        x = Variable(torch.FloatTensor(np.random.random((4, 5, 9))))
+        for returns in ["final", "all"]:
+            layer = q.BiRNNLayer(q.GRUCell(9, 6), q.GRUCell(9, 6))
+            layer = layer.return_final() if returns == "final" else layer.return_all()
+            y = layer.fused(False)(x)
+            fy = layer.fused(True)(x)
+            self.assertEqual(y.size(), (4, 12) if returns == "final" else (4, 5, 12))
+            self.assertTrue(np.allclose(y.data.numpy(), fy.data.numpy(), atol=1e-6))
+
+    def test_not_fusable_return_final(self):
+        x = Variable(torch.FloatTensor(np.random.random((4, 5, 9))))
+        layer = q.BiRNNLayer(q.GRUCell(9, 6, zoneout=0.2), q.GRUCell(9, 6)).return_final()
+        self.assertEqual(layer(x).size(), (4, 12))
+        layer = q.BiRNNLayer(q.GRUCell(9, 6), q.LSTMCell(9, 6), mode="sum").return_final()
+        self.assertEqual(layer(x).size(), (4, 6))
+
+    def test_not_fusable(self):
+        layer = q.BiRNNLayer(q.GRUCell(9, 6, zoneout=0.2), q.GRUCell(9, 6))
+        self.assertFalse(layer._fusable)
+        layer = q.BiRNNLayer(q.GRUCell(9, 6), q.LSTMCell(9, 6))
+        self.assertFalse(layer._fusable)
+
+
+class TestFusedBidirLayer(TestCase):
+    def dorun_same_as_unfused(self, m):
+        batsize, seqlen, indim = 5, 3, 4
+        data = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, indim))))
+        mask = Variable(torch.LongTensor([[1, 1, 0], [1, 1, 0], [1, 1, 0], [1, 1, 1], [1, 0, 0], ]))
+        for mask_e in [mask, None]:
+            rets = []
+            for fused in [False, True]:
+                final, pred = m.fused(fused)(data, mask=mask_e)
+                states = [state.data.numpy() for state in m.layer_fwd.get_states(0) + m.layer_rev.get_states(0)]
+                rets.append((final.data.numpy(), pred.data.numpy(), states))
+            (final, pred, states), (ffinal, fpred, fstates) = rets
+            self.assertTrue(np.allclose(final, ffinal, atol=1e-6))
+            self.assertTrue(np.allclose(pred, fpred, atol=1e-6))
+            for state, fstate in zip(states, fstates):
+                self.assertTrue(np.allclose(state, fstate, atol=1e-6))
+
+    def test_gru(self):
+        self.dorun_same_as_unfused(q.BidirGRULayer(4, 6).return_final())
+
+    def test_lstm(self):
+        self.dorun_same_as_unfused(q.BidirLSTMLayer(4, 6).return_final())
+
+
+class TestHoistedRNNLayer(TestCase):
+    def dorun_same_as_unhoisted(self, cell, indim):
+        batsize, seqlen = 3, 4
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, indim))))
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0], [1, 0, 0, 0], [1, 1, 1, 1]])))
+        layer = cell.to_layer().return_final().return_all()
+        y_t, y = layer(x, mask=m)
+        layer.hoist_inputs()
+        hy_t, hy = layer(x, mask=m)
+        self.assertTrue(np.allclose(y.data.numpy(), hy.data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(y_t.data.numpy(), hy_t.data.numpy(), atol=1e-6))
+        hy.sum().backward()
+
+    def test_gru(self):
+        self.dorun_same_as_unhoisted(q.GRUCell(9, 10), 9)
+
+    def test_gru_non_cudnn(self):
+        self.dorun_same_as_unhoisted(q.GRUCell(9, 10, use_cudnn_cell=False), 9)
+
+    def test_lstm(self):
+        self.dorun_same_as_unhoisted(q.LSTMCell(9, 10), 9)
+
+    def test_lstm_non_cudnn(self):
+        self.dorun_same_as_unhoisted(q.LSTMCell(9, 10, use_cudnn_cell=False), 9)
+
+    def test_sru(self):
+        self.dorun_same_as_unhoisted(q.SRUCell(10), 10)
+
+
+class TestEarlyExitRNNLayer(TestCase):
+    def dorun_same_as_masked(self, cell, indim, reverse=False, hoist=False):
+        batsize, seqlen = 5, 4
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, indim))))
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0], [1, 0, 0, 0], [1, 1, 1, 1], [0, 0, 0, 0], [1, 1, 0, 0]])))
+        init_states = [Variable(torch.FloatTensor(np.random.random((batsize, statedim))))
+                       for statedim in cell.state_spec]
+        cell.set_init_states(*init_states)
+        layer = cell.to_layer().return_final().return_all().hoist_inputs(hoist)
+        layer.early_exit(False)
+        y_t, y = layer(x, mask=m, reverse=reverse)
+        states = [state.data.numpy() for state in cell.get_states(batsize)]
+        layer.early_exit()
+        ey_t, ey = layer(x, mask=m, reverse=reverse)
+        estates = [state.data.numpy() for state in cell.get_states(batsize)]
+        self.assertTrue(np.allclose(y.data.numpy(), ey.data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(y_t.data.numpy(), ey_t.data.numpy(), atol=1e-6))
+        for state, estate in zip(states, estates):
+            self.assertTrue(np.allclose(state, estate, atol=1e-6))
+        ey.sum().backward()
+
+    def test_gru(self):
+        self.dorun_same_as_masked(q.GRUCell(9, 10), 9)
+
+    def test_gru_reverse(self):
+        self.dorun_same_as_masked(q.GRUCell(9, 10), 9, reverse=True)
+
+    def test_gru_hoisted(self):
+        self.dorun_same_as_masked(q.GRUCell(9, 10), 9, hoist=True)
+        self.dorun_same_as_masked(q.GRUCell(9, 10), 9, reverse=True, hoist=True)
+
+    def test_lstm(self):
+        self.dorun_same_as_masked(q.LSTMCell(9, 10, use_cudnn_cell=False), 9)
+
+    def test_stack(self):
+        self.dorun_same_as_masked(q.RecStack(q.GRUCell(9, 10), q.LSTMCell(10, 11)), 9)
+
+    def test_shared_dropouts(self):
+        cell = q.GRUCell(9, 10, shared_dropout_rec=0.3, shared_zoneout=0.3, zoneout=0.2)
+        layer = cell.to_layer().return_final().return_all()
+        x = Variable(torch.FloatTensor(np.random.random((3, 4, 9))))
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0], [1, 0, 0, 0], [1, 1, 1, 1]])))
+        y_t, y = layer(x, mask=m)
+        self.assertEqual((3, 4, 10), y.size())
+        self.assertTrue(np.allclose(y_t.data.numpy(), y.data.numpy()[:, -1]))
+
+
+class TestRNNLayerOutputs(TestCase):
+    def test_preallocated_and_consumer(self):
+        batsize, seqlen = 3, 4
+        layer = q.GRUCell(9, 10).to_layer().return_final().return_all()
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))))
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0], [1, 0, 0, 0], [1, 1, 1, 1]])))
+        for reverse in [False, True]:
+            y_t, y = layer.preallocate_output(False)(x, mask=m, reverse=reverse)
+            py_t, py = layer.preallocate_output()(x, mask=m, reverse=reverse)
+            self.assertTrue(np.allclose(y.data.numpy(), py.data.numpy(), atol=1e-6))
+            self.assertTrue(np.allclose(y_t.data.numpy(), py_t.data.numpy(), atol=1e-6))
+            py.sum().backward()
+            consumed = {}
+            def consumer(t, y_t):
+                consumed[t] = y_t.data.numpy()
+            cy_t = layer.preallocate_output(False).output_to(consumer)(x, mask=m, reverse=reverse)
+            layer.output_to(None)
+            self.assertTrue(np.allclose(y_t.data.numpy(), cy_t.data.numpy(), atol=1e-6))
+            for t in range(seqlen):
+                self.assertTrue(np.allclose(y.data.numpy()[:, t], consumed[t], atol=1e-6))
+
+
+class TestCheckpointedRNNLayer(TestCase):
+    def dorun_same_as_plain(self, cell, mask=True, reverse=False):
+        batsize, seqlen = 3, 7
+        layer = cell.to_layer().return_final().return_all().early_exit(False)
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))), requires_grad=True)
+        m = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0, 0], [1] * 7]))) \
+            if mask else None
+        rets = []
+        for every in [None, 3]:
+            torch.manual_seed(1337)
+            layer.checkpoint(every)
+            cell.zero_grad()
+            x.grad = None
+            y_t, y = layer(x, mask=m, reverse=reverse)
+            (y.sum() + y_t.sum()).backward()
+            grads = [param.grad.data.numpy().copy() for param in cell.parameters()]
+            rets.append((y.data.numpy(), y_t.data.numpy(), grads, x.grad.data.numpy().copy()))
+        (y, y_t, grads, xgrad), (cy, cy_t, cgrads, cxgrad) = rets
+        self.assertTrue(np.array_equal(y, cy))
+        self.assertTrue(np.array_equal(y_t, cy_t))
+        self.assertTrue(np.allclose(xgrad, cxgrad, atol=1e-6))
+        for grad, cgrad in zip(grads, cgrads):
+            self.assertTrue(np.allclose(grad, cgrad, atol=1e-6))
+
+    def test_gru(self):
+        self.dorun_same_as_plain(q.GRUCell(9, 10))
+        self.dorun_same_as_plain(q.GRUCell(9, 10), mask=False, reverse=True)
+
+    def test_gru_dropouts(self):
+        self.dorun_same_as_plain(q.GRUCell(9, 10, dropout_in=0.2, dropout_rec=0.2, zoneout=0.2,
+                                           shared_dropout_rec=0.3, shared_zoneout=0.3))
+
+    def test_stack(self):
+        self.dorun_same_as_plain(q.RecStack(q.GRUCell(9, 10, shared_dropout_rec=0.3),
+                                            q.LSTMCell(10, 11, zoneout=0.2, use_cudnn_cell=False)))
+
+
+class TestStatefulRNNLayer(TestCase):
+    def test_chunks_same_as_whole(self):
+        batsize, seqlen = 3, 8
+        m = q.RecStack(q.GRUCell(9, 10), q.LSTMCell(10, 11)).to_layer().return_final().return_all()
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))))
+        y_t, y = m(x)
+        m.stateful()
+        m.reset_state()
+        cy_t, cy = m(x[:, :3])
+        states = m.get_states(batsize)
+        self.assertEqual(3, len(states))
+        cy_t_2, cy_2 = m(x[:, 3:])
+        self.assertTrue(np.allclose(y.data.numpy(), torch.cat([cy, cy_2], 1).data.numpy(), atol=1e-6))
+        self.assertTrue(np.allclose(y_t.data.numpy(), cy_t_2.data.numpy(), atol=1e-6))
+        # continue from exported states
+        m.reset_state()
+        m.set_states(*states)
+        ey_t, ey = m(x[:, 3:])
+        self.assertTrue(np.allclose(cy_2.data.numpy(), ey.data.numpy(), atol=1e-6))
+
+    def test_truncated_bptt(self):
+        batsize, seqlen = 3, 8
+        m = q.GRUCell(9, 10).to_layer().stateful(detach=True)
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))))
+        m.reset_state()
+        m(x[:, :4]).sum().backward()
+        m(x[:, 4:]).sum().backward()     # would fail if graph of first chunk was still attached
+
+
 class TestRecStack(TestCase):
     def test_shapes(self):
         batsize = 5
@@ -259,6 +570,34 @@ class TestRecStack(TestCase):
         y_t = m(x_t)
         self.assertEqual((batsize, 11), y_t.data.numpy().shape)
 
+    def test_layerwise_same_as_stepwise(self):
+        batsize, seqlen = 4, 5
+        stack = q.RecStack(q.GRUCell(9, 10), q.LSTMCell(10, 11), q.GRUCell(11, 7, use_cudnn_cell=False))
+        init_states = [Variable(torch.FloatTensor(np.random.random((batsize, statedim))))
+                       for statedim in stack.state_spec]
+        stack.set_init_states(*init_states)
+        m = stack.to_layer().return_final().return_all()
+        self.assertTrue(m._layerwise_cells is not None)
+        x = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, 9))))
+        mask = Variable(torch.FloatTensor(np.asarray([[1, 1, 1, 0, 0], [1, 0, 0, 0, 0], [1] * 5, [1, 1, 1, 1, 0]])))
+        for mask_e, reverse in [(None, False), (mask, False), (mask, True)]:
+            rets = []
+            for layerwise in [False, True]:
+                y_t, y = m.layerwise(layerwise)(x, mask=mask_e, reverse=reverse)
+                states = [state.data.numpy() for state in stack.get_states(batsize)]
+                rets.append((y_t.data.numpy(), y.data.numpy(), states))
+            (y_t, y, states), (ly_t, ly, lstates) = rets
+            self.assertTrue(np.allclose(y_t, ly_t, atol=1e-6))
+            self.assertTrue(np.allclose(y, ly, atol=1e-6))
+            for state, lstate in zip(states, lstates):
+                self.assertTrue(np.allclose(state, lstate, atol=1e-6))
+
+    def test_layerwise_fallback(self):
+        m = q.RecStack(q.GRUCell(9, 10), q.Forward(10, 10)).to_layer()
+        self.assertTrue(m._layerwise_cells is None)
+        y = m(Variable(torch.FloatTensor(np.random.random((3, 4, 9)))))
+        self.assertEqual((3, 4, 10), y.size())
+
     def test_masked_gru_stack(self):
         batsize = 3
         seqlen = 4
@@ -355,6 +694,35 @@ class TestGRULayer(TestCase):
         self.assertTrue(np.allclose(final[3, 6:], pred[3, 0, 6:]))
 
 
+    def test_mask_packed_same_as_unpadded(self):
+        batsize, seqlen, indim = 5, 4, 3
+        m = q.GRULayer(indim, 6).return_final()
+        data = Variable(torch.FloatTensor(np.random.random((batsize, seqlen, indim))))
+        mask_val = np.asarray([[1, 1, 0, 0], [1, 1, 1, 0], [1, 1, 1, 1], [1, 0, 0, 0], [1, 1, 0, 0]])
+        mask = Variable(torch.LongTensor(mask_val))
+        final, pred = m(data, mask=mask)
+        states = m.get_states(0)[0].data.numpy()
+        for i in range(batsize):
+            l = mask_val[i].sum()
+            exp_final, exp_pred = m(data[i:i+1, :l])
+            self.assertTrue(np.allclose(exp_pred.data.numpy()[0], pred.data.numpy()[i, :l], atol=1e-6))
+            self.assertTrue(np.allclose(exp_final.data.numpy()[0], final.data.numpy()[i], atol=1e-6))
+            self.assertTrue(np.allclose(exp_final.data.numpy()[0], states[i], atol=1e-6))
+        self.assertTrue(np.allclose(pred.data.numpy()[3, 1:, :], 0))
+
+
+class TestSeqPack(TestCase):
+    def test_pack_unpack(self):
+        x = Variable(torch.FloatTensor(np.random.random((4, 5, 3))))
+        mask_val = np.asarray([[1, 1, 0, 0, 0], [1, 1, 1, 0, 0], [1, 1, 1, 1, 0], [1, 0, 0, 0, 0]])
+        mask = Variable(torch.LongTensor(mask_val))
+        packed, unsorter = q.seq_pack(x, mask)
+        y, ymask = q.seq_unpack(packed, unsorter)
+        self.assertEqual((4, 4, 3), y.size())
+        self.assertTrue(np.allclose(mask_val[:, :4], ymask.data.numpy()))
+        self.assertTrue(np.allclose((x[:, :4] * mask[:, :4].float().unsqueeze(2)).data.numpy(), y.data.numpy()))
+
+
 class TestLSTMLayer(TestCase):
     def test_shapes(self):
         batsize, seqlen, indim = 5, 3, 4
@@ -50,3 +50,43 @@ class TestStack(TestCase):
                 forwards.append(layer)
 
         self.assertEqual(len(forwards), nlayers * 2)
+
+    def test_compiled_plan_routing(self):
+        data = q.var(np.random.random((3, 5)).astype(dtype="float32")).v
+        mask = q.var(np.random.random((3, 5)).astype(dtype="float32")).v
+        a, b = q.Forward(5, 5), q.Forward(5, 5)
+        stack = q.Stack(
+            q.Lambda(lambda x, mask=None: a(x), register_modules=a),
+            q.argsave.spec(a=0, m={"mask"}),
+            q.argmap.spec(0, y=["m"]),
+            q.Lambda(lambda x, y=None, mask=None: (x * y, x + mask)),
+            q.argmap(lambda args, kwargs, slots: ([args[1], slots["a"]], {})),
+            q.Lambda(lambda x, z, mask=None: x - z),
+        )
+        out = stack(data, mask=mask)
+        h = a(data)
+        expected = h + mask - h
+        self.assertTrue(np.allclose(out.data.numpy(), expected.data.numpy()))
+        self.assertEqual(len(stack._plan[0]), 6)
+
+        # adding layers recompiles
+        stack.add(q.Lambda(lambda x, mask=None: b(x), register_modules=b))
+        out = stack(data, mask=mask)
+        self.assertEqual(len(stack._plan[0]), 7)
+        self.assertTrue(np.allclose(out.data.numpy(), b(expected).data.numpy()))
+
+    def test_trace(self):
+        if not hasattr(torch, "jit"):
+            return
+        data = q.var(np.random.random((3, 5)).astype(dtype="float32")).v
+        stack = q.Stack(
+            q.Forward(5, 5),
+            q.argsave.spec(a=0),
+            q.Forward(5, 5),
+            q.argmap.spec(0, ["a"]),
+            q.Lambda(lambda x, y: torch.cat([x, y], 1)),
+            q.Forward(10, 7)
+            )
+        traced = stack.trace(data)
+        newdata = q.var(np.random.random((4, 5)).astype(dtype="float32")).v
+        self.assertTrue(np.allclose(traced(newdata).data.numpy(), stack(newdata).data.numpy()))
@@ -48,3 +48,92 @@ class TestTensorDataset(TestCase):
                 batch = next(dl_iter)[0].numpy()
                 batches.append(batch)
         self.assertRaises(StopIteration, fn)
+
+
+class TestDataload(TestCase):
+    def setUp(self):
+        self.lens = np.random.randint(1, 20, (100,))
+        self.x = np.zeros((100, 25), dtype="int64")
+        self.vnt = np.zeros((100, 26, 7), dtype="int32")
+        for i, l in enumerate(self.lens):
+            self.x[i, :l] = np.random.randint(1, 10, (l,))
+            self.vnt[i, :l+1, np.random.randint(0, 7)] = 1
+        self.y = np.arange(100)
+
+    def test_plain(self):
+        dl = q.dataload(self.x, self.y, batch_size=10)
+        self.assertTrue(isinstance(dl, DataLoader))
+        ys = np.concatenate([batch[1].numpy() for batch in dl])
+        self.assertEqual(set(range(100)), set(ys))
+
+    def test_seq_lengths(self):
+        self.assertTrue(np.all(q.seq_lengths(self.x) == self.lens))
+        self.assertTrue(np.all(q.seq_lengths(torch.from_numpy(self.vnt)) == self.lens + 1))
+
+    def test_bucket_and_trim(self):
+        dl = q.dataload(self.x, self.vnt, self.y, batch_size=10, bucket=0, trim=[0, 1], poolsize=None)
+        epochs = []
+        for epoch in range(2):
+            ys = []
+            for x, vnt, y in dl:
+                y = y.numpy()
+                ys.append(y)
+                lens = self.lens[y]
+                self.assertEqual(x.size(1), lens.max())
+                self.assertEqual(vnt.size(1), lens.max() + 1)
+                self.assertTrue(np.all(x.numpy() == self.x[y, :lens.max()]))
+                self.assertTrue(np.all(vnt.numpy() == self.vnt[y, :lens.max() + 1]))
+            ys = np.concatenate(ys)
+            self.assertEqual(sorted(ys), list(range(100)))
+            # batches are consecutive in sorted lengths when sorting all examples at once
+            sortedlens = np.sort(self.lens)[::-1]
+            for i in range(0, 100, 10):
+                self.assertTrue(sorted(self.lens[ys[i:i+10]]) in
+                                [sorted(sortedlens[j:j+10]) for j in range(0, 100, 10)])
+            epochs.append(ys)
+        self.assertFalse(np.all(epochs[0] == epochs[1]))       # reshuffled
+
+    def test_trim_group(self):
+        dl = q.dataload(self.x, self.vnt, self.y, batch_size=10, bucket=0, trim=[(0, 1)])
+        for x, vnt, y in dl:
+            maxlen = self.lens[y.numpy()].max() + 1       # vnt is one step longer
+            self.assertEqual(x.size(1), maxlen)
+            self.assertEqual(vnt.size(1), maxlen)
+            self.assertTrue(np.all(x.numpy() == self.x[y.numpy(), :maxlen]))
+
+    def test_token_budget(self):
+        dl = q.dataload(self.x, self.vnt, self.y, bucket=0, trim=True, max_tokens=60)
+        ys = []
+        for x, vnt, y in dl:
+            ys.append(y.numpy())
+            self.assertTrue(x.size(0) * x.size(1) <= 60 or x.size(0) == 1)
+        self.assertEqual(sorted(np.concatenate(ys)), list(range(100)))
+        sizes = [len(y) for y in ys]
+        self.assertTrue(max(sizes) > min(sizes))        # short sequences in bigger batches
+
+    def test_token_budget_len_matches_epoch(self):
+        sampler = q.BucketSampler(self.lens, batch_size=None, max_tokens=60, poolsize=2)
+        for epoch in range(5):
+            numbatches = len(sampler)
+            self.assertEqual(numbatches, len(sampler))
+            self.assertEqual(numbatches, len(list(sampler)))
+
+
+class TestInferenceBatcher(TestCase):
+    def test_decoder_in_order(self):
+        vocsize, embdim, encdim = 7, 5, 6
+        decoder = q.DecoderCell(
+            torch.nn.Embedding(vocsize, embdim, padding_idx=0),
+            q.GRUCell(embdim, encdim),
+            q.Forward(encdim, vocsize),
+            q.Softmax()
+        ).to_decoder()
+        decoder.eval()
+        examples = [np.random.randint(1, vocsize, (np.random.randint(1, 10),)) for i in range(23)]
+        batcher = q.InferenceBatcher(decoder, batch_size=4, max_tokens=20, window=10, trim=True)
+        results = list(batcher(example for example in examples))
+        self.assertEqual(len(examples), len(results))
+        for example, result in zip(examples, results):
+            single = decoder(q.var(example[np.newaxis]).v).data.numpy()[0]
+            self.assertEqual(single.shape, result.shape)
+            self.assertTrue(np.allclose(single, result, atol=1e-6))
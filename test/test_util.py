@@ -0,0 +1,63 @@
+from unittest import TestCase
+import threading
+import qelos as q
+import numpy as np
+import torch
+
+
+class TestEmit(TestCase):
+    def test_noop_without_subscribers(self):
+        x = q.var(np.random.random((3, 4)).astype("float32")).v
+        self.assertFalse(q.emitting("x"))
+        q.emit("x", x)
+        self.assertEqual(q.util.EmitHooks.subscribers, {})
+        self.assertRaises(KeyError, q.get_emitted, "x")
+
+    def test_recorders(self):
+        x = q.var(np.random.random((3, 4)).astype("float32")).v
+        last = q.subscribe(q.EmitRecorder(), "x")
+        shapes = q.subscribe(q.ShapeRecorder(keep="all"), "x", "y")
+        stats = q.subscribe(q.StatsRecorder())
+        q.emit("x", {"a": x, "b": [x, 1]})
+        q.emit("y", x[:2])
+        self.assertTrue(last["x"]["a"] is x)
+        self.assertFalse("y" in last)
+        self.assertEqual(shapes["x"], [{"a": (3, 4), "b": [(3, 4), 1]}])
+        self.assertEqual(shapes["y"], [(2, 4)])
+        self.assertTrue(np.isclose(stats["x"]["a"]["mean"], x.data.numpy().mean()))
+        self.assertTrue(np.isclose(stats["y"]["max"], x[:2].data.numpy().max()))
+        q.unsubscribe(stats)
+        q.unsubscribe(shapes, "y")
+        q.emit("y", x)
+        self.assertEqual(len(shapes["y"]), 1)
+        self.assertTrue(np.isclose(stats["y"]["max"], x[:2].data.numpy().max()))
+        q.unsubscribe(last)
+        q.unsubscribe(shapes)
+        self.assertEqual(q.util.EmitHooks.subscribers, {})
+
+    def test_timed(self):
+        times = q.subscribe(q.EmitRecorder(keep="all"), "block")
+        with q.timed("block"):
+            sum(range(1000))
+        with q.timed("other"):
+            pass
+        q.unsubscribe(times)
+        self.assertEqual(len(times["block"]), 1)
+        self.assertTrue(times["block"][0] >= 0)
+        self.assertFalse("other" in times)
+
+    def test_per_thread(self):
+        rec = q.record_emitted("x")
+        otherthread = []
+
+        def _run():
+            otherthread.append(q.emitting("x"))
+            q.emit("x", 2)
+        t = threading.Thread(target=_run)
+        t.start()
+        t.join()
+        q.emit("x", 1)
+        self.assertEqual(otherthread, [False])
+        self.assertEqual(q.get_emitted("x"), 1)
+        q.stop_recording_emitted()
+        self.assertRaises(KeyError, q.get_emitted, "x")
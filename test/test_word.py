@@ -210,6 +210,14 @@ class TestWordLinout(TestCase):
         self.assertEqual(y.size(), (7, 7))
         # self.assertTrue(False)
 
+    def test_index_masked(self):
+        x = Variable(torch.randn(3, 10))
+        msk = q.IndexMask.from_lists([[0, 2, 3], [2, 6], [5]], 7)
+        y = self.linout(x, mask=msk)
+        self.assertEqual(y.size(), (3, 3))
+        dy = self.linout(x, mask=msk.to_dense())
+        self.assertTrue(np.allclose(torch.gather(dy, 1, msk.ids).data.numpy(), y.data.numpy(), atol=1e-6))
+
 
 class TestPretrainedWordLinout(TestCase):
     def setUp(self):
@@ -339,6 +347,20 @@ class TestComputedWordLinout(TestCase):
         cout = cout * msk.float()
         self.assertTrue(np.allclose(cout.data.numpy(), out.data.numpy()))
 
+    def test_index_masked(self):
+        x = Variable(torch.randn(3, 15)).float()
+        msk = q.IndexMask.from_lists([[0, 2, 3], [2, 6], [5]], 7)
+        out = self.linout(x, mask=msk)
+        self.assertEqual(out.size(), (3, 3))
+        cout = torch.matmul(x, self.linout.computer(self.linout.data).t())
+        cout = torch.gather(cout, 1, msk.ids) * msk.mask
+        self.assertTrue(np.allclose(cout.data.numpy(), out.data.numpy(), atol=1e-6))
+        # softmax over allowed ids only
+        probs, _ = q.Softmax()(out, mask=msk)
+        self.assertEqual(probs.size(), (3, 7))
+        self.assertTrue(np.allclose(probs.data.numpy().sum(1), 1))
+        self.assertTrue(np.all((probs.data.numpy() > 0) == (msk.to_dense().data.numpy() > 0)))
+
     def test_all_masked(self):
         x = Variable(torch.randn(3, 15)).float()
         msk = np.zeros((3, 7)).astype("int32")